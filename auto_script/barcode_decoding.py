@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""读段解码和过滤的 Python 实现，与 LoadCodebook + ReadsFiltration + seqToGene 结果一致
+
+core_matlab 在 ReadsExtraction 之后逐条读段做字符串查找（ismember 和 cellfun(@seqToGene)），
+点多的子块上占点检测的不少时间。这里把整个子块的读段一次解码：
+1. 码本：genes.csv 的条形码反转后按两碱基编码转为颜色序列（new_EncodeBases），duo/tri 去掉第 split_loc 位
+   并把后段移到前面（new_LoadCodebook）。core_matlab 调用 LoadCodebook 时不传 mode，tri 模式也使用
+   duo 的 new_LoadCodebook，不用 new_LoadCodebook_tri 的组学位编码，这里与之相同；
+2. 颜色序列（每轮最亮的通道 1..C）按整数编码：第 j 轮为 base^(R-j) 位，码本排序后用二分查找，
+   整个读段矩阵一次得到基因编号，不在码本中的读段丢弃；
+3. end_bases 只用于统计：按 new_DecodeCS 从首碱基解码颜色序列，检查首尾碱基
+   （regular 为 end_bases(1)...end_bases(2)，duo 为前后各 5 轮，tri 另加第 11 轮的组学位），
+   与 new_FilterReads* 输出相同的三行比例。
+
+输入为 core_matlab 写出的 reads_<method>_t<t>_<N>.csv（x,y,z 和各轮颜色，与 allSpots/basecsMat 相同），
+输出 goodPoints_<method>_t<t>_<N>.csv（x,y,z,Gene，坐标加上子块偏移），与 MATLAB 写出的相同。
+"""
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+BARCODE_MODES = ('regular', 'duo', 'tri')
+BASES = 'ACGTN'
+# new_EncodeBases：两碱基 -> 颜色
+PAIR_COLORS = {'AT': 3, 'GT': 1, 'TT': 2, 'AG': 1, 'GG': 2, 'TG': 3, 'AA': 2, 'GA': 3, 'TA': 1}
+# new_DecodeCS / new_DecodeCS_omic：NEXT_BASE[当前碱基, 颜色] -> 下一个碱基，-1 表示无法解码
+NEXT_BASE = np.full((len(BASES), 4), -1, dtype=np.int8)
+for pair, color in PAIR_COLORS.items():
+    NEXT_BASE[BASES.index(pair[0]), color] = BASES.index(pair[1])
+OMIC_NEXT_BASE = np.full((len(BASES), 4), -1, dtype=np.int8)
+for color, base in ((1, 'T'), (2, 'C'), (3, 'N')):
+    OMIC_NEXT_BASE[BASES.index('G'), color] = BASES.index(base)
+# new_FilterReads_Duo/_tri 中前后两段的轮数
+HALF_ROUNDS = 5
+# 各模式用到的 end_bases 个数
+END_BASES_COUNT = {'regular': 2, 'duo': 4, 'tri': 5}
+
+
+def encode_barcode(barcode):
+    """条形码（已反转）-> 颜色序列字符串（new_EncodeBases，各模式相同）"""
+    colors = []
+    for pair in (barcode[i:i + 2] for i in range(len(barcode) - 1)):
+        if pair not in PAIR_COLORS:
+            raise ValueError(f"条形码 {barcode[::-1]} 含无法编码的碱基对 {pair}")
+        colors.append(str(PAIR_COLORS[pair]))
+    return ''.join(colors)
+
+
+def split_codebook_seq(seq, remove_index):
+    """去掉 remove_index（1 起始）各位，并把第二段移到最前（单个位置时即 new_LoadCodebook）"""
+    segments = []
+    start = 1
+    for index in sorted(remove_index):
+        if start <= index - 1:
+            segments.append(seq[start - 1:index - 1])
+        start = index + 1
+    if start <= len(seq):
+        segments.append(seq[start - 1:])
+    if len(segments) > 1:
+        segments = [segments[1], segments[0]] + segments[2:]
+    return ''.join(segments)
+
+
+def read_genes_csv(path):
+    """genes.csv 的 (基因名, 条形码)；首行的条形码不是碱基序列时视为表头"""
+    rows = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            fields = [field.strip() for field in line.rstrip('\r\n').split(',')]
+            if len(fields) >= 2 and fields[0]:
+                rows.append((fields[0], fields[1]))
+    if rows and not set(rows[0][1].upper()) <= set('ACGT'):
+        rows = rows[1:]
+    return rows
+
+
+class Codebook:
+    """颜色序列 -> 基因的整数索引
+
+    codes 为排序后的颜色序列编码，gene_index[i] 为 codes[i] 对应的基因在 genes 中的下标。
+    """
+
+    def __init__(self, seqs, genes):
+        # containers.Map 中重复的键以最后一个为准
+        seq_to_gene = dict(zip(seqs, genes))
+        self.genes = sorted(set(seq_to_gene.values()))
+        self.lengths = {len(seq) for seq in seq_to_gene}
+        self.base = max([int(c) for seq in seq_to_gene for c in seq] + [0]) + 1
+        seq_codes = {seq: self._encode_seq(seq) for seq in seq_to_gene}
+        order = sorted(seq_to_gene, key=seq_codes.get)
+        self.codes = np.array([seq_codes[seq] for seq in order], dtype=np.int64)
+        self.seq_lengths = np.array([len(seq) for seq in order], dtype=np.int64)
+        gene_ids = {gene: i for i, gene in enumerate(self.genes)}
+        self.gene_index = np.array([gene_ids[seq_to_gene[seq]] for seq in order], dtype=np.int64)
+
+    def _encode_seq(self, seq):
+        code = 0
+        for c in seq:
+            code = code * self.base + int(c)
+        return code
+
+    def encode(self, colors):
+        """N×R 的颜色矩阵 -> 整数编码；含码本以外的颜色值时为 -1"""
+        colors = np.asarray(colors, dtype=np.int64)
+        if colors.shape[1] * np.log2(max(self.base, 2)) >= 63:
+            raise ValueError(f"{colors.shape[1]} 轮的颜色序列超出 int64 编码范围")
+        powers = self.base ** np.arange(colors.shape[1] - 1, -1, -1, dtype=np.int64)
+        codes = colors @ powers
+        codes[((colors < 0) | (colors >= self.base)).any(axis=1)] = -1
+        return codes
+
+    def lookup(self, colors):
+        """N×R 的颜色矩阵 -> 基因下标，不在码本中的为 -1（与 ismember(str, barcodeSeqs) 相同）"""
+        colors = np.asarray(colors)
+        result = np.full(len(colors), -1, dtype=np.int64)
+        if len(colors) == 0 or colors.shape[1] not in self.lengths:
+            return result
+        codes = self.encode(colors)
+        pos = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+        # 编码相同但长度不同的码本序列不算匹配（字符串比较）
+        hit = (codes >= 0) & (self.codes[pos] == codes) & (self.seq_lengths[pos] == colors.shape[1])
+        result[hit] = self.gene_index[pos[hit]]
+        return result
+
+
+def load_codebook(path, mode, split_loc=()):
+    """与 core_matlab 中的 LoadCodebook 相同：条形码反转，duo/tri 以 split_loc 为 remove_index，编码不随模式变化"""
+    if mode not in BARCODE_MODES:
+        raise ValueError(f"barcode_mode 必须是 {'、'.join(BARCODE_MODES)} 之一，而不是 {mode}")
+    genes, seqs = [], []
+    for gene, barcode in read_genes_csv(path):
+        seq = encode_barcode(barcode[::-1])
+        if mode != 'regular' and split_loc:
+            seq = split_codebook_seq(seq, split_loc)
+        genes.append(gene)
+        seqs.append(seq)
+    return Codebook(seqs, genes)
+
+
+def decode_colorspace(colors, start_base, table=NEXT_BASE):
+    """new_DecodeCS：从 start_base 起按颜色依次推出碱基，返回 (首碱基, 末碱基) 的下标，无法解码时为 -1"""
+    colors = np.asarray(colors, dtype=np.int64)
+    current = np.full(len(colors), BASES.index(start_base), dtype=np.int64)
+    for j in range(colors.shape[1]):
+        valid = (current >= 0) & (colors[:, j] >= 0) & (colors[:, j] < table.shape[1])
+        current = np.where(valid, table[np.maximum(current, 0), np.clip(colors[:, j], 0, table.shape[1] - 1)], -1)
+    first = np.where(current >= 0, BASES.index(start_base), -1)
+    return first, current
+
+
+def matches_pattern(colors, start_base, end_base, table=NEXT_BASE):
+    first, last = decode_colorspace(colors, start_base, table)
+    return (first == BASES.index(start_base)) & (last == BASES.index(end_base))
+
+
+def pattern_mask(colors, mode, end_bases):
+    """各读段是否符合 end_bases 的碱基模式（new_FilterReads* 中的 correctSeqs）"""
+    colors = np.asarray(colors)
+    if len(end_bases) < END_BASES_COUNT[mode]:
+        raise ValueError(f"{mode} 模式需要 {END_BASES_COUNT[mode]} 个 end_bases，而不是 {''.join(end_bases)}")
+    if mode == 'regular':
+        return matches_pattern(colors, end_bases[0], end_bases[1])
+    front = colors[:, :HALF_ROUNDS]
+    back = colors[:, HALF_ROUNDS:2 * HALF_ROUNDS]
+    if mode == 'duo':
+        return matches_pattern(front, end_bases[0], end_bases[2]) & matches_pattern(back, end_bases[1], end_bases[3])
+    first, _ = decode_colorspace(colors[:, 2 * HALF_ROUNDS:2 * HALF_ROUNDS + 1], end_bases[0], OMIC_NEXT_BASE)
+    return (matches_pattern(front, end_bases[1], end_bases[3]) & matches_pattern(back, end_bases[2], end_bases[4])
+            & (first == BASES.index(end_bases[0])))
+
+
+def ratio(count, total):
+    return count / total if total else float('nan')
+
+
+def decode_reads(colors, codebook, mode, end_bases):
+    """返回 (基因下标, 统计说明)，基因下标为 -1 的读段不在码本中"""
+    gene_ids = codebook.lookup(colors)
+    kept = int((gene_ids >= 0).sum())
+    total = len(gene_ids)
+    correct = int(pattern_mask(colors, mode, end_bases).sum()) if total else 0
+    stats = [f"{ratio(correct, total):f} [{correct} / {total}] 的读段符合 {mode} 碱基模式 {''.join(end_bases)}",
+             f"{ratio(kept, total):f} [{kept} / {total}] 的读段在码本中",
+             f"{ratio(kept, correct):f} [{kept} / {correct}] 符合模式的读段在码本中"]
+    return gene_ids, stats
+
+
+def read_reads_file(path):
+    """reads_*.csv（无表头，每行 x,y,z,颜色1..颜色R）-> (N×3 坐标, N×R 颜色)"""
+    # 没有读段时 writematrix 可能不写出文件
+    path = Path(path)
+    data = np.loadtxt(path, delimiter=',', ndmin=2) if path.exists() and path.stat().st_size else np.zeros((0, 3))
+    return np.rint(data[:, :3]).astype(np.int64), np.rint(data[:, 3:]).astype(np.int64)
+
+
+def write_good_points(path, spots, genes):
+    """写出 x,y,z,Gene（与 writetable 的 QuoteStrings=false 相同）；先写临时文件再改名"""
+    path = Path(path)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write('x,y,z,Gene\n')
+        f.writelines(f"{x},{y},{z},{gene}\n" for (x, y, z), gene in zip(spots.tolist(), genes))
+    tmp_path.replace(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="读段解码和过滤（第 03 步），写出 goodPoints")
+    parser.add_argument('--reads', required=True, help='core_matlab 写出的 reads_*.csv')
+    parser.add_argument('--codebook', required=True, help='genes.csv（基因名,条形码）')
+    parser.add_argument('--mode', required=True, choices=BARCODE_MODES, help='barcode_mode')
+    parser.add_argument('--end-bases', required=True, help="end_bases，如 GAAA")
+    parser.add_argument('--split-loc', type=int, nargs='*', default=[], help='duo/tri 的 split_loc')
+    parser.add_argument('--offset', type=int, nargs=2, default=(0, 0), metavar=('X', 'Y'),
+                        help='子块左上角在整个视野中的偏移（start_coords - 1）')
+    parser.add_argument('--output', required=True, help='goodPoints_*.csv')
+    args = parser.parse_args()
+
+    codebook = load_codebook(args.codebook, args.mode, args.split_loc)
+    spots, colors = read_reads_file(args.reads)
+    gene_ids, stats = decode_reads(colors, codebook, args.mode, args.end_bases)
+    for line in stats:
+        print(line)
+    keep = gene_ids >= 0
+    good_spots = spots[keep] + np.array([args.offset[0], args.offset[1], 0])
+    write_good_points(args.output, good_spots, [codebook.genes[i] for i in gene_ids[keep]])
+    print(f"已写出 {args.output}（{int(keep.sum())} 个点）")
+
+
+if __name__ == "__main__":
+    main()
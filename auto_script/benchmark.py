@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+"""合成数据的端到端基准测试
+
+生成 STARmap 格式的合成原始数据（<root>/<project>/01_data/roundNN/PositionXXX/PositionXXX_chNN.tif，
+每个文件为一个通道的 z 多页 uint8 TIFF）和对应的 config.ini，数据尺寸、点密度和每轮的平移均可设置，
+真值写到 ground_truth.json：
+
+- 参考轮中每个点为一个体素的峰值（200），6 邻域为 40，背景噪声不超过 20，点之间至少相隔 4 个体素，
+  因此 max3d（阈值 0.2 × 255）检出的点与真值一一对应；每轮每个点随机落在一个通道；
+- 第 r 轮为参考轮的内容整体循环平移 -s_r，配准应得到的平移为 s_r。
+
+然后按 config.ini 依次运行各步骤的 Python 实现，数组任务由 executors.LocalExecutor 运行（与 main.py --executor local
+相同）：按 task_range_header 相同的规则由 SLURM_ARRAY_TASK_ID 和 tasks_per_job 计算 FIRST_TASK..LAST_TASK，
+最多 *_parallel_tasks 个任务同时运行，脚本和日志写到 <output>/<project>/benchmark_jobs。只有 MATLAB 实现的部分由本脚本代替，不计入对应步骤：
+
+    01 全局配准   读取原始 TIFF、写各轮最大投影（代替 core_matlab 的预处理），
+                 运行 global_registration.py，再按估计的平移写出 registeredImages.zarr 和 coords_mat_N.csv
+    02 局部配准   直接把各子块窗口写为 registeredImages_t{t}_{N}.zarr（不做局部校正）
+    03 点检测     运行 spot_finding.py，再把点位置转换为全局坐标的 goodPoints 表（代替读段过滤，基因为 NA）
+    04 局部拼接   运行 local_stitch.py
+    07 IF 融合    （--fusion）把各位置参考轮第一个通道作为 IF 图像按网格排列，运行 fusion.py
+
+每个步骤报告运行时间、位置/小时、点/秒和读写字节数（步骤输入和输出文件的大小），
+并检查估计的平移和拼接后的点是否与真值一致。结果写到 <output>/benchmark.json，
+不同设置（sqrt_pieces、tasks_per_job、coarse_factor 等）的结果可直接比较：
+
+    python benchmark.py --output /tmp/bench --width 1024 --depth 16 --positions 4 --sqrt-pieces 2
+"""
+import argparse
+import configparser
+import csv
+import json
+import shlex
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+import volume_store
+from executors import LocalExecutor
+from generate_scripts import count_array_jobs
+from slurm_monitor import JobMonitor
+from subtile_planner import grid_coords, write_coords_mat
+
+SCRIPT_DIR = Path(__file__).parent.absolute()
+PROJECT_NAME = 'bench'
+SPOT_PEAK = 200
+SPOT_SHOULDER = 40
+NOISE_MAX = 20
+SPOT_SPACING = 4
+# 本地执行后端的轮询间隔（秒），比默认的 1-5 秒短，避免等待时间计入各步骤耗时
+POLL_INTERVAL = 0.1
+NEIGHBORS = [(-1, 0, 0), (1, 0, 0), (0, -1, 0), (0, 1, 0), (0, 0, -1), (0, 0, 1)]
+
+
+def sample_spots(rng, shape, count):
+    """在 (y, x, z) 体积内随机取 count 个互相间隔至少 SPOT_SPACING 的点（数量不足时尽量多取）"""
+    occupied = np.zeros(tuple(n // SPOT_SPACING + 1 for n in shape), dtype=bool)
+    spots = []
+    for candidate in rng.integers(0, shape, size=(count * 4, 3)):
+        cell = tuple(candidate // SPOT_SPACING)
+        lo = [max(0, c - 1) for c in cell]
+        if occupied[lo[0]:cell[0] + 2, lo[1]:cell[1] + 2, lo[2]:cell[2] + 2].any():
+            continue
+        occupied[cell] = True
+        spots.append(candidate)
+        if len(spots) == count:
+            break
+    return np.array(spots, dtype=np.int64).reshape(-1, 3)
+
+
+def render_round(rng, shape, spots, channels, num_channels):
+    """(y, x, z, channel) uint8：背景噪声加上每个点（峰值和 6 邻域）"""
+    volume = rng.integers(0, NOISE_MAX + 1, size=shape + (num_channels,), dtype=np.uint8)
+    for dy, dx, dz in NEIGHBORS:
+        neighbor = np.mod(spots + [dy, dx, dz], shape)
+        volume[neighbor[:, 0], neighbor[:, 1], neighbor[:, 2], channels] = np.maximum(
+            volume[neighbor[:, 0], neighbor[:, 1], neighbor[:, 2], channels], SPOT_SHOULDER)
+    volume[spots[:, 0], spots[:, 1], spots[:, 2], channels] = SPOT_PEAK
+    return volume
+
+
+def raw_tile_path(data_dir, round_id, position, channel):
+    return Path(data_dir) / f"round{round_id:02d}" / f"Position{position:03d}" / f"Position{position:03d}_ch{channel:02d}.tif"
+
+
+def make_dataset(root, width, depth, channels, rounds, positions, spot_density, max_shift, max_z_shift, seed):
+    """写出原始数据，返回真值 {'positions': {位置: {'spots': [[x, y, z]], 'shifts': {轮次: [行, 列, z]}}}}
+
+    spot_density 为每百万体素的点数；点坐标为参考轮中 1 起始的 (x, y, z)，与 goodPoints 表相同。
+    """
+    rng = np.random.default_rng(seed)
+    data_dir = Path(root) / PROJECT_NAME / '01_data'
+    shape = (width, width, depth)
+    truth = {'positions': {}}
+    for position in range(1, positions + 1):
+        spots = sample_spots(rng, shape, int(round(spot_density * width * width * depth / 1e6)))
+        shifts = {1: [0, 0, 0]}
+        for r in range(2, rounds + 1):
+            shifts[r] = [int(v) for v in rng.integers(-max_shift, max_shift + 1, size=2)] + \
+                        [int(rng.integers(-max_z_shift, max_z_shift + 1))]
+        for r in range(1, rounds + 1):
+            volume = render_round(rng, shape, spots, rng.integers(0, channels, size=len(spots)), channels)
+            # 第 r 轮的内容相对参考轮平移 -shift，配准时按 shift 平移回来
+            volume = np.roll(volume, [-s for s in shifts[r]], axis=(0, 1, 2))
+            for c in range(channels):
+                path = raw_tile_path(data_dir, r, position, c)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tifffile.imwrite(path, np.ascontiguousarray(volume[:, :, :, c].transpose(2, 0, 1)))
+        truth['positions'][position] = {'spots': (spots[:, [1, 0, 2]] + 1).tolist(), 'shifts': shifts}
+    return truth
+
+
+def make_config(root, output, width, depth, channels, rounds, positions, sqrt_pieces, tasks_per_job, parallel,
+                coarse_factor):
+    """以仓库中的 config.ini 为模板，写出指向合成数据、使用 Python 实现的配置"""
+    config = configparser.ConfigParser()
+    config.read(SCRIPT_DIR / 'config.ini')
+    config['PROJECT']['project_root'] = str(Path(root).absolute()) + '/'
+    config['PROJECT']['project_name'] = PROJECT_NAME
+    num_subtiles = sqrt_pieces ** 2
+    for section, prefix, tasks in (('GLOBAL_REGISTRATION', 'gr', positions),
+                                   ('LOCAL_REGISTRATION', 'lr', positions * num_subtiles),
+                                   ('LOCAL_STITCH', 'ls', positions)):
+        config[section].update({'image_width': str(width), 'image_depth': str(depth), 'channel_num': str(channels),
+                                'round_num': str(rounds), 'ref_round': '1', 'sqrt_pieces': str(sqrt_pieces),
+                                'tasks_per_job': str(tasks_per_job), f'{prefix}_array_tasks': str(tasks),
+                                f'{prefix}_parallel_tasks': str(parallel)})
+    config['GLOBAL_REGISTRATION'].update({'volume_format': 'zarr', 'registration_backend': 'python',
+                                          'coarse_factor': str(coarse_factor)})
+    config['LOCAL_REGISTRATION'].update({'spotfinding_method': 'max3d', 'spotfinding_backend': 'python'})
+    config['LOCAL_STITCH'].update({'spotfinding_method': 'max3d', 'backend': 'python', 'spot_format': 'csv'})
+    path = Path(output) / 'config.ini'
+    with open(path, 'w') as f:
+        config.write(f)
+    return config, path
+
+
+def run_array(name, job_dir, num_tasks, tasks_per_job, parallel, command, cpus):
+    """用 executors.LocalExecutor 按数组任务运行 command(first, last)，返回失败的数组任务号
+
+    每个数组任务的命令按 SLURM_ARRAY_TASK_ID 写入 <job_dir>/bench_<name>.sh，以 %parallel 限制并发，
+    日志写到 <job_dir>/logs/<name>_<数组任务号>.out。
+    """
+    num_jobs = count_array_jobs(num_tasks, tasks_per_job)
+    cases = []
+    for index in range(1, num_jobs + 1):
+        first = (index - 1) * tasks_per_job + 1
+        args = command(first, min(first + tasks_per_job - 1, num_tasks))
+        cases.append(f"    {index}) {' '.join(shlex.quote(arg) for arg in args)} ;;")
+    script = Path(job_dir) / f"bench_{name}.sh"
+    script.parent.mkdir(parents=True, exist_ok=True)
+    script.write_text('\n'.join([
+        '#!/bin/bash',
+        f"#SBATCH -J bench_{name}",
+        f"#SBATCH -c {cpus}",
+        f"#SBATCH -o {shlex.quote(str(Path(job_dir) / 'logs' / f'{name}_%a.out'))}",
+        f"cd {shlex.quote(str(SCRIPT_DIR))}",
+        'case $SLURM_ARRAY_TASK_ID in',
+        *cases,
+        '    *) echo "未知的数组任务号 $SLURM_ARRAY_TASK_ID" >&2; exit 1 ;;',
+        'esac',
+    ]) + '\n')
+
+    executor = LocalExecutor(max_cpus=max(1, parallel) * cpus)
+    monitor = JobMonitor(executor, min_interval=POLL_INTERVAL, max_interval=POLL_INTERVAL)
+    job_id = executor.submit(script, array=f"1-{num_jobs}%{max(1, parallel)}", env={'OFFSET': 0})
+    if job_id is None:
+        return list(range(1, num_jobs + 1))
+    monitor.track(job_id, name)
+    monitor.wait()
+    failed = sorted(int(task) for task, _, _ in monitor.failed_tasks(job_id))
+    for index in failed:
+        log = Path(job_dir) / 'logs' / f"{name}_{index}.out"
+        print(f"{name} 数组任务 {index} 失败：\n{log.read_text(errors='replace') if log.exists() else ''}")
+    return failed
+
+
+def size_of(paths):
+    """文件和目录（递归）的总字节数"""
+    total = 0
+    for path in map(Path, paths):
+        if path.is_dir():
+            total += sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+        elif path.exists():
+            total += path.stat().st_size
+    return total
+
+
+class Stage:
+    """计时并统计一个步骤的读写量"""
+
+    def __init__(self, results, name, positions):
+        self.results = results
+        self.record = {'stage': name, 'positions': positions}
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        record = self.record
+        record['seconds'] = round(seconds, 3)
+        record['positions_per_hour'] = round(record['positions'] * 3600 / seconds, 1) if seconds else None
+        if 'spots' in record:
+            record['spots_per_s'] = round(record['spots'] / seconds, 1) if seconds else None
+        record.setdefault('bytes_read', 0)
+        record.setdefault('bytes_written', 0)
+        record['mb_per_s'] = round((record['bytes_read'] + record['bytes_written']) / 1e6 / seconds, 1) if seconds else None
+        self.results.append(record)
+        return False
+
+
+def global_registration(config, registration_dir, data_dir, positions, results, workers):
+    section = config['GLOBAL_REGISTRATION']
+    sqrt_pieces = int(section['sqrt_pieces'])
+    num_subtiles = sqrt_pieces ** 2
+    rounds, channels = int(section['round_num']), int(section['channel_num'])
+    tile_size = int(section['image_width']) // sqrt_pieces
+    raw = {}
+    with Stage(results, '01_prepare (core_matlab stand-in)', positions) as stage:
+        for position in range(1, positions + 1):
+            interm_dir = registration_dir / f"Position{position:03d}" / 'interm'
+            interm_dir.mkdir(parents=True, exist_ok=True)
+            files = [[raw_tile_path(data_dir, r, position, c) for c in range(channels)] for r in range(1, rounds + 1)]
+            stage.record['bytes_read'] = stage.record.get('bytes_read', 0) + size_of(p for row in files for p in row)
+            raw[position] = np.stack([np.stack([tifffile.imread(str(p)).transpose(1, 2, 0) for p in row], axis=3)
+                                      for row in files], axis=4)
+            volume_store.write_volume(interm_dir / 'global_registration_input.zarr',
+                                      raw[position].max(axis=3, keepdims=True), tile_size)
+        stage.record['bytes_written'] = size_of(registration_dir / f"Position{p:03d}" / 'interm' / 'global_registration_input.zarr'
+                                                for p in range(1, positions + 1))
+
+    def command(first, last):
+        return [sys.executable, str(SCRIPT_DIR / 'global_registration.py'),
+                '--input', str(registration_dir / f"Position{first:03d}" / 'interm' / 'global_registration_input.zarr'),
+                '--output', str(registration_dir / f"Position{first:03d}" / 'interm' / 'global_shifts.csv'),
+                '--ref-round', section['ref_round'], '--coarse-factor', section.get('coarse_factor', '1'), '--workers', str(workers)]
+
+    with Stage(results, '01_global_registration.py', positions) as stage:
+        # global_registration.py 每次处理一个位置
+        failed = run_array('01', registration_dir.parent / 'benchmark_jobs', positions, 1,
+                           section.getint('gr_parallel_tasks'), command, workers)
+        stage.record['failed_tasks'] = len(failed)
+        stage.record['bytes_read'] = stage.record['bytes_written'] = 0
+        for p in range(1, positions + 1):
+            interm_dir = registration_dir / f"Position{p:03d}" / 'interm'
+            stage.record['bytes_read'] += size_of([interm_dir / 'global_registration_input.zarr'])
+            stage.record['bytes_written'] += size_of([interm_dir / 'global_shifts.csv'])
+
+    shifts = {}
+    with Stage(results, '01_apply_shifts (core_matlab stand-in)', positions) as stage:
+        for position in range(1, positions + 1):
+            interm_dir = registration_dir / f"Position{position:03d}" / 'interm'
+            with open(interm_dir / 'global_shifts.csv', newline='') as f:
+                shifts[position] = {int(row['round']): [int(row['row_shift']), int(row['col_shift']), int(row['z_shift'])]
+                                    for row in csv.DictReader(f)}
+            registered = raw.pop(position)
+            for r, shift in shifts[position].items():
+                registered[..., r - 1] = np.roll(registered[..., r - 1], shift, axis=(0, 1, 2))
+            volume_store.write_volume(volume_store.global_store_path(interm_dir), registered, tile_size)
+            write_coords_mat(interm_dir, grid_coords(int(section['image_width']), sqrt_pieces, sqrt_pieces))
+        interm_dirs = [registration_dir / f"Position{p:03d}" / 'interm' for p in range(1, positions + 1)]
+        stage.record['bytes_written'] = size_of([volume_store.global_store_path(d) for d in interm_dirs]
+                                                + [d / f"coords_mat_{num_subtiles}.csv" for d in interm_dirs])
+    return shifts
+
+
+def local_registration(config, registration_dir, positions, results):
+    num_subtiles = int(config['LOCAL_REGISTRATION']['sqrt_pieces']) ** 2
+    with Stage(results, '02_subtile_split (local registration stand-in)', positions) as stage:
+        for position in range(1, positions + 1):
+            interm_dir = registration_dir / f"Position{position:03d}" / 'interm'
+            for subtile in range(1, num_subtiles + 1):
+                volume_store.write_volume(volume_store.subtile_store_path(interm_dir, subtile, num_subtiles),
+                                          volume_store.read_subtile(interm_dir, subtile, num_subtiles))
+            stage.record['bytes_read'] = stage.record.get('bytes_read', 0) + size_of([volume_store.global_store_path(interm_dir)])
+            stage.record['bytes_written'] = stage.record.get('bytes_written', 0) + size_of(
+                volume_store.subtile_store_path(interm_dir, t, num_subtiles) for t in range(1, num_subtiles + 1))
+
+
+def spot_finding(config, registration_dir, positions, results, workers):
+    section = config['LOCAL_REGISTRATION']
+    num_subtiles = int(section['sqrt_pieces']) ** 2
+    num_tasks = positions * num_subtiles
+
+    def command(first, last):
+        return [sys.executable, str(SCRIPT_DIR / 'spot_finding.py'), '--registration-dir', str(registration_dir),
+                '--tasks', str(first), str(last), '--subtiles', str(num_subtiles), '--ref-round', section['ref_round'],
+                '--intensity-threshold', section['intensity_threshold'], '--volume-format', 'zarr',
+                '--workers', str(workers)]
+
+    def interm(task_id):
+        return registration_dir / f"Position{(task_id - 1) // num_subtiles + 1:03d}" / 'interm'
+
+    def spots_file(task_id):
+        return interm(task_id) / f"spots_max3d_t{(task_id - 1) % num_subtiles + 1}_{num_subtiles}.csv"
+
+    with Stage(results, '03_spot_finding.py', positions) as stage:
+        failed = run_array('03', registration_dir.parent / 'benchmark_jobs', num_tasks, section.getint('tasks_per_job'),
+                           section.getint('lr_parallel_tasks'), command, workers)
+        stage.record['failed_tasks'] = len(failed)
+        stage.record['bytes_read'] = size_of(volume_store.subtile_store_path(interm(t), (t - 1) % num_subtiles + 1, num_subtiles)
+                                             for t in range(1, num_tasks + 1))
+        stage.record['bytes_written'] = size_of(spots_file(t) for t in range(1, num_tasks + 1))
+        stage.record['spots'] = sum(max(0, sum(1 for _ in open(spots_file(t))) - 1)
+                                    for t in range(1, num_tasks + 1) if spots_file(t).exists())
+
+    # 读段过滤由 MATLAB 完成，这里把子块坐标转换为全局坐标，作为 goodPoints 表
+    for task_id in range(1, num_tasks + 1):
+        subtile = (task_id - 1) % num_subtiles + 1
+        if not spots_file(task_id).exists():
+            continue
+        coords = volume_store.read_coords(interm(task_id), num_subtiles)[subtile - 1]
+        spots = np.loadtxt(spots_file(task_id), delimiter=',', skiprows=1, ndmin=2).reshape(-1, 3).astype(np.int64)
+        spots[:, 0] += coords['scoords_x'] - 1
+        spots[:, 1] += coords['scoords_y'] - 1
+        with open(interm(task_id) / f"goodPoints_max3d_t{subtile}_{num_subtiles}.csv", 'w', newline='') as f:
+            f.write('x,y,z,gene\n')
+            f.writelines(f"{x},{y},{z},NA\n" for x, y, z in spots)
+
+
+def local_stitch(config_path, registration_dir, positions, num_subtiles, results):
+    with Stage(results, '04_local_stitch.py', positions) as stage:
+        result = subprocess.run([sys.executable, str(SCRIPT_DIR / 'local_stitch.py'), '--config', str(config_path)],
+                                capture_output=True, text=True, cwd=SCRIPT_DIR)
+        stage.record['failed_tasks'] = int(result.returncode != 0)
+        if result.returncode != 0:
+            print(f"04 失败：\n{result.stdout}{result.stderr}")
+        stage.record['bytes_read'] = size_of(registration_dir / f"Position{p:03d}" / 'interm' / f"goodPoints_max3d_t{t}_{num_subtiles}.csv"
+                                             for p in range(1, positions + 1) for t in range(1, num_subtiles + 1))
+        outputs = [registration_dir / f"Position{p:03d}" / 'goodPoints_max3d.csv' for p in range(1, positions + 1)]
+        stage.record['bytes_written'] = size_of(outputs)
+        stage.record['spots'] = sum(max(0, sum(1 for _ in open(path)) - 1) for path in outputs if path.exists())
+
+
+def if_fusion(registration_dir, data_dir, width, positions, results, workers):
+    """各位置参考轮第一个通道作为 IF 图像，按一行排列（重叠 10%）后融合"""
+    protein_dir = registration_dir / 'IF1' / 'bench_protein'
+    protein_dir.mkdir(parents=True, exist_ok=True)
+    step = int(width * 0.9)
+    with open(protein_dir / 'TileConfiguration.registered.txt', 'w') as f:
+        f.write('# Define the number of dimensions we are working on\ndim = 3\n\n# Define the image coordinates\n')
+        for position in range(1, positions + 1):
+            tifffile.imwrite(protein_dir / f"Position{position:03d}.tif", tifffile.imread(str(raw_tile_path(data_dir, 1, position, 0))))
+            f.write(f"Position{position:03d}.tif; ; ({(position - 1) * step}.0, 0.0, 0.0)\n")
+    tiles = [protein_dir / f"Position{p:03d}.tif" for p in range(1, positions + 1)]
+    outputs = [protein_dir / 'bench_proteinbig3dnew.ome.zarr', protein_dir / 'bench_proteinbig2dnew.tif',
+               protein_dir / 'bench_proteinbig2dnew.ome.zarr']
+    with Stage(results, '07_fusion.py', positions) as stage:
+        result = subprocess.run([sys.executable, str(SCRIPT_DIR / 'fusion.py'),
+                                 '--tile-config', str(protein_dir / 'TileConfiguration.registered.txt'),
+                                 '--tile-dir', str(protein_dir), '--output', str(outputs[0]), '--mip-tiff', str(outputs[1]),
+                                 '--mip-output', str(outputs[2]), '--workers', str(workers)],
+                                capture_output=True, text=True, cwd=SCRIPT_DIR)
+        stage.record['failed_tasks'] = int(result.returncode != 0)
+        if result.returncode != 0:
+            print(f"07 失败：\n{result.stdout}{result.stderr}")
+        stage.record['bytes_read'] = size_of(tiles)
+        stage.record['bytes_written'] = size_of(outputs)
+    if result.returncode != 0:
+        return False
+    expected = (width, (positions - 1) * step + width)
+    return tifffile.imread(str(outputs[1])).shape == expected
+
+
+def check_spots(registration_dir, truth):
+    """拼接后的点与真值比较，返回 {位置: {'truth', 'found', 'matched'}}"""
+    checks = {}
+    for position, expected in truth['positions'].items():
+        path = registration_dir / f"Position{int(position):03d}" / 'goodPoints_max3d.csv'
+        found = set()
+        if path.exists():
+            with open(path, newline='') as f:
+                found = {(int(row['x']), int(row['y']), int(row['z'])) for row in csv.DictReader(f)}
+        expected_spots = {tuple(spot) for spot in expected['spots']}
+        checks[position] = {'truth': len(expected_spots), 'found': len(found), 'matched': len(found & expected_spots)}
+    return checks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="合成数据的端到端基准测试：各步骤吞吐量，以及平移和点数与真值的比较")
+    parser.add_argument('--output', required=True, help='数据、配置和结果的输出目录')
+    parser.add_argument('--width', type=int, default=512, help='image_width（默认：512）')
+    parser.add_argument('--depth', type=int, default=16, help='image_depth（默认：16）')
+    parser.add_argument('--channels', type=int, default=3, help='channel_num（默认：3）')
+    parser.add_argument('--rounds', type=int, default=4, help='round_num（默认：4）')
+    parser.add_argument('--positions', type=int, default=2, help='位置数（默认：2）')
+    parser.add_argument('--spot-density', type=float, default=50, help='每百万体素的点数（默认：50）')
+    parser.add_argument('--max-shift', type=int, default=8, help='各轮 xy 平移的最大值（默认：8）')
+    parser.add_argument('--max-z-shift', type=int, default=0, help='各轮 z 平移的最大值（默认：0）')
+    parser.add_argument('--sqrt-pieces', type=int, default=2, help='sqrt_pieces（默认：2）')
+    parser.add_argument('--tasks-per-job', type=int, default=1, help='tasks_per_job（默认：1）')
+    parser.add_argument('--parallel', type=int, default=2, help='*_parallel_tasks（默认：2）')
+    parser.add_argument('--workers', type=int, default=1, help='每个任务的 SLURM_CPUS_PER_TASK（默认：1）')
+    parser.add_argument('--coarse-factor', type=int, default=1, help='global_registration.py 的 coarse_factor（默认：1）')
+    parser.add_argument('--fusion', action='store_true', help='同时测试 IF 融合（fusion.py）')
+    parser.add_argument('--seed', type=int, default=0, help='随机数种子（默认：0）')
+    args = parser.parse_args()
+
+    output = Path(args.output).absolute()
+    output.mkdir(parents=True, exist_ok=True)
+    results = []
+    with Stage(results, '00_generate', args.positions) as stage:
+        truth = make_dataset(output, args.width, args.depth, args.channels, args.rounds, args.positions,
+                             args.spot_density, args.max_shift, args.max_z_shift, args.seed)
+        stage.record['bytes_written'] = size_of([output / PROJECT_NAME / '01_data'])
+    with open(output / 'ground_truth.json', 'w') as f:
+        json.dump(truth, f)
+    config, config_path = make_config(output, output, args.width, args.depth, args.channels, args.rounds,
+                                      args.positions, args.sqrt_pieces, args.tasks_per_job, args.parallel,
+                                      args.coarse_factor)
+    registration_dir = output / PROJECT_NAME / '02_registration'
+    data_dir = output / PROJECT_NAME / '01_data'
+    num_subtiles = args.sqrt_pieces ** 2
+
+    shifts = global_registration(config, registration_dir, data_dir, args.positions, results, args.workers)
+    local_registration(config, registration_dir, args.positions, results)
+    spot_finding(config, registration_dir, args.positions, results, args.workers)
+    local_stitch(config_path, registration_dir, args.positions, num_subtiles, results)
+    fusion_ok = if_fusion(registration_dir, data_dir, args.width, args.positions, results, args.workers) if args.fusion else None
+
+    shift_errors = [(position, r) for position, expected in truth['positions'].items()
+                    for r, shift in expected['shifts'].items() if shifts.get(position, {}).get(r) != shift]
+    spot_checks = check_spots(registration_dir, truth)
+    report = {
+        'parameters': vars(args),
+        'stages': results,
+        'checks': {
+            'shifts_match': not shift_errors,
+            'shift_errors': shift_errors,
+            'spots': spot_checks,
+            'spots_match': all(c['truth'] == c['found'] == c['matched'] for c in spot_checks.values()),
+            'fusion_shape_match': fusion_ok,
+        },
+    }
+    with open(output / 'benchmark.json', 'w') as f:
+        json.dump(report, f, indent=1)
+
+    print(f"{'步骤':<48}{'秒':>9}{'位置/小时':>11}{'点/秒':>10}{'读 MB':>9}{'写 MB':>9}")
+    for record in results:
+        spots_rate = record.get('spots_per_s')
+        print(f"{record['stage']:<48}{record['seconds']:>9.2f}{record['positions_per_hour'] or 0:>11.0f}"
+              f"{'-' if spots_rate is None else f'{spots_rate:.0f}':>10}"
+              f"{record['bytes_read'] / 1e6:>9.1f}{record['bytes_written'] / 1e6:>9.1f}")
+    checks = report['checks']
+    print(f"平移与真值一致：{checks['shifts_match']}" + (f"（不一致：{shift_errors}）" if shift_errors else ""))
+    print(f"点与真值一致：{checks['spots_match']} "
+          + ", ".join(f"Position{int(p):03d} {c['matched']}/{c['truth']}（检出 {c['found']}）" for p, c in spot_checks.items()))
+    if fusion_ok is not None:
+        print(f"融合图尺寸正确：{fusion_ok}")
+    print(f"结果已写出到 {output / 'benchmark.json'}")
+    if not (checks['shifts_match'] and checks['spots_match'] and fusion_ok is not False):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
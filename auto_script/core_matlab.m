@@ -5,6 +5,8 @@
     % 3 local_registration: performs local reg over one subtile and performs spot-finding and filtering
     % 4 stitch: aggregates spot-finding results across subtiles and "re-stitches" the full tile
     % 5 nuclei_protein_registration: 
+    % 6 local_registration_spot_finding: local reg and spot-finding of one subtile in one call,
+    %   the registered subtile stays in memory and is only written when 'save_registered' is true
 
 function out = core_matlab( sample, mode, tile, xy, z, ref_round, n_chs, n_rounds, ...
                             user_dir, source_data_dir, registration_dir, log_dir, ...
@@ -46,6 +48,16 @@ function out = core_matlab( sample, mode, tile, xy, z, ref_round, n_chs, n_round
     defaultqScoreThers = 0;
     defaultproteinRound = "";
     defaultproteinStains = [];
+    defaultsaveRegistered = false;
+    defaultvolumeFormat = "mat";
+    defaultspotfindingBackend = "matlab";
+    defaultregistrationBackend = "matlab";
+    defaultregistrationScript = "";
+    defaultcoarseFactor = 1;
+    defaultrefineWindow = 512;
+    defaultcoordsFile = "";
+    defaultdecodingBackend = "matlab";
+    defaultdecodingScript = "";
     addParameter(p, 'subtile', defaultSubtile);
     addParameter(p, 'end_bases', defaultendBases);
     addParameter(p, 'barcode_mode', defaultbarcodeMode);
@@ -57,6 +69,16 @@ function out = core_matlab( sample, mode, tile, xy, z, ref_round, n_chs, n_round
     % addParameter(p, 'q_score_thers', defaultqScoreThers);
     addParameter(p, 'protein_round', defaultproteinRound);
     addParameter(p, 'protein_stains', defaultproteinStains);
+    addParameter(p, 'save_registered', defaultsaveRegistered);
+    addParameter(p, 'volume_format', defaultvolumeFormat);
+    addParameter(p, 'spotfinding_backend', defaultspotfindingBackend);
+    addParameter(p, 'registration_backend', defaultregistrationBackend);
+    addParameter(p, 'registration_script', defaultregistrationScript);
+    addParameter(p, 'coarse_factor', defaultcoarseFactor);
+    addParameter(p, 'refine_window', defaultrefineWindow);
+    addParameter(p, 'coords_file', defaultcoordsFile);
+    addParameter(p, 'decoding_backend', defaultdecodingBackend);
+    addParameter(p, 'decoding_script', defaultdecodingScript);
  
     parse(p, sample, mode, tile, xy, z, ref_round, n_chs, n_rounds, ...
             user_dir, source_data_dir, registration_dir, log_dir, ...
@@ -64,6 +86,22 @@ function out = core_matlab( sample, mode, tile, xy, z, ref_round, n_chs, n_round
 
     disp("additional parameters parsed")
 
+    % Subtile grid: planned by auto_script/subtile_planner.py (coords_file, possibly non-square)
+    % or sqrt_pieces x sqrt_pieces. For a planned grid, tile_size is [y x]: the zarr chunks follow the
+    % grid spacing of each axis, so every subtile window reads the same few chunks
+    opts = p.Results;
+    if strlength(string(opts.coords_file)) > 0
+        planned_coords = readtable(opts.coords_file, 'ReadVariableNames', true, 'TextType', 'string');
+        opts.n_subtiles = height(planned_coords);
+        opts.tile_size = [min([diff(unique(planned_coords.upperleft_y)); opts.xy]), ...
+                          min([diff(unique(planned_coords.upperleft_x)); opts.xy])];
+        opts.sqrt_pieces = 0;
+    else
+        planned_coords = [];
+        opts.n_subtiles = opts.sqrt_pieces^2;
+        opts.tile_size = floor(opts.xy / max(opts.sqrt_pieces, 1));
+    end
+
     % Parse dimensions
     input_dim = [p.Results.xy p.Results.xy p.Results.z p.Results.n_chs p.Results.n_rounds];
 
@@ -115,7 +153,11 @@ function out = core_matlab( sample, mode, tile, xy, z, ref_round, n_chs, n_round
         sdata = sdata.MorphoRecon('Method', "2d", 'radius', 6);
     
         %%% register
-        sdata = sdata.test_GlobalRegistration('useGPU', false, 'ref_round', p.Results.ref_round); 
+        if strcmp(p.Results.registration_backend, "python")
+            sdata = PythonGlobalRegistration(sdata, opts, interm_output_dir);
+        else
+            sdata = sdata.test_GlobalRegistration('useGPU', false, 'ref_round', p.Results.ref_round); 
+        end
     
         % Save global registered images for each round
         %for r = 1:size(sdata.registeredImages, 5) % 遍历每个 round
@@ -152,57 +194,69 @@ function out = core_matlab( sample, mode, tile, xy, z, ref_round, n_chs, n_round
         fclose(sdata.log);
 
         % Split into subtiles for local registration and spot-finding
-        coords_mat = table([],[],[],[],[],[],[],[],[],[],[],'VariableNames',{'t','ind_x','ind_y','scoords_x','scoords_y','ecoords_x','ecoords_y','upperleft_x','upperleft_y','inputdim_x','inputdim_y'});
-        sub_order = [];
-        for i = 0:(p.Results.sqrt_pieces-1)
-            for j = 0:(p.Results.sqrt_pieces-1)
-                sub_order = [sub_order;[i,j]];
-            end
-        end
-        tile_size = floor(p.Results.xy / p.Results.sqrt_pieces);
-        overlap_half = floor(tile_size * 0.1);
-        upper_left = [0,0];
-        for t=1:size(sub_order,1)
-            tile_idx = sub_order(t,:);
-            start_coords_x = tile_idx(1) * tile_size - overlap_half + 1;
-            end_coords_x = (tile_idx(1)+1) * tile_size + overlap_half;
-            start_coords_y = tile_idx(2) * tile_size - overlap_half + 1;
-            end_coords_y = (tile_idx(2)+1) * tile_size + overlap_half;
-            %% compensate in edge
-            if tile_idx(1) == 0
-                start_coords_x = start_coords_x + overlap_half;
-            end
-            if tile_idx(2) == 0
-                start_coords_y = start_coords_y + overlap_half;
+        if ~isempty(planned_coords)
+            coords_mat = planned_coords;
+        else
+            coords_mat = table([],[],[],[],[],[],[],[],[],[],[],'VariableNames',{'t','ind_x','ind_y','scoords_x','scoords_y','ecoords_x','ecoords_y','upperleft_x','upperleft_y','inputdim_x','inputdim_y'});
+            sub_order = [];
+            for i = 0:(p.Results.sqrt_pieces-1)
+                for j = 0:(p.Results.sqrt_pieces-1)
+                    sub_order = [sub_order;[i,j]];
+                end
             end
-            %% compensate in edge
-            if tile_idx(1) == p.Results.sqrt_pieces - 1
-                end_coords_x = input_dim(1);
+            tile_size = opts.tile_size;
+            overlap_half = floor(tile_size * 0.1);
+            upper_left = [0,0];
+            for t=1:size(sub_order,1)
+                tile_idx = sub_order(t,:);
+                start_coords_x = tile_idx(1) * tile_size - overlap_half + 1;
+                end_coords_x = (tile_idx(1)+1) * tile_size + overlap_half;
+                start_coords_y = tile_idx(2) * tile_size - overlap_half + 1;
+                end_coords_y = (tile_idx(2)+1) * tile_size + overlap_half;
+                %% compensate in edge
+                if tile_idx(1) == 0
+                    start_coords_x = start_coords_x + overlap_half;
+                end
+                if tile_idx(2) == 0
+                    start_coords_y = start_coords_y + overlap_half;
+                end
+                %% compensate in edge
+                if tile_idx(1) == p.Results.sqrt_pieces - 1
+                    end_coords_x = input_dim(1);
+                end
+                if tile_idx(2) == p.Results.sqrt_pieces - 1
+                    end_coords_y = input_dim(2);
+                end
+                upper_left(1) = tile_idx(1) * tile_size;
+                upper_left(2) = tile_idx(2) * tile_size;    
+        
+                input_dim_t = input_dim;
+                input_dim_t(1:2) = [end_coords_x - start_coords_x + 1,end_coords_y - start_coords_y + 1];
+                disp([tile_idx,start_coords_x,end_coords_x,start_coords_y,end_coords_y,upper_left(1:2),input_dim_t(1:2)]);
+                coords_mat_t = table(t,tile_idx(1),tile_idx(2),start_coords_x,start_coords_y,end_coords_x,end_coords_y,upper_left(1),upper_left(2),input_dim_t(1),input_dim_t(2),'VariableNames',{'t','ind_x','ind_y','scoords_x','scoords_y','ecoords_x','ecoords_y','upperleft_x','upperleft_y','inputdim_x','inputdim_y'});
+                coords_mat = [coords_mat;coords_mat_t];
             end
-            if tile_idx(2) == p.Results.sqrt_pieces - 1
-                end_coords_y = input_dim(2);
+        end
+        if ~strcmp(p.Results.volume_format, "zarr")
+            for t=1:size(coords_mat,1)
+                t_output = sdata.registeredImages(coords_mat.scoords_y(t):coords_mat.ecoords_y(t),coords_mat.scoords_x(t):coords_mat.ecoords_x(t),:,:,:); %% row - y , col - x [row, col, z, :,:]
+
+                %%% save each subtile registered images in following format: registeredImages_t{subtile}_{total_subtiles}.mat
+                save(fullfile(interm_output_dir, strcat('registeredImages_t',num2str(t),'_',num2str(opts.n_subtiles),'.mat')), "t_output");
             end
-            upper_left(1) = tile_idx(1) * tile_size;
-            upper_left(2) = tile_idx(2) * tile_size;    
-    
-            input_dim_t = input_dim;
-            input_dim_t(1:2) = [end_coords_x - start_coords_x + 1,end_coords_y - start_coords_y + 1];
-            disp([tile_idx,start_coords_x,end_coords_x,start_coords_y,end_coords_y,upper_left(1:2),input_dim_t(1:2)]);
-            coords_mat_t = table(t,tile_idx(1),tile_idx(2),start_coords_x,start_coords_y,end_coords_x,end_coords_y,upper_left(1),upper_left(2),input_dim_t(1),input_dim_t(2),'VariableNames',{'t','ind_x','ind_y','scoords_x','scoords_y','ecoords_x','ecoords_y','upperleft_x','upperleft_y','inputdim_x','inputdim_y'});
-            coords_mat = [coords_mat;coords_mat_t];
-            t_output = sdata.registeredImages(start_coords_y:end_coords_y,start_coords_x:end_coords_x,:,:,:); %% row - y , col - x [row, col, z, :,:]
-
-            %%% save each subtile registered images in following format: registeredImages_t{subtile}_{total_subtiles}.mat
-            save(fullfile(interm_output_dir, strcat('registeredImages_t',num2str(t),'_',num2str(p.Results.sqrt_pieces^2),'.mat')), "t_output");
+        else
+            %%% save the whole registered tile once, chunks aligned to the subtile grid
+            WriteZarrVolume(fullfile(interm_output_dir, 'registeredImages.zarr'), sdata.registeredImages, opts.tile_size);
+            disp(strcat("Wrote ", fullfile(interm_output_dir, 'registeredImages.zarr'), " to file"))
         end
-        writetable(coords_mat, fullfile(interm_output_dir,strcat('coords_mat_',num2str(p.Results.sqrt_pieces^2),'.csv')),'Delimiter',',','QuoteStrings',false);
+        writetable(coords_mat, fullfile(interm_output_dir,strcat('coords_mat_',num2str(opts.n_subtiles),'.csv')),'Delimiter',',','QuoteStrings',false);
 
     end
     
     % Local Registration Only
     if strcmp(p.Results.mode,'local_registration')
         %%% get subtile coordinate position data
-        coords_mat =readtable(fullfile(interm_output_dir,strcat('coords_mat_',num2str(p.Results.sqrt_pieces^2),'.csv')),'ReadVariableNames',true,'TextType','string');
+        coords_mat =readtable(fullfile(interm_output_dir,strcat('coords_mat_',num2str(opts.n_subtiles),'.csv')),'ReadVariableNames',true,'TextType','string');
         
         t = p.Results.subtile;
         input_dim_t = input_dim;
@@ -214,9 +268,13 @@ function out = core_matlab( sample, mode, tile, xy, z, ref_round, n_chs, n_round
     
         %%% initialize and load registered subtile 
         sdata_t = new_STARMapDataset_zf(input_path, output_path, 'useGPU', false);
-        sdata_t.log = fopen(fullfile(curr_out_path_log, strcat('log_t',num2str(p.Results.subtile),'_',num2str(p.Results.sqrt_pieces^2),'.txt')), 'w');
-        fprintf(sdata_t.log, strcat('log_t',num2str(p.Results.subtile),'_',num2str(p.Results.sqrt_pieces^2),':\n'));
-        load(fullfile(interm_output_dir, strcat('registeredImages_','t',num2str(p.Results.subtile),'_',num2str(p.Results.sqrt_pieces^2),'.mat')));
+        sdata_t.log = fopen(fullfile(curr_out_path_log, strcat('log_t',num2str(p.Results.subtile),'_',num2str(opts.n_subtiles),'.txt')), 'w');
+        fprintf(sdata_t.log, strcat('log_t',num2str(p.Results.subtile),'_',num2str(opts.n_subtiles),':\n'));
+        if strcmp(p.Results.volume_format, "zarr")
+            t_output = ReadZarrWindow(fullfile(interm_output_dir, 'registeredImages.zarr'), start_coords_y, table2array(coords_mat(t,7)), start_coords_x, table2array(coords_mat(t,6)));
+        else
+            load(fullfile(interm_output_dir, strcat('registeredImages_','t',num2str(p.Results.subtile),'_',num2str(opts.n_subtiles),'.mat')));
+        end
         sdata_t.registeredImages = t_output;
         t_output = [];
         sdata_t.dims = input_dim_t;
@@ -230,9 +288,16 @@ function out = core_matlab( sample, mode, tile, xy, z, ref_round, n_chs, n_round
         sdata_t = sdata_t.xxx_LocalRegistration('Iterations', 50, 'AccumulatedFieldSmoothing', 1, 'ref_round',p.Results.ref_round);
    
         % Save local registered images
-        local_registered_img_name = fullfile(interm_output_dir, strcat('registeredImages_t', num2str(p.Results.subtile), '_', num2str(p.Results.sqrt_pieces^2), '.mat'));
-        local_registered_img = sdata_t.registeredImages;
-        save(local_registered_img_name, 'local_registered_img');
+        if strcmp(p.Results.volume_format, "zarr")
+            local_registered_img_name = fullfile(interm_output_dir, strcat('registeredImages_t', num2str(p.Results.subtile), '_', num2str(opts.n_subtiles), '.zarr'));
+            WriteZarrVolume(local_registered_img_name, sdata_t.registeredImages, max(sdata_t.dimX, sdata_t.dimY));
+        else
+            local_registered_img_name = fullfile(interm_output_dir, strcat('registeredImages_t', num2str(p.Results.subtile), '_', num2str(opts.n_subtiles), '.mat'));
+            local_registered_img = sdata_t.registeredImages;
+            save(local_registered_img_name, 'local_registered_img');
+            %%% global registration writes a .mat with the same name, so mark the subtile as locally registered for --resume
+            WriteLocalRegistrationMarker(interm_output_dir, p.Results.subtile, opts.n_subtiles);
+        end
         disp(strcat("Wrote ", local_registered_img_name, " to file"))
     
         fclose(sdata_t.log);
@@ -241,7 +306,7 @@ function out = core_matlab( sample, mode, tile, xy, z, ref_round, n_chs, n_round
     % Spot Finding Only
     if strcmp(p.Results.mode,'spot_finding')
         %%% get subtile coordinate position data
-        coords_mat =readtable(fullfile(interm_output_dir,strcat('coords_mat_',num2str(p.Results.sqrt_pieces^2),'.csv')),'ReadVariableNames',true,'TextType','string');
+        coords_mat =readtable(fullfile(interm_output_dir,strcat('coords_mat_',num2str(opts.n_subtiles),'.csv')),'ReadVariableNames',true,'TextType','string');
         goodSpots = table([],[],[],[],'VariableNames',{'x','y','z','Gene'});
         
         t = p.Results.subtile;
@@ -254,12 +319,16 @@ function out = core_matlab( sample, mode, tile, xy, z, ref_round, n_chs, n_round
     
         %%% initialize and load locally registered subtile 
         sdata_t = new_STARMapDataset_zf(input_path, output_path, 'useGPU', false);
-        sdata_t.log = fopen(fullfile(curr_out_path_log, strcat('log_t',num2str(p.Results.subtile),'_',num2str(p.Results.sqrt_pieces^2),'.txt')), 'w');
-        fprintf(sdata_t.log, strcat('log_t',num2str(p.Results.subtile),'_',num2str(p.Results.sqrt_pieces^2),':\n'));
+        sdata_t.log = fopen(fullfile(curr_out_path_log, strcat('log_t',num2str(p.Results.subtile),'_',num2str(opts.n_subtiles),'.txt')), 'w');
+        fprintf(sdata_t.log, strcat('log_t',num2str(p.Results.subtile),'_',num2str(opts.n_subtiles),':\n'));
         
         % Load all rounds of locally registered images
-        local_registered_img_name = fullfile(interm_output_dir, strcat('registeredImages_t', num2str(p.Results.subtile), '_', num2str(p.Results.sqrt_pieces^2), '.mat'));
-        load(local_registered_img_name, 't_output');  % 明确指定要加载的变量名
+        if strcmp(p.Results.volume_format, "zarr")
+            t_output = ReadZarrWindow(fullfile(interm_output_dir, strcat('registeredImages_t', num2str(p.Results.subtile), '_', num2str(opts.n_subtiles), '.zarr')));
+        else
+            local_registered_img_name = fullfile(interm_output_dir, strcat('registeredImages_t', num2str(p.Results.subtile), '_', num2str(opts.n_subtiles), '.mat'));
+            load(local_registered_img_name, 't_output');  % 明确指定要加载的变量名
+        end
         sdata_t.registeredImages = t_output;
         
         sdata_t.dims = input_dim_t;
@@ -269,32 +338,62 @@ function out = core_matlab( sample, mode, tile, xy, z, ref_round, n_chs, n_round
         sdata_t.Nchannel = p.Results.n_chs;
         sdata_t.Nround = p.Results.n_rounds;
 
-        %%% spot finding
-        sdata_t = sdata_t.SpotFinding('Method', p.Results.spotfinding_method, 'ref_index', p.Results.ref_round, 'intensityThreshold', p.Results.intensity_threshold, 'showPlots', false);
-        sdata_t = sdata_t.ReadsExtraction('voxelSize', p.Results.voxel_size);
-        if strcmp(p.Results.barcode_mode, "duo")
-            sdata_t = sdata_t.LoadCodebook('remove_index', p.Results.split_loc);
-            sdata_t = sdata_t.ReadsFiltration('mode', "duo", 'endBases', p.Results.end_bases, 'split_loc', p.Results.split_loc, 'showPlots', false);
-        elseif strcmp(p.Results.barcode_mode, "regular")
-            sdata_t = sdata_t.LoadCodebook();
-            sdata_t = sdata_t.ReadsFiltration('mode', "regular", 'endBases', p.Results.end_bases, 'showPlots', false);
-        elseif strcmp(p.Results.barcode_mode, "tri")
-            sdata_t = sdata_t.LoadCodebook('remove_index', p.Results.split_loc);
-            sdata_t = sdata_t.ReadsFiltration('mode', "tri", 'endBases', p.Results.end_bases, 'split_loc', p.Results.split_loc, 'showPlots', false);
-        else
-            fprintf(sdata_t.log, "Reads filtration incomplete: invalid mode entered (valid options include 'regular', 'duo', and 'tri'");
-        end
+        %%% spot finding and save results
+        FindAndSaveSpots(sdata_t, opts, start_coords_x, start_coords_y, interm_output_dir);
+    
+        fclose(sdata_t.log);
+    end
+
+    % Local Registration + Spot Finding
+    if strcmp(p.Results.mode,'local_registration_spot_finding')
+        %%% get subtile coordinate position data
+        coords_mat =readtable(fullfile(interm_output_dir,strcat('coords_mat_',num2str(opts.n_subtiles),'.csv')),'ReadVariableNames',true,'TextType','string');
         
-        %%% save results
-        if size(sdata_t.goodSpots,1) > 0
-            sdata_t.goodSpots(:,1) = sdata_t.goodSpots(:,1) + start_coords_x - 1;
-            sdata_t.goodSpots(:,2) = sdata_t.goodSpots(:,2) + start_coords_y - 1;
-            goodSpots_t = [table(sdata_t.goodSpots(:,1),sdata_t.goodSpots(:,2),sdata_t.goodSpots(:,3),'VariableNames',{'x','y','z'}),cell2table(cellfun(@(x) sdata_t.seqToGene(x), sdata_t.goodReads, 'UniformOutput', false),'VariableNames',{'Gene'})];
+        t = p.Results.subtile;
+        input_dim_t = input_dim;
+        start_coords_x = table2array(coords_mat(t,4));
+        start_coords_y = table2array(coords_mat(t,5));
+        input_dim_t(1:2) = table2array(coords_mat(t,10:11));
+    
+        %%% initialize and load globally registered subtile 
+        sdata_t = new_STARMapDataset_zf(input_path, output_path, 'useGPU', false);
+        sdata_t.log = fopen(fullfile(curr_out_path_log, strcat('log_t',num2str(p.Results.subtile),'_',num2str(opts.n_subtiles),'.txt')), 'w');
+        fprintf(sdata_t.log, strcat('log_t',num2str(p.Results.subtile),'_',num2str(opts.n_subtiles),':\n'));
+        if strcmp(p.Results.volume_format, "zarr")
+            t_output = ReadZarrWindow(fullfile(interm_output_dir, 'registeredImages.zarr'), start_coords_y, table2array(coords_mat(t,7)), start_coords_x, table2array(coords_mat(t,6)));
         else
-            goodSpots_t = table([],[],[],[],'VariableNames',{'x','y','z','Gene'});
+            load(fullfile(interm_output_dir, strcat('registeredImages_t', num2str(p.Results.subtile), '_', num2str(opts.n_subtiles), '.mat')), 't_output');
         end
-
-        writetable(goodSpots_t,fullfile(interm_output_dir, strcat('goodPoints_', p.Results.spotfinding_method, '_t',num2str(p.Results.subtile),'_',num2str(p.Results.sqrt_pieces^2),'.csv')),'Delimiter',',','QuoteStrings',false);
+        sdata_t.registeredImages = t_output;
+        t_output = [];
+        sdata_t.dims = input_dim_t;
+        sdata_t.dimX = input_dim_t(1);
+        sdata_t.dimY = input_dim_t(2);
+        sdata_t.dimZ = input_dim_t(3);
+        sdata_t.Nchannel = p.Results.n_chs;
+        sdata_t.Nround = p.Results.n_rounds;
+    
+        %%% locally register across rounds, keep the result in memory
+        sdata_t = sdata_t.xxx_LocalRegistration('Iterations', 50, 'AccumulatedFieldSmoothing', 1, 'ref_round',p.Results.ref_round);
+    
+        %%% optionally save local registered images (same variable name that spot_finding loads)
+        if p.Results.save_registered
+            registered_img_name = fullfile(interm_output_dir, strcat('registeredImages_t', num2str(p.Results.subtile), '_', num2str(opts.n_subtiles)));
+            if strcmp(p.Results.volume_format, "zarr")
+                registered_img_name = strcat(registered_img_name, '.zarr');
+                WriteZarrVolume(registered_img_name, sdata_t.registeredImages, max(sdata_t.dimX, sdata_t.dimY));
+            else
+                registered_img_name = strcat(registered_img_name, '.mat');
+                t_output = sdata_t.registeredImages;
+                save(registered_img_name, 't_output');
+                t_output = [];
+                WriteLocalRegistrationMarker(interm_output_dir, p.Results.subtile, opts.n_subtiles);
+            end
+            disp(strcat("Wrote ", registered_img_name, " to file"))
+        end
+    
+        %%% spot finding and save results
+        FindAndSaveSpots(sdata_t, opts, start_coords_x, start_coords_y, interm_output_dir);
     
         fclose(sdata_t.log);
     end
@@ -302,7 +401,7 @@ function out = core_matlab( sample, mode, tile, xy, z, ref_round, n_chs, n_round
     % Stitch
     if strcmp(p.Results.mode,'stitch')
         %%% get subtile configuration
-        coords_mat = readtable(fullfile(interm_output_dir,strcat('coords_mat_',num2str(p.Results.sqrt_pieces^2),'.csv')),'ReadVariableNames',true,'TextType','string');
+        coords_mat = readtable(fullfile(interm_output_dir,strcat('coords_mat_',num2str(opts.n_subtiles),'.csv')),'ReadVariableNames',true,'TextType','string');
         goodSpots = table([],[],[],[],'VariableNames',{'x','y','z','Gene'});
         
         %%% iteratively aggregate subtile spots
@@ -310,7 +409,7 @@ function out = core_matlab( sample, mode, tile, xy, z, ref_round, n_chs, n_round
             start_coords_x = table2array(coords_mat(t,4));
             start_coords_y = table2array(coords_mat(t,5));
             upper_left = table2array(coords_mat(t,8:9));
-            goodSpots_t = readtable(fullfile(interm_output_dir,strcat('goodPoints_',p.Results.spotfinding_method,'_t',num2str(t),'_',num2str(p.Results.sqrt_pieces^2),'.csv')),'ReadVariableNames',true,'TextType','string');
+            goodSpots_t = readtable(fullfile(interm_output_dir,strcat('goodPoints_',p.Results.spotfinding_method,'_t',num2str(t),'_',num2str(opts.n_subtiles),'.csv')),'ReadVariableNames',true,'TextType','string');
         
             % filter based on overlap region
             if size(goodSpots,1) > 0
@@ -349,5 +448,189 @@ function out = core_matlab( sample, mode, tile, xy, z, ref_round, n_chs, n_round
     end
 
 
+% Spot finding, reads extraction and filtration on one registered subtile,
+% writes goodPoints_{method}_t{subtile}_{total_subtiles}.csv in full-tile coordinates
+function FindAndSaveSpots(sdata_t, opts, start_coords_x, start_coords_y, interm_output_dir)
+    if strcmp(opts.spotfinding_backend, "python")
+        % spot locations already found by auto_script/spot_finding.py (same as SpotFindingMax3D)
+        spots_file = fullfile(interm_output_dir, strcat('spots_', opts.spotfinding_method, '_t', num2str(opts.subtile), '_', num2str(opts.n_subtiles), '.csv'));
+        allSpots = readmatrix(spots_file);
+        if isempty(allSpots)
+            allSpots = zeros(0, 3);
+        end
+        sdata_t.allSpots = int16(allSpots);
+        sdata_t.jobFinished.SpotFinding = [1 opts.spotfinding_method];
+    else
+        sdata_t = sdata_t.SpotFinding('Method', opts.spotfinding_method, 'ref_index', opts.ref_round, 'intensityThreshold', opts.intensity_threshold, 'showPlots', false);
+    end
+    sdata_t = sdata_t.ReadsExtraction('voxelSize', opts.voxel_size);
+    good_points_file = fullfile(interm_output_dir, strcat('goodPoints_', opts.spotfinding_method, '_t',num2str(opts.subtile),'_',num2str(opts.n_subtiles),'.csv'));
+    if strcmp(opts.decoding_backend, "python")
+        PythonDecodeReads(sdata_t, opts, start_coords_x, start_coords_y, interm_output_dir, good_points_file);
+        return
+    end
+    if strcmp(opts.barcode_mode, "duo")
+        sdata_t = sdata_t.LoadCodebook('remove_index', opts.split_loc);
+        sdata_t = sdata_t.ReadsFiltration('mode', "duo", 'endBases', opts.end_bases, 'split_loc', opts.split_loc, 'showPlots', false);
+    elseif strcmp(opts.barcode_mode, "regular")
+        sdata_t = sdata_t.LoadCodebook();
+        sdata_t = sdata_t.ReadsFiltration('mode', "regular", 'endBases', opts.end_bases, 'showPlots', false);
+    elseif strcmp(opts.barcode_mode, "tri")
+        sdata_t = sdata_t.LoadCodebook('remove_index', opts.split_loc);
+        sdata_t = sdata_t.ReadsFiltration('mode', "tri", 'endBases', opts.end_bases, 'split_loc', opts.split_loc, 'showPlots', false);
+    else
+        fprintf(sdata_t.log, "Reads filtration incomplete: invalid mode entered (valid options include 'regular', 'duo', and 'tri'");
+    end
+    
+    %%% save results
+    if size(sdata_t.goodSpots,1) > 0
+        sdata_t.goodSpots(:,1) = sdata_t.goodSpots(:,1) + start_coords_x - 1;
+        sdata_t.goodSpots(:,2) = sdata_t.goodSpots(:,2) + start_coords_y - 1;
+        goodSpots_t = [table(sdata_t.goodSpots(:,1),sdata_t.goodSpots(:,2),sdata_t.goodSpots(:,3),'VariableNames',{'x','y','z'}),cell2table(cellfun(@(x) sdata_t.seqToGene(x), sdata_t.goodReads, 'UniformOutput', false),'VariableNames',{'Gene'})];
+    else
+        goodSpots_t = table([],[],[],[],'VariableNames',{'x','y','z','Gene'});
+    end
+
+    writetable(goodSpots_t,good_points_file,'Delimiter',',','QuoteStrings',false);
+
+
+% Codebook lookup and filtration with auto_script/barcode_decoding.py: the spots and color
+% sequences (allSpots, basecsMat) go to reads_{method}_t{subtile}_{total_subtiles}.csv, Python
+% decodes all reads at once (same genes as LoadCodebook + ReadsFiltration + seqToGene) and
+% writes goodPoints in full-tile coordinates
+function PythonDecodeReads(sdata_t, opts, start_coords_x, start_coords_y, interm_output_dir, good_points_file)
+    reads_file = fullfile(interm_output_dir, strcat('reads_', opts.spotfinding_method, '_t', num2str(opts.subtile), '_', num2str(opts.n_subtiles), '.csv'));
+    writematrix([double(sdata_t.allSpots), double(sdata_t.basecsMat)], reads_file);
+    if strcmp(opts.barcode_mode, "regular")
+        split_loc = '';
+    else
+        split_loc = num2str(opts.split_loc);
+    end
+    cmd = sprintf('python "%s" --reads "%s" --codebook "%s" --mode %s --end-bases %s --split-loc %s --offset %d %d --output "%s"', ...
+        opts.decoding_script, reads_file, fullfile(sdata_t.inputPath, 'genes.csv'), opts.barcode_mode, ...
+        string(opts.end_bases), split_loc, start_coords_x - 1, start_coords_y - 1, good_points_file);
+    status = system(cmd);
+    delete(reads_file);
+    if status ~= 0
+        error("barcode_decoding.py failed with exit status %d", status);
+    end
 
 
+% Global registration with auto_script/global_registration.py: the channel max of each preprocessed
+% round goes to interm/global_registration_input.zarr, Python writes the integer shifts (same as
+% DFTRegister3D) to interm/global_shifts.csv, and they are applied here with ApplyIntegerShift
+function sdata = PythonGlobalRegistration(sdata, opts, interm_output_dir)
+    input_store = fullfile(interm_output_dir, 'global_registration_input.zarr');
+    shifts_file = fullfile(interm_output_dir, 'global_shifts.csv');
+    WriteZarrVolume(input_store, max(sdata.rawImages, [], 4), opts.tile_size);
+    cmd = sprintf('python "%s" --input "%s" --output "%s" --ref-round %d --coarse-factor %d --refine-window %d', ...
+        opts.registration_script, input_store, shifts_file, opts.ref_round, opts.coarse_factor, opts.refine_window);
+    status = system(cmd);
+    rmdir(input_store, 's');
+    if status ~= 0
+        error("global_registration.py failed with exit status %d", status);
+    end
+
+    shifts = readmatrix(shifts_file);  % round, row_shift, col_shift, z_shift
+    sdata.registeredImages = uint8(sdata.rawImages);
+    for k = 1:size(shifts, 1)
+        r = shifts(k, 1);
+        if r ~= opts.ref_round
+            sdata.registeredImages(:,:,:,:,r) = ApplyIntegerShift(sdata.rawImages(:,:,:,:,r), shifts(k, 2:4));
+            fprintf('Round %d vs. Round %d shifted by %s\n', r, opts.ref_round, num2str(shifts(k, 2:4)));
+            fprintf(sdata.log, 'Round %d vs. Round %d shifted by %s\n', r, opts.ref_round, num2str(shifts(k, 2:4)));
+        end
+    end
+    sdata.rawImages = [];
+    sdata.jobFinished.test_GlobalRegistration = 1;
+
+
+% Same as DFTApply3D for an integer shift, applied to all channels at once: circular shift,
+% then the wrapped rows/columns/slices are zeroed with the same index ranges as DFTApply3D
+function vol = ApplyIntegerShift(vol, shifts)
+    vol = circshift(vol, shifts);
+    for d = 1:3
+        n = size(vol, d);
+        if shifts(d) > 0
+            wrapped = 1:shifts(d);
+        else
+            wrapped = n + shifts(d):n;
+        end
+        idx = repmat({':'}, 1, ndims(vol));
+        idx{d} = wrapped;
+        vol(idx{:}) = 0;
+    end
+
+
+% Write the empty marker localRegistered_t{subtile}_{total_subtiles}.done after the locally registered .mat.
+% Global registration writes registeredImages_t*.mat under the same names, so only the marker tells --resume that step 02 ran.
+function WriteLocalRegistrationMarker(interm_output_dir, subtile, n_subtiles)
+    fid = fopen(fullfile(interm_output_dir, strcat('localRegistered_t', num2str(subtile), '_', num2str(n_subtiles), '.done')), 'w');
+    fclose(fid);
+end
+
+
+% Write a 5-D volume [y, x, z, channel, round] as an uncompressed zarr v2 array in Fortran order,
+% chunks of chunk_yx(1) x chunk_yx(end) x z x 1 x 1 (edge chunks padded; a scalar gives square chunks).
+% .zarray is written last, so an existing .zarray marks a complete store. Readable with auto_script/volume_store.py.
+function WriteZarrVolume(store_path, vol, chunk_yx)
+    dtypes = struct('uint8', '|u1', 'uint16', '<u2', 'single', '<f4', 'double', '<f8');
+    dims = size(vol, 1:5);
+    chunks = [chunk_yx(1), chunk_yx(end), dims(3), 1, 1];
+    n_chunks = ceil(dims ./ chunks);
+    if exist(store_path, 'dir')
+        rmdir(store_path, 's');
+    end
+    mkdir(store_path);
+    for ir = 1:n_chunks(5)
+        for ic = 1:n_chunks(4)
+            for ix = 1:n_chunks(2)
+                for iy = 1:n_chunks(1)
+                    ys = (iy-1)*chunks(1) + 1;
+                    ye = min(iy*chunks(1), dims(1));
+                    xs = (ix-1)*chunks(2) + 1;
+                    xe = min(ix*chunks(2), dims(2));
+                    block = zeros(chunks(1:3), 'like', vol);
+                    block(1:ye-ys+1, 1:xe-xs+1, :) = vol(ys:ye, xs:xe, :, ic, ir);
+                    fid = fopen(fullfile(store_path, sprintf('%d.%d.0.%d.%d', iy-1, ix-1, ic-1, ir-1)), 'w', 'l');
+                    fwrite(fid, block, class(vol));
+                    fclose(fid);
+                end
+            end
+        end
+    end
+    meta = sprintf('{"zarr_format": 2, "shape": [%s], "chunks": [%s], "dtype": "%s", "compressor": null, "fill_value": 0, "order": "F", "filters": null}', ...
+                   strjoin(string(dims), ', '), strjoin(string(chunks), ', '), dtypes.(class(vol)));
+    fid = fopen(fullfile(store_path, '.zarray'), 'w');
+    fprintf(fid, '%s', meta);
+    fclose(fid);
+
+
+% Read rows ys:ye and columns xs:xe (1-based, inclusive) of all z/channels/rounds
+% from a store written by WriteZarrVolume; only the chunks overlapping the window are read.
+function vol = ReadZarrWindow(store_path, ys, ye, xs, xe)
+    classes = struct('u1', 'uint8', 'u2', 'uint16', 'f4', 'single', 'f8', 'double');
+    meta = jsondecode(fileread(fullfile(store_path, '.zarray')));
+    dims = reshape(meta.shape, 1, []);
+    chunks = reshape(meta.chunks, 1, []);
+    precision = classes.(meta.dtype(2:end));
+    if nargin < 2
+        ys = 1; ye = dims(1); xs = 1; xe = dims(2);
+    end
+    vol = zeros([ye-ys+1, xe-xs+1, dims(3:5)], precision);
+    for ir = 1:dims(5)
+        for ic = 1:dims(4)
+            for ix = floor((xs-1)/chunks(2))+1:floor((xe-1)/chunks(2))+1
+                for iy = floor((ys-1)/chunks(1))+1:floor((ye-1)/chunks(1))+1
+                    fid = fopen(fullfile(store_path, sprintf('%d.%d.0.%d.%d', iy-1, ix-1, ic-1, ir-1)), 'r', 'l');
+                    block = reshape(fread(fid, prod(chunks), ['*' precision]), chunks(1:3));
+                    fclose(fid);
+                    cy = (iy-1)*chunks(1);
+                    cx = (ix-1)*chunks(2);
+                    rows = max(ys, cy+1):min(ye, cy+chunks(1));
+                    cols = max(xs, cx+1):min(xe, cx+chunks(2));
+                    vol(rows-ys+1, cols-xs+1, :, ic, ir) = block(rows-cy, cols-cx, :);
+                end
+            end
+        end
+    end
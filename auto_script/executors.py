@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+"""作业执行后端
+
+编排器通过执行后端提交脚本、查询状态、取消、释放 --hold 作业和修改依赖/并发上限，
+三种实现接口相同：
+
+    slurm - 调用 sbatch/sacct/squeue/scancel/scontrol（参数以列表传入，不经过 shell）
+    local - 在本机用有限的 CPU 名额并发运行生成脚本的数组任务，自行设置 SLURM_ARRAY_TASK_ID、
+            OFFSET 等环境变量，按 afterok/aftercorr/afterany 依赖和 %并发上限 调度，
+            超过 --time 的任务以 TIMEOUT 结束（不限制内存）
+    fake  - 不运行脚本，按依赖顺序把任务直接标记为结束，可指定部分任务失败，用于离线检查编排逻辑
+
+状态统一为 {作业ID: {任务号: (状态, 退出码)}}，非数组作业的任务号为 None；
+accounting() 按 sacct -n -P 的格式返回记账记录，供运行报告和资源历史使用。
+"""
+import os
+import shlex
+import signal
+import subprocess
+import time
+from datetime import datetime
+from pathlib import Path
+
+from retry import parse_time
+from slurm_monitor import FAILURE_STATES, TERMINAL_STATES, normalize_state, split_job_id
+
+EXECUTORS = ('slurm', 'local', 'fake')
+
+
+def dependency_args(deps, kill_on_invalid_dep=True):
+    """生成 sbatch 依赖参数，deps 为 [(依赖类型, 作业ID)]
+
+    afterok 依赖整个作业（或 jobid_taskid 指定的单个数组任务）成功结束；
+    aftercorr 使数组中每个任务只依赖上游作业中相同编号的任务。
+    默认上游失败时由 Slurm 自动取消本作业；启用重试时由编排器自行处理。
+    """
+    if not deps:
+        return []
+    args = [f"--dependency={','.join(f'{dep_type}:{dep_id}' for dep_type, dep_id in deps)}"]
+    if kill_on_invalid_dep:
+        args.append('--kill-on-invalid-dep=yes')
+    return args
+
+
+class SlurmExecutor:
+    """通过 Slurm 命令行提交和查询作业"""
+
+    name = 'slurm'
+    poll_intervals = (15, 300)
+
+    def __init__(self):
+        self.use_sacct = True
+
+    def submit(self, script, array=None, env=None, deps=(), resources=None, hold=False, kill_on_invalid_dep=True):
+        """提交作业，返回作业ID（失败返回None）"""
+        args = ['sbatch']
+        if hold:
+            args.append('--hold')
+        if array is not None:
+            args.append(f'--array={array}')
+        args += [f'--{key}={value}' for key, value in (resources or {}).items()]
+        args += dependency_args(deps, kill_on_invalid_dep)
+        args.append('--export=ALL' + ''.join(f',{key}={value}' for key, value in (env or {}).items()))
+        args.append(str(script))
+        try:
+            result = subprocess.run(args, capture_output=True, text=True)
+        except OSError as e:
+            print(f"错误：无法运行 sbatch：{e}")
+            return None
+        if result.returncode != 0:
+            print(f"错误：提交失败\n{result.stderr}")
+            return None
+        return result.stdout.strip().split()[-1]
+
+    def _query_sacct(self, job_ids):
+        """一次 sacct 查询所有作业，失败返回 None"""
+        lines = self.accounting(job_ids, ['JobID', 'State', 'ExitCode'], allocations_only=True)
+        if lines is None:
+            return None
+        states = {}
+        for fields in lines:
+            job_id, task = split_job_id(fields[0])
+            states.setdefault(job_id, {})[task] = (normalize_state(fields[1]), fields[2])
+        return states
+
+    def _query_squeue(self, job_ids):
+        """sacct 不可用时的退路：离开队列即视为结束（无法区分成功失败）
+
+        squeue 失败时返回 {}（没有信息），不把作业当作已结束；只有一个作业且已被清出
+        控制器时 squeue 报 Invalid job id，这时视为已离开队列。
+        """
+        try:
+            result = subprocess.run(['squeue', '-h', '-j', ','.join(job_ids), '-o', '%i|%T'],
+                                    capture_output=True, text=True)
+        except OSError:
+            return {}
+        if result.returncode != 0 and 'Invalid job id' not in result.stderr:
+            return {}
+        queued = {}
+        for line in result.stdout.splitlines():
+            fields = line.split('|')
+            if len(fields) < 2:
+                continue
+            job_id, task = split_job_id(fields[0])
+            queued.setdefault(job_id, {})[task] = (normalize_state(fields[1]), '')
+        return {job_id: queued.get(job_id, {None: ('COMPLETED', 'unknown')}) for job_id in job_ids}
+
+    def query(self, job_ids):
+        """返回 {作业ID: {任务号: (状态, 退出码)}}，刚提交、尚未进入记账数据库的作业可能缺失"""
+        states = self._query_sacct(job_ids) if self.use_sacct else None
+        if states is None:
+            if self.use_sacct:
+                print("警告：sacct 不可用，改用 squeue 监控（无法识别失败的作业）")
+                self.use_sacct = False
+            states = self._query_squeue(job_ids)
+        return states
+
+    def accounting(self, job_ids, fields, allocations_only=False):
+        """sacct -n -P 查询，返回每行的字段列表（含 .batch 等作业步），失败返回 None"""
+        args = ['sacct', '-n', '-P', '-j', ','.join(job_ids), f"--format={','.join(fields)}"]
+        if allocations_only:
+            args.insert(2, '-X')
+        try:
+            result = subprocess.run(args, capture_output=True, text=True)
+        except OSError:
+            return None
+        if result.returncode != 0:
+            return None
+        return [line.split('|') for line in result.stdout.splitlines() if len(line.split('|')) >= len(fields)]
+
+    def cancel(self, job_ids):
+        subprocess.run(['scancel'] + list(job_ids), capture_output=True, text=True)
+
+    def release(self, job_ids):
+        subprocess.run(['scontrol', 'release', ','.join(job_ids)], capture_output=True, text=True)
+
+    def update_dependency(self, job_id, deps):
+        """改写作业的依赖，返回是否成功"""
+        dependency = ','.join(f"{dep_type}:{dep_id}" for dep_type, dep_id in deps)
+        result = subprocess.run(['scontrol', 'update', f'JobId={job_id}', f'Dependency={dependency}'],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f"警告：无法更新作业 {job_id} 的依赖：{result.stderr.strip()}")
+            return False
+        return True
+
+    def set_throttle(self, job_id, throttle):
+        """修改数组作业的并发上限，返回是否成功"""
+        result = subprocess.run(['scontrol', 'update', f'JobId={job_id}', f'ArrayTaskThrottle={throttle}'],
+                                capture_output=True, text=True)
+        return result.returncode == 0
+
+
+def parse_array_spec(spec):
+    """'1-3,7%2' -> ([1, 2, 3, 7], 2)，无并发上限时为 0"""
+    spec, _, throttle = spec.partition('%')
+    indices = []
+    for part in spec.split(','):
+        if '-' in part:
+            first, last = part.split('-', 1)
+            indices.extend(range(int(first), int(last) + 1))
+        elif part:
+            indices.append(int(part))
+    return indices, int(throttle) if throttle else 0
+
+
+def read_sbatch_header(script):
+    """读取脚本的 #SBATCH 选项，返回 {选项名: 值}，短选项转为长选项名"""
+    aliases = {'o': 'output', 'e': 'error', 'J': 'job-name', 'p': 'partition', 'c': 'cpus-per-task',
+               't': 'time', 'a': 'array'}
+    options = {}
+    with open(script, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if not line.startswith('#SBATCH'):
+                continue
+            words = shlex.split(line[len('#SBATCH'):], comments=True)
+            while words:
+                word = words.pop(0)
+                if word.startswith('--'):
+                    key, _, value = word[2:].partition('=')
+                    if not value and words and not words[0].startswith('-'):
+                        value = words.pop(0)
+                elif word.startswith('-') and len(word) > 1:
+                    key, value = aliases.get(word[1], word[1]), word[2:]
+                    if not value and words and not words[0].startswith('-'):
+                        value = words.pop(0)
+                else:
+                    continue
+                options[key] = value
+    return options
+
+
+def format_timestamp(value):
+    return datetime.fromtimestamp(value).strftime('%Y-%m-%dT%H:%M:%S') if value else 'Unknown'
+
+
+def format_duration(seconds):
+    """秒 -> sacct 格式 'HH:MM:SS'（超过一天为 'D-HH:MM:SS'）"""
+    days, seconds = divmod(int(round(seconds)), 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    text = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+    return f"{days}-{text}" if days else text
+
+
+class LocalExecutor:
+    """在本机运行生成的脚本
+
+    每个数组任务以 bash 单独运行（独立的进程组，取消时整组结束），同时运行的任务占用的
+    CPU（脚本的 -c）之和不超过 max_cpus。每次 query() 时回收结束的进程并启动依赖已满足的任务，
+    因此由 JobMonitor 的轮询驱动，不需要后台线程。
+    """
+
+    name = 'local'
+    poll_intervals = (1, 5)
+
+    def __init__(self, max_cpus=None):
+        self.max_cpus = max_cpus or len(os.sched_getaffinity(0))
+        self.jobs = {}
+        self.running = {}  # pid -> (作业ID, 任务号, Popen)
+        self.used_cpus = 0
+        self.next_id = 1
+
+    def submit(self, script, array=None, env=None, deps=(), resources=None, hold=False, kill_on_invalid_dep=True):
+        try:
+            header = read_sbatch_header(script)
+        except OSError as e:
+            print(f"错误：无法读取脚本 {script}：{e}")
+            return None
+        header.update(resources or {})
+        array = array if array is not None else header.get('array')
+        if array:
+            indices, throttle = parse_array_spec(array)
+            task_ids = [str(index) for index in indices]
+        else:
+            task_ids, throttle = [None], 0
+        job_id = str(self.next_id)
+        self.next_id += 1
+        now = time.time()
+        self.jobs[job_id] = {
+            'script': str(script), 'header': header, 'env': dict(env or {}), 'deps': list(deps),
+            'hold': hold, 'throttle': throttle, 'kill_on_invalid_dep': kill_on_invalid_dep,
+            'cpus': min(self.max_cpus, int(header.get('cpus-per-task') or 1)),
+            'time_limit': parse_time(header['time']) * 60 if header.get('time') else None,
+            'tasks': {task: {'state': 'PENDING', 'exit_code': '0:0', 'submit': now, 'eligible': None,
+                             'start': None, 'end': None, 'max_rss_kb': 0, 'cpu_s': 0.0, 'cancelled': False,
+                             'timed_out': False}
+                      for task in task_ids},
+        }
+        self._schedule()
+        return job_id
+
+    def _task_states(self, dep_type, dep_id, task):
+        """依赖涉及的上游任务状态列表，上游作业未知时返回 None"""
+        upstream, upstream_task = split_job_id(dep_id)
+        job = self.jobs.get(upstream)
+        if job is None:
+            return None
+        if upstream_task is not None:
+            tasks = [job['tasks'][upstream_task]] if upstream_task in job['tasks'] else []
+        elif dep_type == 'aftercorr':
+            tasks = [job['tasks'][task]] if task in job['tasks'] else []
+        else:
+            tasks = list(job['tasks'].values())
+        return [t['state'] for t in tasks]
+
+    def _dependency(self, job, task):
+        """'ok'（可以运行）、'wait' 或 'never'（上游已失败，永远无法满足）"""
+        result = 'ok'
+        for dep_type, dep_id in job['deps']:
+            states = self._task_states(dep_type, dep_id, task)
+            if states is None:
+                continue
+            if dep_type == 'afterany':
+                if not all(state in TERMINAL_STATES for state in states):
+                    result = 'wait'
+            elif any(state in FAILURE_STATES for state in states):
+                return 'never'
+            elif not all(state == 'COMPLETED' for state in states):
+                result = 'wait'
+        return result
+
+    def _schedule(self):
+        """按提交顺序启动依赖已满足的任务，CPU 名额不足时停止"""
+        now = time.time()
+        for job_id, job in self.jobs.items():
+            if job['hold']:
+                continue
+            running = sum(1 for t in job['tasks'].values() if t['state'] == 'RUNNING')
+            for task, info in job['tasks'].items():
+                if info['state'] != 'PENDING':
+                    continue
+                dependency = self._dependency(job, task)
+                if dependency == 'never':
+                    if job['kill_on_invalid_dep']:
+                        info.update(state='CANCELLED', end=now)
+                    continue
+                if dependency == 'wait':
+                    continue
+                if info['eligible'] is None:
+                    info['eligible'] = now
+                if job['throttle'] and running >= job['throttle']:
+                    break
+                if self.used_cpus and self.used_cpus + job['cpus'] > self.max_cpus:
+                    return
+                self._launch(job_id, job, task)
+                running += 1
+
+    def _log_path(self, job_id, job, task, key, default):
+        pattern = job['header'].get(key, default)
+        for placeholder, value in (('%A', job_id), ('%a', task or '0'), ('%j', job_id),
+                                   ('%x', job['header'].get('job-name', '')), ('%%', '%')):
+            pattern = pattern.replace(placeholder, value)
+        path = Path(pattern)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def _launch(self, job_id, job, task):
+        env = dict(os.environ)
+        env.update({key: str(value) for key, value in job['env'].items()})
+        env.update({'SLURM_JOB_ID': job_id, 'SLURM_CPUS_PER_TASK': str(job['cpus']),
+                    'SLURM_JOB_NAME': job['header'].get('job-name', Path(job['script']).name)})
+        if task is not None:
+            env.update({'SLURM_ARRAY_JOB_ID': job_id, 'SLURM_ARRAY_TASK_ID': task})
+        default_log = f"slurm-{job_id}_{task}.out" if task is not None else f"slurm-{job_id}.out"
+        stdout_path = self._log_path(job_id, job, task, 'output', default_log)
+        stderr_path = self._log_path(job_id, job, task, 'error', str(stdout_path))
+        with open(stdout_path, 'a') as stdout, open(stderr_path, 'a') as stderr:
+            process = subprocess.Popen(['bash', job['script']], env=env, stdout=stdout,
+                                       stderr=subprocess.STDOUT if stderr_path == stdout_path else stderr,
+                                       stdin=subprocess.DEVNULL, start_new_session=True)
+        self.running[process.pid] = (job_id, task, process)
+        self.used_cpus += job['cpus']
+        job['tasks'][task].update(state='RUNNING', start=time.time())
+
+    def _kill(self, pid):
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def _reap(self):
+        """回收已结束的进程，记录退出码、MaxRSS 和 CPU 时间；结束超时的任务"""
+        now = time.time()
+        for pid, (job_id, task, process) in list(self.running.items()):
+            job = self.jobs[job_id]
+            info = job['tasks'][task]
+            if job['time_limit'] and not info['timed_out'] and now - info['start'] > job['time_limit']:
+                info['timed_out'] = True
+                self._kill(pid)
+            finished, status, usage = os.wait4(pid, os.WNOHANG)
+            if finished == 0:
+                continue
+            if os.WIFSIGNALED(status):
+                exit_code = f"0:{os.WTERMSIG(status)}"
+                process.returncode = -os.WTERMSIG(status)
+            else:
+                exit_code = f"{os.WEXITSTATUS(status)}:0"
+                process.returncode = os.WEXITSTATUS(status)
+            if info['timed_out']:
+                state = 'TIMEOUT'
+            elif info['cancelled']:
+                state = 'CANCELLED'
+            else:
+                state = 'COMPLETED' if process.returncode == 0 else 'FAILED'
+            info.update(state=state, exit_code=exit_code, end=time.time(), max_rss_kb=usage.ru_maxrss,
+                        cpu_s=usage.ru_utime + usage.ru_stime)
+            del self.running[pid]
+            self.used_cpus -= job['cpus']
+
+    def query(self, job_ids):
+        self._reap()
+        self._schedule()
+        return {job_id: {task: (info['state'], info['exit_code']) for task, info in self.jobs[job_id]['tasks'].items()}
+                for job_id in job_ids if job_id in self.jobs}
+
+    def accounting(self, job_ids, fields, allocations_only=False):
+        """按 sacct 的字段和格式返回记账记录：每个任务一行，已运行的任务另有一行 .batch 作业步"""
+        lines = []
+        for job_id in job_ids:
+            job = self.jobs.get(job_id)
+            if job is None:
+                continue
+            for task, info in job['tasks'].items():
+                name = job_id if task is None else f"{job_id}_{task}"
+                elapsed = (info['end'] or time.time()) - info['start'] if info['start'] else 0
+                record = {'JobID': name, 'State': info['state'], 'ExitCode': info['exit_code'],
+                          'Submit': format_timestamp(info['submit']), 'Eligible': format_timestamp(info['eligible']),
+                          'Start': format_timestamp(info['start']), 'End': format_timestamp(info['end']),
+                          'Elapsed': format_duration(elapsed), 'MaxRSS': '', 'TotalCPU': format_duration(info['cpu_s']),
+                          'AllocCPUS': str(job['cpus'])}
+                lines.append([record.get(field, '') for field in fields])
+                if info['start'] and not allocations_only:
+                    record.update(JobID=f"{name}.batch", MaxRSS=f"{info['max_rss_kb']}K")
+                    lines.append([record.get(field, '') for field in fields])
+        return lines
+
+    def cancel(self, job_ids):
+        now = time.time()
+        for job_id in job_ids:
+            for task, info in self.jobs.get(job_id, {'tasks': {}})['tasks'].items():
+                if info['state'] == 'PENDING':
+                    info.update(state='CANCELLED', end=now)
+                elif info['state'] == 'RUNNING':
+                    info['cancelled'] = True
+        for pid, (job_id, _, _) in list(self.running.items()):
+            if job_id in job_ids:
+                self._kill(pid)
+
+    def release(self, job_ids):
+        for job_id in job_ids:
+            if job_id in self.jobs:
+                self.jobs[job_id]['hold'] = False
+        self._schedule()
+
+    def update_dependency(self, job_id, deps):
+        if job_id not in self.jobs:
+            print(f"警告：无法更新作业 {job_id} 的依赖：作业不存在")
+            return False
+        self.jobs[job_id]['deps'] = list(deps)
+        return True
+
+    def set_throttle(self, job_id, throttle):
+        if job_id not in self.jobs:
+            return False
+        self.jobs[job_id]['throttle'] = throttle
+        return True
+
+
+class FakeExecutor(LocalExecutor):
+    """不运行脚本：依赖满足的任务立即结束，用于离线检查依赖图、续跑、重试和报告
+
+    failures 为 {(脚本名, 任务号): 状态}，如 {('03_spot_finding_batch1.sh', '2'): 'OUT_OF_MEMORY'}，
+    非数组作业的任务号为 None；每项只对第一次运行生效，重试提交的作业会成功。
+    submitted 按顺序记录每次提交的参数。
+    """
+
+    name = 'fake'
+    poll_intervals = (0, 0)
+
+    def __init__(self, failures=None):
+        super().__init__(max_cpus=1)
+        self.failures = dict(failures or {})
+        self.submitted = []
+
+    def submit(self, script, array=None, env=None, deps=(), resources=None, hold=False, kill_on_invalid_dep=True):
+        job_id = super().submit(script, array, env, deps, resources, hold, kill_on_invalid_dep)
+        if job_id is not None:
+            self.submitted.append({'job_id': job_id, 'script': str(script), 'array': array, 'env': dict(env or {}),
+                                   'deps': list(deps), 'resources': dict(resources or {}), 'hold': hold})
+        return job_id
+
+    def _launch(self, job_id, job, task):
+        now = time.time()
+        state = self.failures.pop((Path(job['script']).name, task), 'COMPLETED')
+        job['tasks'][task].update(state=state, exit_code='0:0' if state == 'COMPLETED' else '1:0',
+                                  start=now, end=now)
+
+
+def make_executor(config, name=None):
+    """按命令行参数或 [EXECUTOR] backend 创建执行后端"""
+    name = (name or config.get('EXECUTOR', 'backend', fallback='slurm')).strip()
+    if name == 'slurm':
+        return SlurmExecutor()
+    if name == 'local':
+        max_cpus = config.get('EXECUTOR', 'local_cpus', fallback='').strip()
+        return LocalExecutor(int(max_cpus) if max_cpus else None)
+    if name == 'fake':
+        return FakeExecutor()
+    raise ValueError(f"未知的执行后端：{name}（可选 {', '.join(EXECUTORS)}）")
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""IF 拼接的分块融合（Python 实现），输出多尺度 OME-Zarr
+
+Fiji 的 Grid/Collection stitching（image_output=[Fuse and display]）把整张切片的三维融合结果放在
+一个 JVM 堆里，再 saveAs TIFF、Z Project。fusion_backend = python 时，按 TileConfiguration.registered.txt
+中的位置逐块融合：
+
+1. 输出按 xy 方向 chunk × chunk（全部 z）分块，各块在线程池中并行计算，
+   每块只读取与之相交的各位置的窗口（未压缩的 TIFF 用内存映射），内存只与块大小和线程数有关；
+2. 重叠区域按 Fiji Linear Blending 的权重加权平均：每个轴上到边缘的距离在图像尺寸的 20% 内线性渐变，
+   各轴相乘后做余弦平滑；
+3. 融合的同时对每块做 z 方向最大投影，写到 <蛋白>big2dnew.tif（与 Fiji 的 MIP 相同的文件）
+   和二维的 OME-Zarr；
+4. 三维结果写到 <蛋白>big3dnew.ome.zarr，第 0 层为全分辨率，之后每层 xy 方向 2×2 平均降采样。
+
+--projection-first 时先对每个位置做 z 方向最大投影，再融合二维图像，只写出 MIP，不生成三维结果，
+读取量和内存都约为原来的 1/z。重叠区域是各位置投影的加权平均，与先融合再投影略有不同。
+
+位置坐标的取整与 stitch_points.py 相同（向零取整，再平移使最小值为 1），因此点拼接的坐标与融合图一致。
+"""
+import argparse
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import tifffile
+import zarr
+
+from stitch_points import parse_tile_configuration
+
+# Fiji BlendingPixelFusion 的渐变宽度（占图像尺寸的比例）
+BLEND_FRACTION = 0.2
+Z_CHUNK = 8
+
+
+class Tile:
+    """一个位置的图像：offset 为在融合图中的 (z, y, x) 起点（0 起始），shape 为 (z, y, x)
+
+    project=True 时按 z 方向最大投影后的 (1, y, x) 图像参与融合。
+    """
+
+    def __init__(self, path, offset, project=False):
+        self.path = Path(path)
+        self.project = project
+        with tifffile.TiffFile(self.path) as tif:
+            shape = tif.series[0].shape
+            self.dtype = tif.series[0].dtype
+        if len(shape) == 2:
+            shape = (1,) + tuple(shape)
+        if len(shape) != 3:
+            raise ValueError(f"{self.path} 的维度 {shape} 不是 (z, y, x)")
+        self.stack_shape = tuple(shape)
+        self.shape = (1,) + self.stack_shape[1:] if project else self.stack_shape
+        self.offset = (0,) + tuple(int(v) for v in offset[1:]) if project else tuple(int(v) for v in offset)
+        self.profiles = [blend_profile(n) for n in self.shape]
+        self._memmap = None
+
+    def intersect(self, box):
+        """box 为融合图中的 [(起, 止)] * 3，返回 (融合图切片, 位置内切片)，不相交时返回 None"""
+        out_slices, local_slices = [], []
+        for (start, stop), offset, n in zip(box, self.offset, self.shape):
+            lo, hi = max(start, offset), min(stop, offset + n)
+            if lo >= hi:
+                return None
+            out_slices.append(slice(lo - start, hi - start))
+            local_slices.append(slice(lo - offset, hi - offset))
+        return tuple(out_slices), tuple(local_slices)
+
+    def read(self, local_slices):
+        if self.project:
+            # 投影后只有一层 z，读取整个 z 方向再取最大值
+            return self.read_stack((slice(None),) + local_slices[1:]).max(axis=0, keepdims=True)
+        return self.read_stack(local_slices)
+
+    def read_stack(self, local_slices):
+        if self._memmap is None:
+            try:
+                self._memmap = tifffile.memmap(self.path, mode='r').reshape(self.stack_shape)
+            except ValueError:
+                # 压缩或不连续存储的 TIFF 不能内存映射，每次整幅读取（不缓存，避免占用整张切片的内存）
+                return tifffile.imread(self.path).reshape(self.stack_shape)[local_slices]
+        return np.asarray(self._memmap[local_slices])
+
+    def weights(self, local_slices):
+        """Linear Blending 权重"""
+        z, y, x = (profile[s] for profile, s in zip(self.profiles, local_slices))
+        product = z[:, None, None] * y[None, :, None] * x[None, None, :]
+        return np.where(product >= 1, 1, (np.cos((1 - product) * np.pi) + 1) / 2).astype(np.float32)
+
+
+def blend_profile(n):
+    """一个轴上的渐变：到较近边缘的距离 + 1，在 n * BLEND_FRACTION 内线性归一化，其余为 1"""
+    position = np.arange(n)
+    distance = np.maximum(1, np.minimum(position, n - 1 - position) + 1).astype(np.float64)
+    size = BLEND_FRACTION * n
+    return np.where(distance < size, distance / size, 1.0)
+
+
+def read_tiles(tile_config, tile_dir, project=False):
+    """按 TileConfiguration 读取各位置（PositionXXX.tif）的偏移和尺寸"""
+    return [Tile(Path(tile_dir) / f"Position{tile:03d}.tif", (z - 1, y - 1, x - 1), project)
+            for tile, x, y, z in parse_tile_configuration(tile_config)]
+
+
+def fused_shape(tiles):
+    return tuple(int(max(t.offset[d] + t.shape[d] for t in tiles)) for d in range(3))
+
+
+def cast_like(values, dtype):
+    """四舍五入并截断到 dtype 的范围"""
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return np.clip(np.floor(values + 0.5), info.min, info.max).astype(dtype)
+    return values.astype(dtype)
+
+
+def fuse_block(tiles, box, dtype):
+    """融合 box 内的体积，返回 (z, y, x) 数组"""
+    shape = tuple(stop - start for start, stop in box)
+    total = np.zeros(shape, dtype=np.float32)
+    weight_sum = np.zeros(shape, dtype=np.float32)
+    for tile in tiles:
+        overlap = tile.intersect(box)
+        if overlap is None:
+            continue
+        out_slices, local_slices = overlap
+        weights = tile.weights(local_slices)
+        total[out_slices] += weights * tile.read(local_slices)
+        weight_sum[out_slices] += weights
+    fused = np.divide(total, weight_sum, out=np.zeros_like(total), where=weight_sum > 0)
+    return cast_like(fused, dtype)
+
+
+def block_boxes(shape, chunk):
+    """xy 方向 chunk × chunk 的块（全部 z）"""
+    nz, ny, nx = shape
+    return [[(0, nz), (y, min(y + chunk, ny)), (x, min(x + chunk, nx))]
+            for y in range(0, ny, chunk) for x in range(0, nx, chunk)]
+
+
+def downsample_xy(block, dtype):
+    """最后两个轴 2×2 平均，奇数边缘复制最后一行/列"""
+    pad = [(0, 0)] * (block.ndim - 2) + [(0, block.shape[-2] % 2), (0, block.shape[-1] % 2)]
+    block = np.pad(block, pad, mode='edge').astype(np.float32)
+    shape = block.shape[:-2] + (block.shape[-2] // 2, 2, block.shape[-1] // 2, 2)
+    return cast_like(block.reshape(shape).mean(axis=(-3, -1)), dtype)
+
+
+def create_multiscale(path, shape, dtype, chunk, levels):
+    """创建 OME-Zarr 组及各层数组（每层 xy 减半），返回 (组, [数组])"""
+    group = zarr.open_group(str(path), mode='w')
+    chunks = ((min(shape[0], Z_CHUNK),) if len(shape) == 3 else ()) + (chunk, chunk)
+    arrays = [group.create_dataset(str(level), shape=tuple(shape[:-2]) + tuple(-(-n // 2 ** level) for n in shape[-2:]),
+                                   chunks=chunks, dtype=dtype, fill_value=0, dimension_separator='/')
+              for level in range(levels)]
+    return group, arrays
+
+
+def write_multiscales(group, name, axes, levels):
+    """写入 OME-NGFF 0.4 的 multiscales 元数据，最后写入"""
+    datasets = [{'path': str(level),
+                 'coordinateTransformations': [{'type': 'scale',
+                                                'scale': [1.0] * (len(axes) - 2) + [float(2 ** level)] * 2}]}
+                for level in range(levels)]
+    group.attrs['multiscales'] = [{
+        'version': '0.4',
+        'name': name,
+        'axes': [{'name': axis, 'type': 'space'} for axis in axes],
+        'datasets': datasets,
+        'metadata': {'method': 'fusion.downsample_xy', 'description': '2x2 mean in xy'},
+    }]
+
+
+def build_pyramid(arrays, chunk, executor):
+    """由上一层逐块生成下一层"""
+    for source, target in zip(arrays[:-1], arrays[1:]):
+        ny, nx = target.shape[-2:]
+
+        def downsample_chunk(origin, source=source, target=target):
+            y, x = origin
+            y1, x1 = min(y + chunk, ny), min(x + chunk, nx)
+            block = source[..., 2 * y:2 * y1, 2 * x:2 * x1]
+            target[..., y:y1, x:x1] = downsample_xy(block, target.dtype)[..., :y1 - y, :x1 - x]
+
+        list(executor.map(downsample_chunk, [(y, x) for y in range(0, ny, chunk) for x in range(0, nx, chunk)]))
+
+
+def replace_dir(tmp_path, path):
+    if path.exists():
+        shutil.rmtree(path) if path.is_dir() else path.unlink()
+    tmp_path.rename(path)
+
+
+def fuse(tile_config, tile_dir, output=None, mip_tiff=None, mip_output=None, chunk=1024, levels=4, workers=16,
+         name=None, projection_first=False):
+    """融合并写出三维 OME-Zarr（output）、二维 MIP（TIFF 和/或 OME-Zarr），返回融合图尺寸 (z, y, x)
+
+    projection_first=True 时先投影再融合，只写出 MIP，不能与 output 一起使用。
+    """
+    if projection_first and output:
+        raise ValueError("先投影再融合时没有三维结果，不能指定 output")
+    if not (output or mip_tiff or mip_output):
+        raise ValueError("没有指定任何输出")
+    tiles = read_tiles(tile_config, tile_dir, project=projection_first)
+    dtype = np.result_type(*[tile.dtype for tile in tiles])
+    shape = fused_shape(tiles)
+    name = name or Path(output or mip_output or mip_tiff).name.split('.')[0]
+
+    volume_group = volume_levels = tmp_output = None
+    if output:
+        output = Path(output)
+        tmp_output = output.with_name(output.name + '.tmp')
+        volume_group, volume_levels = create_multiscale(tmp_output, shape, dtype, chunk, levels)
+    mip_group = mip_levels = tmp_mip_output = None
+    if mip_output:
+        mip_output = Path(mip_output)
+        tmp_mip_output = mip_output.with_name(mip_output.name + '.tmp')
+        mip_group, mip_levels = create_multiscale(tmp_mip_output, shape[1:], dtype, chunk, levels)
+    mip_image = tmp_mip_tiff = None
+    if mip_tiff:
+        mip_tiff = Path(mip_tiff)
+        tmp_mip_tiff = mip_tiff.with_name(mip_tiff.name + '.tmp')
+        mip_image = tifffile.memmap(tmp_mip_tiff, shape=shape[1:], dtype=dtype)
+
+    def fuse_and_write(box):
+        block = fuse_block(tiles, box, dtype)
+        (_, _), (y0, y1), (x0, x1) = box
+        if volume_levels:
+            volume_levels[0][:, y0:y1, x0:x1] = block
+        projection = block.max(axis=0)
+        if mip_levels:
+            mip_levels[0][y0:y1, x0:x1] = projection
+        if mip_image is not None:
+            mip_image[y0:y1, x0:x1] = projection
+
+    boxes = block_boxes(shape, chunk)
+    print(f"融合 {len(tiles)} 个位置 -> {shape}，{len(boxes)} 个块，{workers} 个线程")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for done, _ in enumerate(executor.map(fuse_and_write, boxes), start=1):
+            if done % max(1, len(boxes) // 10) == 0:
+                print(f"  已融合 {done}/{len(boxes)} 块")
+        if volume_levels:
+            build_pyramid(volume_levels, chunk, executor)
+        if mip_levels:
+            build_pyramid(mip_levels, chunk, executor)
+
+    if volume_group is not None:
+        write_multiscales(volume_group, name, ['z', 'y', 'x'], levels)
+        replace_dir(tmp_output, output)
+    if mip_group is not None:
+        write_multiscales(mip_group, f"{name} MIP", ['y', 'x'], levels)
+        replace_dir(tmp_mip_output, mip_output)
+    if mip_image is not None:
+        mip_image.flush()
+        del mip_image
+        replace_dir(tmp_mip_tiff, mip_tiff)
+    return shape
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按 TileConfiguration.registered.txt 分块融合 IF 图像，输出多尺度 OME-Zarr")
+    parser.add_argument('--tile-config', required=True, help='TileConfiguration.registered.txt')
+    parser.add_argument('--tile-dir', required=True, help='PositionXXX.tif 所在目录')
+    parser.add_argument('--output', help='三维融合结果（.ome.zarr）')
+    parser.add_argument('--mip-tiff', help='z 方向最大投影的 TIFF（如 <蛋白>big2dnew.tif）')
+    parser.add_argument('--mip-output', help='z 方向最大投影的 OME-Zarr')
+    parser.add_argument('--chunk', type=int, default=1024, help='xy 方向的块大小（默认：1024）')
+    parser.add_argument('--levels', type=int, default=4, help='金字塔层数（默认：4）')
+    parser.add_argument('--workers', type=int, default=16, help='线程数（默认：16）')
+    parser.add_argument('--projection-first', action='store_true',
+                        help='先对每个位置做最大投影再融合二维图像，只写出 MIP')
+    args = parser.parse_args()
+
+    shape = fuse(args.tile_config, args.tile_dir, args.output, args.mip_tiff, args.mip_output,
+                 args.chunk, args.levels, args.workers, projection_first=args.projection_first)
+    for path in (args.output, args.mip_tiff, args.mip_output):
+        if path:
+            print(f"已写出 {path}")
+    print(f"融合图尺寸 (z, y, x) = {shape}")
+
+
+if __name__ == "__main__":
+    main()
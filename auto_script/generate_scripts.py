@@ -6,18 +6,137 @@ from pathlib import Path
 import subprocess
 import textwrap
 
+from resource_planner import plan_resources
+from resume import registration_dir
+from subtile_planner import check_array_tasks, describe_plan, local_array_tasks, plan_coords_file, plan_subtiles, write_plan
+from task_order import load_task_map, plan_task_order, task_map_path
+from retry import parse_memory
+
+def get_max_array_batch_size(config):
+    """获取单个数组作业允许的最大任务数
+
+    优先使用配置中的 [LOCAL_REGISTRATION] max_array_size，
+    否则读取集群 `scontrol show config` 中的 MaxArraySize（任务号需小于该值），
+    都不可用时默认 1000。
+    """
+    max_array_size = config.getint('LOCAL_REGISTRATION', 'max_array_size', fallback=0)
+    if not max_array_size:
+        try:
+            result = subprocess.run(['scontrol', 'show', 'config'], capture_output=True, text=True)
+            for line in result.stdout.splitlines():
+                key, _, value = line.partition('=')
+                if key.strip() == 'MaxArraySize':
+                    max_array_size = int(value.strip())
+                    break
+        except (OSError, ValueError):
+            pass
+    if max_array_size > 1:
+        return max_array_size - 1
+    return 1000
+
+def split_array_batches(array_tasks, max_per_batch):
+    """把数组任务按最大批次大小切分，返回 [(offset, batch_size), ...]"""
+    return [(offset, min(max_per_batch, array_tasks - offset))
+            for offset in range(0, array_tasks, max_per_batch)]
+
+def get_tasks_per_job(config, section):
+    """每个数组任务在同一个 MATLAB 会话中处理的位置/子块数（默认 1）"""
+    return max(1, config.getint(section, 'tasks_per_job', fallback=1))
+
+def count_array_jobs(num_tasks, tasks_per_job):
+    """把 num_tasks 个位置/子块按 tasks_per_job 打包后的数组任务数"""
+    return (num_tasks + tasks_per_job - 1) // tasks_per_job
+
+def array_indices_for_tasks(task_ids, tasks_per_job, offset=0):
+    """任务号 -> 需要提交的数组任务号（去重排序）"""
+    return sorted({(task_id - offset - 1) // tasks_per_job + 1 for task_id in task_ids})
+
+def get_volume_format(config):
+    """配准体积的中间格式：mat（每个子块一个 .mat）或 zarr（每个位置一个分块存储）"""
+    return config.get('GLOBAL_REGISTRATION', 'volume_format', fallback='mat').strip()
+
+def task_range_header(num_tasks, tasks_per_job, offset=0):
+    """生成计算本数组任务负责的 FIRST_TASK..LAST_TASK 的 bash 片段
+
+    OFFSET 为位置/子块编号的偏移（由 main.py 通过 --export 传入），
+    TASK_LIMIT 为本作业可处理的最大编号（流水线模式下为当前位置的最后一个子块）。
+    """
+    return textwrap.dedent(f"""\
+        TASKS_PER_JOB={tasks_per_job}
+        OFFSET=${{OFFSET:-{offset}}}  # 默认偏移为{offset}
+        TASK_LIMIT=${{TASK_LIMIT:-{num_tasks}}}
+        FIRST_TASK=$(( OFFSET + (SLURM_ARRAY_TASK_ID - 1) * TASKS_PER_JOB + 1 ))
+        LAST_TASK=$(( FIRST_TASK + TASKS_PER_JOB - 1 ))
+        if [ $LAST_TASK -gt $TASK_LIMIT ]; then LAST_TASK=$TASK_LIMIT; fi""")
+
+def matlab_task_loop(call, subtiles_per_position=None, task_map=None):
+    """生成 matlab -batch 命令：在一个会话中依次处理 FIRST_TASK..LAST_TASK
+
+    call 为 core_matlab(...) 调用，可使用 MATLAB 变量 position_name 和 subtile_id。
+    task_map 为 task_map.csv 的路径时，FIRST_TASK..LAST_TASK 是 slot，任务号从表中第 2 列查出。
+    每个位置/子块单独 try/catch 并输出进度，任一失败时以非零状态退出，便于 sacct 识别和重试。
+    """
+    if subtiles_per_position:
+        locate = (f"position_name = sprintf('Position%03d', floor((task_id - 1) / {subtiles_per_position}) + 1); "
+                  f"subtile_id = mod(task_id - 1, {subtiles_per_position}) + 1; ")
+        label = "fprintf('[task %d] %s subtile %d "
+        label_args = "task_id, position_name, subtile_id"
+    else:
+        locate = "position_name = sprintf('Position%03d', task_id); "
+        label = "fprintf('[task %d] %s "
+        label_args = "task_id, position_name"
+    if task_map:
+        loop = (f"task_map = readmatrix('{task_map}', 'NumHeaderLines', 1); "
+                f"for slot = $FIRST_TASK:$LAST_TASK, task_id = task_map(slot, 2); ")
+    else:
+        loop = "for task_id = $FIRST_TASK:$LAST_TASK, "
+    return (f'matlab -batch "addpath(\'$CORE_MATLAB_DIR\'); n_failed = 0; '
+            f'{loop}{locate}'
+            f'try, {call}; {label}done\\n\', {label_args}); '
+            f'catch err, n_failed = n_failed + 1; {label}failed: %s\\n\', {label_args}, getReport(err)); end, end; '
+            f'exit(double(n_failed > 0))"')
+
+def get_registration_backend(config):
+    """[GLOBAL_REGISTRATION] registration_backend：matlab 或 python（平移量由 global_registration.py 估计）"""
+    backend = config.get('GLOBAL_REGISTRATION', 'registration_backend', fallback='matlab').strip()
+    if backend not in ('matlab', 'python'):
+        raise ValueError(f"[GLOBAL_REGISTRATION] registration_backend 必须是 matlab 或 python，而不是 {backend}")
+    return backend
+
+def python_registration_options(config):
+    """registration_backend = python 时 core_matlab 的额外参数"""
+    if get_registration_backend(config) != 'python':
+        return ""
+    section = config['GLOBAL_REGISTRATION']
+    return (f", 'registration_backend', 'python', 'registration_script', '{Path(__file__).parent.absolute() / 'global_registration.py'}', "
+            f"'coarse_factor', {section.getint('coarse_factor', fallback=1)}, 'refine_window', {section.getint('refine_window', fallback=512)}")
+
+def task_map_file(config):
+    """task_order = cost 且 task_map.csv 有效时返回其路径，否则为 None"""
+    return task_map_path(config) if load_task_map(config) is not None else None
+
+def subtile_plan_options(config):
+    """规划了子块网格时 core_matlab 的 'coords_file' 参数，子块坐标和子块数都从该文件读取"""
+    plan = plan_subtiles(config)
+    if not plan['planned']:
+        return ""
+    return f", 'coords_file', '{plan_coords_file(registration_dir(config), plan)}'"
+
 def generate_global_registration_script(config):
     """生成全局配准脚本"""
+    resources = plan_resources(config, 'global_registration')
+    num_tasks = int(config['GLOBAL_REGISTRATION']['gr_array_tasks'])
+    tasks_per_job = get_tasks_per_job(config, 'GLOBAL_REGISTRATION')
     script = textwrap.dedent(f"""\
         #!/bin/bash
         #SBATCH -o logs_global_registration/global_registration_%A_%a.out  
         #SBATCH -e logs_global_registration/global_registration_%A_%a.err
         #SBATCH -J Global_Registration
-        #SBATCH -p C64M512G 
-        #SBATCH -c 8        
-        #SBATCH --mem=64G                  
-        #SBATCH --time=24:00:00
-        #SBATCH --array=1-{config['GLOBAL_REGISTRATION']['gr_array_tasks']}%{config['GLOBAL_REGISTRATION']['gr_parallel_tasks']}
+        #SBATCH -p {resources['partition']}
+        #SBATCH -c {resources['cpus']}
+        #SBATCH --mem={resources['mem']}
+        #SBATCH --time={resources['time']}
+        #SBATCH --array=1-{count_array_jobs(num_tasks, tasks_per_job)}%{config['GLOBAL_REGISTRATION']['gr_parallel_tasks']}
 
         module purge
         module load matlab/2023a
@@ -29,26 +148,27 @@ def generate_global_registration_script(config):
 
         PROJECT_NAME="{config['PROJECT']['project_name']}"
         PROJECT_ROOT="{config['PROJECT']['project_root']}"
-        TASK_ID=$SLURM_ARRAY_TASK_ID
-        POSITION_NAME=$(printf "Position%03d" $TASK_ID)
-
-        matlab -batch "addpath('$CORE_MATLAB_DIR'); core_matlab('$PROJECT_NAME', 'global_registration', '$POSITION_NAME', {config['GLOBAL_REGISTRATION']['image_width']}, {config['GLOBAL_REGISTRATION']['image_depth']}, {config['GLOBAL_REGISTRATION']['ref_round']}, {config['GLOBAL_REGISTRATION']['channel_num']}, {config['GLOBAL_REGISTRATION']['round_num']}, \\
-          '$PROJECT_ROOT', '01_data', '02_registration', 'log', 'sqrt_pieces', {config['GLOBAL_REGISTRATION']['sqrt_pieces']})"
     """)
+    call = (f"core_matlab('$PROJECT_NAME', 'global_registration', position_name, {config['GLOBAL_REGISTRATION']['image_width']}, {config['GLOBAL_REGISTRATION']['image_depth']}, {config['GLOBAL_REGISTRATION']['ref_round']}, {config['GLOBAL_REGISTRATION']['channel_num']}, {config['GLOBAL_REGISTRATION']['round_num']}, "
+            f"'$PROJECT_ROOT', '01_data', '02_registration', 'log', 'sqrt_pieces', {config['GLOBAL_REGISTRATION']['sqrt_pieces']}, 'volume_format', '{get_volume_format(config)}'"
+            f"{python_registration_options(config)}{subtile_plan_options(config)})")
+    script += task_range_header(num_tasks, tasks_per_job) + "\n\n" + matlab_task_loop(call) + "\n"
     return script
 
 def generate_local_registration_script(config):
     """生成局部配准脚本"""
-    array_tasks = int(config['LOCAL_REGISTRATION']['lr_array_tasks'])
+    resources = plan_resources(config, 'local_registration')
+    array_tasks = local_array_tasks(config)
     parallel_tasks = int(config['LOCAL_REGISTRATION']['lr_parallel_tasks'])
+    tasks_per_job = get_tasks_per_job(config, 'LOCAL_REGISTRATION')
+    subtiles_per_position = plan_subtiles(config)['num_subtiles']
+    task_map = task_map_file(config)
     
     scripts = []
-    max_per_batch = 1000
-    num_batches = (array_tasks + max_per_batch - 1) // max_per_batch
+    max_per_batch = get_max_array_batch_size(config)
+    num_jobs = count_array_jobs(array_tasks, tasks_per_job)
     
-    for batch in range(num_batches):
-        offset = batch * max_per_batch
-        current_batch_size = min(max_per_batch, array_tasks - offset)
+    for batch, (job_offset, current_batch_size) in enumerate(split_array_batches(num_jobs, max_per_batch)):
         array_range = f"1-{current_batch_size}"
         
         script = textwrap.dedent(f"""\
@@ -56,10 +176,10 @@ def generate_local_registration_script(config):
             #SBATCH -o logs_local_registration/local_registration_%A_%a.out  
             #SBATCH -e logs_local_registration/local_registration_%A_%a.err
             #SBATCH -J Local_Registration
-            #SBATCH -p C64M512G 
-            #SBATCH -c 8        
-            #SBATCH --mem=64G                  
-            #SBATCH --time=24:00:00
+            #SBATCH -p {resources['partition']}
+            #SBATCH -c {resources['cpus']}
+            #SBATCH --mem={resources['mem']}
+            #SBATCH --time={resources['time']}
             #SBATCH --array={array_range}%{parallel_tasks}
 
             module purge
@@ -72,34 +192,32 @@ def generate_local_registration_script(config):
 
             PROJECT_NAME="{config['PROJECT']['project_name']}"
             PROJECT_ROOT="{config['PROJECT']['project_root']}"
-            OFFSET=${{OFFSET:-{offset}}}  # 默认偏移为{offset}
-            TASK_ID=$(( SLURM_ARRAY_TASK_ID + OFFSET ))
-            SUBTILES_PER_POSITION=16  
-            POSITION_INDEX=$(( (TASK_ID - 1) / SUBTILES_PER_POSITION + 1 ))
-            SUBTILE_ID=$(( (TASK_ID - 1) % SUBTILES_PER_POSITION + 1 ))
-            POSITION_NAME=$(printf "Position%03d" $POSITION_INDEX)
-
-            matlab -batch "addpath('$CORE_MATLAB_DIR'); core_matlab('$PROJECT_NAME', 'local_registration', '$POSITION_NAME', {config['LOCAL_REGISTRATION']['image_width']}, {config['LOCAL_REGISTRATION']['image_depth']}, {config['LOCAL_REGISTRATION']['ref_round']}, {config['LOCAL_REGISTRATION']['channel_num']}, {config['LOCAL_REGISTRATION']['round_num']}, \\
-              '$PROJECT_ROOT', '01_data', '02_registration', 'log', 'spotfinding_method', '{config['LOCAL_REGISTRATION']['spotfinding_method']}', 'sqrt_pieces', {config['LOCAL_REGISTRATION']['sqrt_pieces']}, \\
-              'subtile', $SUBTILE_ID, 'voxel_size', {config['LOCAL_REGISTRATION']['voxel_size']}, 'end_bases', {config['LOCAL_REGISTRATION']['end_bases']}, 'barcode_mode', '{config['LOCAL_REGISTRATION']['barcode_mode']}', \\
-              'split_loc', {config['LOCAL_REGISTRATION']['split_loc']}, 'intensity_threshold', {config['LOCAL_REGISTRATION']['intensity_threshold']})"
         """)
+        call = (f"core_matlab('$PROJECT_NAME', 'local_registration', position_name, {config['LOCAL_REGISTRATION']['image_width']}, {config['LOCAL_REGISTRATION']['image_depth']}, {config['LOCAL_REGISTRATION']['ref_round']}, {config['LOCAL_REGISTRATION']['channel_num']}, {config['LOCAL_REGISTRATION']['round_num']}, "
+                f"'$PROJECT_ROOT', '01_data', '02_registration', 'log', 'spotfinding_method', '{config['LOCAL_REGISTRATION']['spotfinding_method']}', 'sqrt_pieces', {config['LOCAL_REGISTRATION']['sqrt_pieces']}, "
+                f"'subtile', subtile_id, 'voxel_size', {config['LOCAL_REGISTRATION']['voxel_size']}, 'end_bases', {config['LOCAL_REGISTRATION']['end_bases']}, 'barcode_mode', '{config['LOCAL_REGISTRATION']['barcode_mode']}', "
+                f"'split_loc', {config['LOCAL_REGISTRATION']['split_loc']}, 'intensity_threshold', {config['LOCAL_REGISTRATION']['intensity_threshold']}, 'volume_format', '{get_volume_format(config)}'{subtile_plan_options(config)})")
+        script += (task_range_header(array_tasks, tasks_per_job, job_offset * tasks_per_job) + "\n\n"
+                   + matlab_task_loop(call, subtiles_per_position, task_map) + "\n")
         scripts.append((f"02_local_registration_batch{batch+1}.sh", script))
     
     return scripts
 
 def generate_local_stitch_script(config):
     """生成局部拼接脚本"""
+    resources = plan_resources(config, 'local_stitch')
+    num_tasks = int(config['LOCAL_STITCH']['ls_array_tasks'])
+    tasks_per_job = get_tasks_per_job(config, 'LOCAL_STITCH')
     script = textwrap.dedent(f"""\
         #!/bin/bash
         #SBATCH -o logs_local_stitch/local_stitch_%A_%a.out  
         #SBATCH -e logs_local_stitch/local_stitch_%A_%a.err
         #SBATCH -J Local_Stitch
-        #SBATCH -p C64M512G 
-        #SBATCH -c 8        
-        #SBATCH --mem=64G                  
-        #SBATCH --time=24:00:00
-        #SBATCH --array=1-{config['LOCAL_STITCH']['ls_array_tasks']}%{config['LOCAL_STITCH']['ls_parallel_tasks']}
+        #SBATCH -p {resources['partition']}
+        #SBATCH -c {resources['cpus']}
+        #SBATCH --mem={resources['mem']}
+        #SBATCH --time={resources['time']}
+        #SBATCH --array=1-{count_array_jobs(num_tasks, tasks_per_job)}%{config['LOCAL_STITCH']['ls_parallel_tasks']}
 
         module purge
         module load matlab/2023a
@@ -111,30 +229,31 @@ def generate_local_stitch_script(config):
 
         PROJECT_NAME="{config['PROJECT']['project_name']}"
         PROJECT_ROOT="{config['PROJECT']['project_root']}"
-        TASK_ID=$SLURM_ARRAY_TASK_ID
-        POSITION_NAME=$(printf "Position%03d" $TASK_ID)
-
-        matlab -batch "addpath('$CORE_MATLAB_DIR'); core_matlab('$PROJECT_NAME', 'stitch', '$POSITION_NAME', {config['LOCAL_STITCH']['image_width']}, {config['LOCAL_STITCH']['image_depth']}, {config['LOCAL_STITCH']['ref_round']}, {config['LOCAL_STITCH']['channel_num']}, {config['LOCAL_STITCH']['round_num']}, \\
-          '$PROJECT_ROOT', '01_data', '02_registration', 'log', 'spotfinding_method', '{config['LOCAL_STITCH']['spotfinding_method']}', 'sqrt_pieces', {config['LOCAL_STITCH']['sqrt_pieces']})"
     """)
+    call = (f"core_matlab('$PROJECT_NAME', 'stitch', position_name, {config['LOCAL_STITCH']['image_width']}, {config['LOCAL_STITCH']['image_depth']}, {config['LOCAL_STITCH']['ref_round']}, {config['LOCAL_STITCH']['channel_num']}, {config['LOCAL_STITCH']['round_num']}, "
+            f"'$PROJECT_ROOT', '01_data', '02_registration', 'log', 'spotfinding_method', '{config['LOCAL_STITCH']['spotfinding_method']}', 'sqrt_pieces', {config['LOCAL_STITCH']['sqrt_pieces']}{subtile_plan_options(config)})")
+    script += task_range_header(num_tasks, tasks_per_job) + "\n\n" + matlab_task_loop(call) + "\n"
     return script
 
 def generate_if_registration_script(config):
     """生成免疫荧光配准脚本"""
+    resources = plan_resources(config, 'IF_registration')
     # 从配置文件中获取蛋白标记列表
     protein_stains = config['IF_REGISTRATION']['ir_protein_stains'].strip('{}').replace("'", "").split(',')
     protein_stains_str = ", ".join(f"'{stain.strip()}'" for stain in protein_stains)
+    num_tasks = int(config['IF_REGISTRATION']['ir_array_tasks'])
+    tasks_per_job = get_tasks_per_job(config, 'IF_REGISTRATION')
     
     script = textwrap.dedent(f"""\
         #!/bin/bash
         #SBATCH -o logs_IF_registration/IF_registration_%A_%a.out  
         #SBATCH -e logs_IF_registration/IF_registration_%A_%a.err
         #SBATCH -J IF_Registration
-        #SBATCH -p C64M512G 
-        #SBATCH -c 8        
-        #SBATCH --mem=64G                  
-        #SBATCH --time=24:00:00
-        #SBATCH --array=1-{config['IF_REGISTRATION']['ir_array_tasks']}%{config['IF_REGISTRATION']['ir_parallel_tasks']}
+        #SBATCH -p {resources['partition']}
+        #SBATCH -c {resources['cpus']}
+        #SBATCH --mem={resources['mem']}
+        #SBATCH --time={resources['time']}
+        #SBATCH --array=1-{count_array_jobs(num_tasks, tasks_per_job)}%{config['IF_REGISTRATION']['ir_parallel_tasks']}
 
         module purge
         module load matlab/2023a
@@ -146,30 +265,31 @@ def generate_if_registration_script(config):
 
         PROJECT_NAME="{config['PROJECT']['project_name']}"
         PROJECT_ROOT="{config['PROJECT']['project_root']}"
-        TASK_ID=$SLURM_ARRAY_TASK_ID
-        POSITION_NAME=$(printf "Position%03d" $TASK_ID)
-
-        matlab -batch "addpath('$CORE_MATLAB_DIR'); core_matlab('$PROJECT_NAME', 'nuclei_protein_registration', '$POSITION_NAME', {config['IF_REGISTRATION']['ir_image_width']}, {config['IF_REGISTRATION']['ir_image_depth']}, {config['IF_REGISTRATION']['ref_round']}, {config['IF_REGISTRATION']['ir_channel_num']}, {config['IF_REGISTRATION']['ir_round_num']}, \\
-          '$PROJECT_ROOT', '01_data', '02_registration', 'log', 'protein_round', '{config['IF_REGISTRATION']['ir_if_name']}', 'protein_stains', {{{protein_stains_str}}})"
     """)
+    call = (f"core_matlab('$PROJECT_NAME', 'nuclei_protein_registration', position_name, {config['IF_REGISTRATION']['ir_image_width']}, {config['IF_REGISTRATION']['ir_image_depth']}, {config['IF_REGISTRATION']['ref_round']}, {config['IF_REGISTRATION']['ir_channel_num']}, {config['IF_REGISTRATION']['ir_round_num']}, "
+            f"'$PROJECT_ROOT', '01_data', '02_registration', 'log', 'protein_round', '{config['IF_REGISTRATION']['ir_if_name']}', 'protein_stains', {{{protein_stains_str}}})")
+    script += task_range_header(num_tasks, tasks_per_job) + "\n\n" + matlab_task_loop(call) + "\n"
     return script
 
 def generate_if2_registration_script(config):
     """生成IF2配准脚本"""
+    resources = plan_resources(config, 'IF2_registration')
     # 从配置文件中获取蛋白标记列表
     protein_stains = config['IF2_REGISTRATION']['ir_protein_stains'].strip('{}').replace("'", "").split(',')
     protein_stains_str = ", ".join(f"'{stain.strip()}'" for stain in protein_stains)
+    num_tasks = int(config['IF2_REGISTRATION']['ir2_array_tasks'])
+    tasks_per_job = get_tasks_per_job(config, 'IF2_REGISTRATION')
     
     script = textwrap.dedent(f"""\
         #!/bin/bash
         #SBATCH -o logs_IF_registration/IF2_registration_%A_%a.out  
         #SBATCH -e logs_IF_registration/IF2_registration_%A_%a.err
         #SBATCH -J IF2_Registration
-        #SBATCH -p C64M512G 
-        #SBATCH -c 8        
-        #SBATCH --mem=64G                  
-        #SBATCH --time=24:00:00
-        #SBATCH --array=1-{config['IF2_REGISTRATION']['ir2_array_tasks']}%{config['IF2_REGISTRATION']['ir2_parallel_tasks']}
+        #SBATCH -p {resources['partition']}
+        #SBATCH -c {resources['cpus']}
+        #SBATCH --mem={resources['mem']}
+        #SBATCH --time={resources['time']}
+        #SBATCH --array=1-{count_array_jobs(num_tasks, tasks_per_job)}%{config['IF2_REGISTRATION']['ir2_parallel_tasks']}
 
         module purge
         module load matlab/2023a
@@ -181,16 +301,110 @@ def generate_if2_registration_script(config):
 
         PROJECT_NAME="{config['PROJECT']['project_name']}"
         PROJECT_ROOT="{config['PROJECT']['project_root']}"
-        TASK_ID=$SLURM_ARRAY_TASK_ID
-        POSITION_NAME=$(printf "Position%03d" $TASK_ID)
-
-        matlab -batch "addpath('$CORE_MATLAB_DIR'); core_matlab('$PROJECT_NAME', 'nuclei_protein_registration', '$POSITION_NAME', {config['IF2_REGISTRATION']['ir_image_width']}, {config['IF2_REGISTRATION']['ir_image_depth']}, {config['IF2_REGISTRATION']['ref_round']}, {config['IF2_REGISTRATION']['ir_channel_num']}, {config['IF2_REGISTRATION']['ir_round_num']}, \\
-          '$PROJECT_ROOT', '01_data', '02_registration', 'log', 'protein_round', '{config['IF2_REGISTRATION']['ir_if_name']}', 'protein_stains', {{{protein_stains_str}}})"
     """)
+    call = (f"core_matlab('$PROJECT_NAME', 'nuclei_protein_registration', position_name, {config['IF2_REGISTRATION']['ir_image_width']}, {config['IF2_REGISTRATION']['ir_image_depth']}, {config['IF2_REGISTRATION']['ref_round']}, {config['IF2_REGISTRATION']['ir_channel_num']}, {config['IF2_REGISTRATION']['ir_round_num']}, "
+            f"'$PROJECT_ROOT', '01_data', '02_registration', 'log', 'protein_round', '{config['IF2_REGISTRATION']['ir_if_name']}', 'protein_stains', {{{protein_stains_str}}})")
+    script += task_range_header(num_tasks, tasks_per_job) + "\n\n" + matlab_task_loop(call) + "\n"
     return script
 
+def fiji_command(imagej_path, bsh_name, resources):
+    """无界面运行 Fiji 脚本的一行命令
+
+    JVM 默认按节点内存确定最大堆，会超过作业的 --mem 而被 OOM kill。这里用启动器的 --mem
+    （即 JVM 的 -Xmx）把堆限制为作业内存减去 JVM 自身的开销（1/8，至少 2G）；
+    按 SLURM_MEM_PER_NODE 计算，重试提高 --mem 后堆随之增大。
+    """
+    job_mem = f"${{SLURM_MEM_PER_NODE:-{parse_memory(resources['mem'])}}}"
+    return (f"FIJI_MEM={job_mem}; FIJI_HEAP=$(( FIJI_MEM - (FIJI_MEM / 8 > 2048 ? FIJI_MEM / 8 : 2048) )); "
+            f'{imagej_path} --mem=${{FIJI_HEAP}}m --headless --console --run "$(pwd)/{bsh_name}"')
+
+def fiji_bsh_script(macro_name):
+    """启动 Fiji 宏的 BeanShell 脚本（拼接时忽略 z 方向的全局优化）"""
+    return textwrap.dedent(f"""\
+        // Set MPICBG parameters
+        mpicbg.stitching.GlobalOptimization.ignoreZ = true;
+        print("Set mpicbg.stitching.GlobalOptimization.ignoreZ = true;");
+
+        // Import IJ
+        import ij.IJ;
+
+        // Run macro script
+        String macroPath = "{macro_name}";
+        print("Running macro script: " + macroPath);
+        IJ.runMacroFile(macroPath);
+        print("Finished running macro script.");
+    """)
+
+def fiji_fusion_macro(protein_dir, protein):
+    """按已有的 TileConfiguration.registered.txt 融合一个蛋白，保存三维结果和 MIP"""
+    return textwrap.dedent(f"""\
+        print("Starting Grid/Collection stitching...");
+
+        run("Grid/Collection stitching", "type=[Positions from file] order=[Defined by TileConfiguration] directory={protein_dir}/ layout_file=TileConfiguration.registered.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 computation_parameters=[Save computation time (but use more RAM)] image_output=[Fuse and display]");
+
+        print("Finished Grid/Collection stitching.");
+
+        saveAs("Tiff", "{protein_dir}/{protein}big3dnew.tif");
+
+        run("Z Project...", "projection=[Max Intensity]");
+        saveAs("Tiff", "{protein_dir}/{protein}big2dnew.tif");
+
+        close();
+        close();
+    """)
+
+def is_projection_first(config, section, protein):
+    """protein 是否在 projection_first_proteins 中：先投影每个位置再做二维融合，不生成三维结果"""
+    proteins = config.get(section, 'projection_first_proteins', fallback='')
+    return protein in [p.strip() for p in proteins.split(',') if p.strip()]
+
+def fiji_projection_first_setup(protein_dir):
+    """srp 中的准备步骤：把三维布局文件转换为二维（去掉 z 坐标），写到 mip/ 目录"""
+    return textwrap.dedent(f"""\
+        mkdir -p "{protein_dir}/mip"
+        sed -E -e 's/^dim *= *3/dim = 2/' -e 's/\\(([^,]*),([^,]*),[^)]*\\)/(\\1,\\2)/' "{protein_dir}/TileConfiguration.registered.txt" > "{protein_dir}/mip/TileConfiguration.registered.txt"
+
+    """)
+
+def fiji_projection_first_macro(protein_dir, protein):
+    """先对每个位置做最大投影，保存到 mip/，再按二维布局融合，只保存 MIP"""
+    return textwrap.dedent(f"""\
+        print("Projecting tiles...");
+
+        lines = split(File.openAsString("{protein_dir}/mip/TileConfiguration.registered.txt"), "\\n");
+        for (i = 0; i < lines.length; i++) {{
+            if (indexOf(lines[i], ";") > 0 && !startsWith(lines[i], "#")) {{
+                name = replace(substring(lines[i], 0, indexOf(lines[i], ";")), " ", "");
+                open("{protein_dir}/" + name);
+                run("Z Project...", "projection=[Max Intensity]");
+                saveAs("Tiff", "{protein_dir}/mip/" + name);
+                close();
+                close();
+            }}
+        }}
+
+        print("Starting Grid/Collection stitching...");
+
+        run("Grid/Collection stitching", "type=[Positions from file] order=[Defined by TileConfiguration] directory={protein_dir}/mip/ layout_file=TileConfiguration.registered.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 computation_parameters=[Save computation time (but use more RAM)] image_output=[Fuse and display]");
+
+        print("Finished Grid/Collection stitching.");
+
+        saveAs("Tiff", "{protein_dir}/{protein}big2dnew.tif");
+
+        close();
+    """)
+
+def fiji_protein_setup(config, section, protein_dir, protein):
+    return fiji_projection_first_setup(protein_dir) if is_projection_first(config, section, protein) else ""
+
+def fiji_protein_macro(config, section, protein_dir, protein):
+    if is_projection_first(config, section, protein):
+        return fiji_projection_first_macro(protein_dir, protein)
+    return fiji_fusion_macro(protein_dir, protein)
+
 def generate_first_stitch_script(config):
     """Generate the first stitching script (script01)"""
+    resources = plan_resources(config, 'first_stitch')
     # 从config中获取第一个蛋白名称
     first_protein = config['IF1_GLOBAL_STITCH']['proteins'].split(',')[0].strip()
     
@@ -201,6 +415,8 @@ def generate_first_stitch_script(config):
     # 规范化路径
     registration_dir = os.path.normpath(config['IF1_GLOBAL_STITCH']['registration_dir'])
     protein_dir = os.path.normpath(f"{registration_dir}/IF1/{first_protein}")
+    if is_projection_first(config, 'IF1_GLOBAL_STITCH', first_protein):
+        print(f"警告：第一个蛋白 {first_protein} 需要三维配准得到拼接布局，不能先投影，仍按三维拼接")
     
     # 检查目录是否存在
     if not os.path.exists(protein_dir):
@@ -213,29 +429,17 @@ def generate_first_stitch_script(config):
         #SBATCH -o logs_stitch{first_protein}/stitch{first_protein}.%j.out
         #SBATCH -e logs_stitch{first_protein}/stitch{first_protein}.%j.err
         #SBATCH -J stitch{first_protein}
-        #SBATCH -p C64M512G
-        #SBATCH -c 16
-        #SBATCH --time=24:00:00
+        #SBATCH -p {resources['partition']}
+        #SBATCH -c {resources['cpus']}
+        #SBATCH --mem={resources['mem']}
+        #SBATCH --time={resources['time']}
 
         source activate Fiji
-        {config['IF1_GLOBAL_STITCH']['imagej_path']} --headless --console --run "$(pwd)/{script_name.replace('.srp', '.bsh')}"
+        {fiji_command(config['IF1_GLOBAL_STITCH']['imagej_path'], script_name.replace('.srp', '.bsh'), resources)}
     """)
     
     # Generate .bsh script
-    bsh_script = textwrap.dedent(f"""\
-        // Set MPICBG parameters
-        mpicbg.stitching.GlobalOptimization.ignoreZ = true;
-        print("Set mpicbg.stitching.GlobalOptimization.ignoreZ = true;");
-
-        // Import IJ
-        import ij.IJ;
-
-        // Run macro script
-        String macroPath = "{macro_name}";
-        print("Running macro script: " + macroPath);
-        IJ.runMacroFile(macroPath);
-        print("Finished running macro script.");
-    """)
+    bsh_script = fiji_bsh_script(macro_name)
     
     # Generate .ijm script
     ijm_script = textwrap.dedent(f"""\
@@ -260,8 +464,36 @@ def generate_first_stitch_script(config):
         macro_name: ijm_script
     }
 
+def get_fusion_backend(config, section):
+    """IF 拼接的融合方式：fiji（Grid/Collection stitching 融合）或 python（fusion.py 分块融合）"""
+    backend = config.get(section, 'fusion_backend', fallback=config.get('IF1_GLOBAL_STITCH', 'fusion_backend', fallback='fiji')).strip()
+    if backend not in ('fiji', 'python'):
+        raise ValueError(f"[{section}] fusion_backend 必须是 fiji 或 python，而不是 {backend}")
+    return backend
+
+def python_fusion_command(config, section, protein_dir, protein):
+    """按 TileConfiguration.registered.txt 分块融合，写出 OME-Zarr 和 <蛋白>big2dnew.tif"""
+    def option(key, default):
+        return config.get(section, key, fallback=config.get('IF1_GLOBAL_STITCH', key, fallback=default)).strip()
+    if is_projection_first(config, section, protein):
+        outputs = "--projection-first"
+    else:
+        outputs = f'--output "{protein_dir}/{protein}big3dnew.ome.zarr"'
+    return textwrap.dedent(f"""\
+        python "{Path(__file__).parent.absolute() / 'fusion.py'}" \\
+            --tile-config "{protein_dir}/TileConfiguration.registered.txt" \\
+            --tile-dir "{protein_dir}" \\
+            {outputs} \\
+            --mip-tiff "{protein_dir}/{protein}big2dnew.tif" \\
+            --mip-output "{protein_dir}/{protein}big2dnew.ome.zarr" \\
+            --chunk {option('fusion_chunk', '1024')} \\
+            --levels {option('pyramid_levels', '4')} \\
+            --workers {option('fusion_workers', '16')}
+    """)
+
 def generate_subsequent_stitch_scripts(config, protein, script_num):
     """Generate subsequent stitching scripts (script02 and later)"""
+    resources = plan_resources(config, 'stitch')
     # 从config中获取第一个蛋白名称
     first_protein = config['IF1_GLOBAL_STITCH']['proteins'].split(',')[0].strip()
     
@@ -280,48 +512,28 @@ def generate_subsequent_stitch_scripts(config, protein, script_num):
         #SBATCH -o logs_stitch{protein}/stitch{protein}.%j.out
         #SBATCH -e logs_stitch{protein}/stitch{protein}.%j.err
         #SBATCH -J stitch{protein}
-        #SBATCH -p C64M512G
-        #SBATCH -c 16
-        #SBATCH --time=24:00:00
+        #SBATCH -p {resources['partition']}
+        #SBATCH -c {resources['cpus']}
+        #SBATCH --mem={resources['mem']}
+        #SBATCH --time={resources['time']}
 
         cp -v "{first_protein_dir}/TileConfiguration.registered.txt" "{protein_dir}/"
 
+    """)
+    if get_fusion_backend(config, 'IF1_GLOBAL_STITCH') == 'python':
+        # 位置已由第一个蛋白确定，不需要 Fiji：直接按 TileConfiguration 分块融合
+        return {script_name: srp_script + python_fusion_command(config, 'IF1_GLOBAL_STITCH', protein_dir, protein)}
+    srp_script += fiji_protein_setup(config, 'IF1_GLOBAL_STITCH', protein_dir, protein)
+    srp_script += textwrap.dedent(f"""\
         source activate Fiji
-        {config['IF1_GLOBAL_STITCH']['imagej_path']} --headless --console --run "$(pwd)/{script_name.replace('.srp', '.bsh')}"
+        {fiji_command(config['IF1_GLOBAL_STITCH']['imagej_path'], script_name.replace('.srp', '.bsh'), resources)}
     """)
     
     # Generate .bsh script
-    bsh_script = textwrap.dedent(f"""\
-        // Set MPICBG parameters
-        mpicbg.stitching.GlobalOptimization.ignoreZ = true;
-        print("Set mpicbg.stitching.GlobalOptimization.ignoreZ = true;");
-
-        // Import IJ
-        import ij.IJ;
-
-        // Run macro script
-        String macroPath = "{macro_name}";
-        print("Running macro script: " + macroPath);
-        IJ.runMacroFile(macroPath);
-        print("Finished running macro script.");
-    """)
+    bsh_script = fiji_bsh_script(macro_name)
     
     # Generate .ijm script
-    ijm_script = textwrap.dedent(f"""\
-        print("Starting Grid/Collection stitching...");
-
-        run("Grid/Collection stitching", "type=[Positions from file] order=[Defined by TileConfiguration] directory={protein_dir}/ layout_file=TileConfiguration.registered.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 computation_parameters=[Save computation time (but use more RAM)] image_output=[Fuse and display]");
-
-        print("Finished Grid/Collection stitching.");
-
-        saveAs("Tiff", "{protein_dir}/{protein}big3dnew.tif");
-
-        run("Z Project...", "projection=[Max Intensity]");
-        saveAs("Tiff", "{protein_dir}/{protein}big2dnew.tif");
-
-        close();
-        close();
-    """)
+    ijm_script = fiji_protein_macro(config, 'IF1_GLOBAL_STITCH', protein_dir, protein)
     
     return {
         script_name: srp_script,
@@ -331,6 +543,7 @@ def generate_subsequent_stitch_scripts(config, protein, script_num):
 
 def generate_if2_stitch_scripts(config, protein, script_num):
     """Generate IF2 stitching scripts"""
+    resources = plan_resources(config, 'IF2_stitch')
     # 从config中获取第一个蛋白名称
     first_protein = config['IF1_GLOBAL_STITCH']['proteins'].split(',')[0].strip()
     
@@ -344,48 +557,28 @@ def generate_if2_stitch_scripts(config, protein, script_num):
         #SBATCH -o logs_stitch{protein}/stitch{protein}.%j.out
         #SBATCH -e logs_stitch{protein}/stitch{protein}.%j.err
         #SBATCH -J stitch{protein}
-        #SBATCH -p C64M512G
-        #SBATCH -c 16
-        #SBATCH --time=24:00:00
+        #SBATCH -p {resources['partition']}
+        #SBATCH -c {resources['cpus']}
+        #SBATCH --mem={resources['mem']}
+        #SBATCH --time={resources['time']}
 
         cp -v "{config['IF2_GLOBAL_STITCH']['registration_dir']}/IF1/{first_protein}/TileConfiguration.registered.txt" "{config['IF2_GLOBAL_STITCH']['registration_dir']}/IF2/{protein}/"
 
+    """)
+    protein_dir = f"{config['IF2_GLOBAL_STITCH']['registration_dir']}/IF2/{protein}"
+    if get_fusion_backend(config, 'IF2_GLOBAL_STITCH') == 'python':
+        return {script_name: srp_script + python_fusion_command(config, 'IF2_GLOBAL_STITCH', protein_dir, protein)}
+    srp_script += fiji_protein_setup(config, 'IF2_GLOBAL_STITCH', protein_dir, protein)
+    srp_script += textwrap.dedent(f"""\
         source activate Fiji
-        {config['IF2_GLOBAL_STITCH']['imagej_path']} --headless --console --run "$(pwd)/{script_name.replace('.srp', '.bsh')}"
+        {fiji_command(config['IF2_GLOBAL_STITCH']['imagej_path'], script_name.replace('.srp', '.bsh'), resources)}
     """)
     
     # Generate .bsh script
-    bsh_script = textwrap.dedent(f"""\
-        // Set MPICBG parameters
-        mpicbg.stitching.GlobalOptimization.ignoreZ = true;
-        print("Set mpicbg.stitching.GlobalOptimization.ignoreZ = true;");
-
-        // Import IJ
-        import ij.IJ;
-
-        // Run macro script
-        String macroPath = "{macro_name}";
-        print("Running macro script: " + macroPath);
-        IJ.runMacroFile(macroPath);
-        print("Finished running macro script.");
-    """)
+    bsh_script = fiji_bsh_script(macro_name)
     
     # Generate .ijm script
-    ijm_script = textwrap.dedent(f"""\
-        print("Starting Grid/Collection stitching...");
-
-        run("Grid/Collection stitching", "type=[Positions from file] order=[Defined by TileConfiguration] directory={config['IF2_GLOBAL_STITCH']['registration_dir']}/IF2/{protein}/ layout_file=TileConfiguration.registered.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 computation_parameters=[Save computation time (but use more RAM)] image_output=[Fuse and display]");
-
-        print("Finished Grid/Collection stitching.");
-
-        saveAs("Tiff", "{config['IF2_GLOBAL_STITCH']['registration_dir']}/IF2/{protein}/{protein}big3dnew.tif");
-
-        run("Z Project...", "projection=[Max Intensity]");
-        saveAs("Tiff", "{config['IF2_GLOBAL_STITCH']['registration_dir']}/IF2/{protein}/{protein}big2dnew.tif");
-
-        close();
-        close();
-    """)
+    ijm_script = fiji_protein_macro(config, 'IF2_GLOBAL_STITCH', protein_dir, protein)
     
     return {
         script_name: srp_script,
@@ -393,8 +586,87 @@ def generate_if2_stitch_scripts(config, protein, script_num):
         macro_name: ijm_script
     }
 
+COMBINED_STITCH_SCRIPT = '07_stitch_combined.srp'
+COMBINED_IF2_STITCH_SCRIPT = '09_IF2_stitch_combined.srp'
+
+def stitch_targets(config, section):
+    """第一个蛋白之后要融合的蛋白：[(配置节, 蛋白, 蛋白目录, 布局文件所在目录)]"""
+    first_protein = config['IF1_GLOBAL_STITCH']['proteins'].split(',')[0].strip()
+    if section == 'IF1_GLOBAL_STITCH':
+        registration_dir = os.path.normpath(config['IF1_GLOBAL_STITCH']['registration_dir'])
+        layout_dir = os.path.normpath(f"{registration_dir}/IF1/{first_protein}")
+        proteins = [p.strip() for p in config['IF1_GLOBAL_STITCH']['proteins'].split(',')[1:]]
+        return [(section, p, os.path.normpath(f"{registration_dir}/IF1/{p}"), layout_dir) for p in proteins]
+    registration_dir = config['IF2_GLOBAL_STITCH']['registration_dir']
+    proteins = [p.strip() for p in config['IF2_GLOBAL_STITCH']['proteins'].split(',')]
+    return [(section, p, f"{registration_dir}/IF2/{p}", f"{registration_dir}/IF1/{first_protein}") for p in proteins]
+
+def combined_stitch_jobs(config):
+    """combined_fusion = true 时，同一节的蛋白在一个作业中依次融合（IF1 和 IF2 都合并时放在同一个作业）
+
+    返回 [(脚本名, 步骤, 融合目标)]，融合目标见 stitch_targets。
+    """
+    if1 = []
+    if config.getboolean('IF1_GLOBAL_STITCH', 'combined_fusion', fallback=False):
+        if1 = stitch_targets(config, 'IF1_GLOBAL_STITCH')
+    if2 = []
+    if (config.getboolean('IF2_GLOBAL_STITCH', 'if2_enabled', fallback=False)
+            and config.getboolean('IF2_GLOBAL_STITCH', 'combined_fusion', fallback=False)):
+        if2 = stitch_targets(config, 'IF2_GLOBAL_STITCH')
+    jobs = []
+    if if1:
+        jobs.append((COMBINED_STITCH_SCRIPT, '07', if1 + if2))
+        if2 = []
+    if if2:
+        jobs.append((COMBINED_IF2_STITCH_SCRIPT, '09', if2))
+    return jobs
+
+def generate_combined_stitch_script(config, script_name, targets):
+    """一个作业融合多个蛋白：布局文件复制一次，Fiji 融合的蛋白共用一个 Fiji 会话和一个宏"""
+    # 各蛋白依次融合：内存按需求最大的节，运行时间按蛋白数累加
+    resources = max((plan_resources(config, 'IF2_stitch' if section == 'IF2_GLOBAL_STITCH' else 'stitch', proteins=len(targets))
+                     for section in {t[0] for t in targets}), key=lambda r: parse_memory(r['mem']))
+    job_name = script_name[:-len('.srp')]
+    macro_name = script_name.replace('_stitch_', '_Macro_').replace('.srp', '.ijm')
+    srp_script = textwrap.dedent(f"""\
+        #!/bin/bash
+        #SBATCH -o logs_{job_name}/{job_name}.%j.out
+        #SBATCH -e logs_{job_name}/{job_name}.%j.err
+        #SBATCH -J {job_name}
+        #SBATCH -p {resources['partition']}
+        #SBATCH -c {resources['cpus']}
+        #SBATCH --mem={resources['mem']}
+        #SBATCH --time={resources['time']}
+
+    """)
+    for _, protein, protein_dir, layout_dir in targets:
+        srp_script += f'cp -v "{layout_dir}/TileConfiguration.registered.txt" "{protein_dir}/"\n'
+    srp_script += "\nFAILED=0\n"
+
+    fiji_targets = [t for t in targets if get_fusion_backend(config, t[0]) == 'fiji']
+    for section, protein, protein_dir, _ in targets:
+        if get_fusion_backend(config, section) == 'python':
+            srp_script += f"\n{python_fusion_command(config, section, protein_dir, protein).rstrip()} || FAILED=$((FAILED + 1))\n"
+    scripts = {}
+    if fiji_targets:
+        setup = "".join(fiji_protein_setup(config, section, protein_dir, protein)
+                        for section, protein, protein_dir, _ in fiji_targets)
+        if setup:
+            srp_script += "\n" + setup.rstrip("\n") + "\n"
+        srp_script += textwrap.dedent(f"""
+            source activate Fiji
+            {fiji_command(config[fiji_targets[0][0]]['imagej_path'], script_name.replace('.srp', '.bsh'), resources)} || FAILED=$((FAILED + 1))
+        """)
+        scripts[script_name.replace('.srp', '.bsh')] = fiji_bsh_script(macro_name)
+        scripts[macro_name] = "\n".join(f'print("Protein: {protein}");\n' + fiji_protein_macro(config, section, protein_dir, protein)
+                                        for section, protein, protein_dir, _ in fiji_targets)
+    srp_script += "\nexit $(( FAILED > 0 ))\n"
+    scripts[script_name] = srp_script
+    return scripts
+
 def generate_point_stitch_script(config, scripts_dir):
     """Generate point stitching script"""
+    resources = plan_resources(config, 'stitchpoint')
     # 生成点拼接脚本
     point_stitch_script = os.path.join(scripts_dir, '10_stitchpoint.srp')
     script_content = textwrap.dedent(f"""\
@@ -402,9 +674,10 @@ def generate_point_stitch_script(config, scripts_dir):
         #SBATCH -o logs_stitchpoint/stitchpoint.%j.out
         #SBATCH -e logs_stitchpoint/stitchpoint.%j.err
         #SBATCH -J stitchpoint
-        #SBATCH -p C64M512G
-        #SBATCH -c 8
-        #SBATCH --time=24:00:00
+        #SBATCH -p {resources['partition']}
+        #SBATCH -c {resources['cpus']}
+        #SBATCH --mem={resources['mem']}
+        #SBATCH --time={resources['time']}
 
         module purge
         module load matlab/2023a
@@ -419,14 +692,37 @@ def generate_point_stitch_script(config, scripts_dir):
 
         matlab -batch "addpath('$CORE_MATLAB_DIR'); core_matlab('$PROJECT_NAME', 'stitchpoint', '$PROJECT_ROOT', '01_data', '02_registration', 'log')"
     """)
+    if config.get('IF1_GLOBAL_STITCH', 'point_stitch_backend', fallback='matlab').strip() == 'python':
+        # Python 实现：矩形判断归属、只读 TIFF 头、并行读取各位置的点文件
+        stitch_file, dapi_file, spot_out_path = get_point_stitch_paths(config)
+        method = config.get('LOCAL_STITCH', 'spotfinding_method', fallback='max3d')
+        script_content = textwrap.dedent(f"""\
+            #!/bin/bash
+            #SBATCH -o logs_stitchpoint/stitchpoint.%j.out
+            #SBATCH -e logs_stitchpoint/stitchpoint.%j.err
+            #SBATCH -J stitchpoint
+            #SBATCH -p {resources['partition']}
+            #SBATCH -c {resources['cpus']}
+            #SBATCH --mem={resources['mem']}
+            #SBATCH --time={resources['time']}
+
+            python "{Path(__file__).parent.absolute() / 'stitch_points.py'}" \\
+                --tile-config "{stitch_file}" \\
+                --image "{dapi_file}" \\
+                --registration-dir "{config['IF1_GLOBAL_STITCH']['registration_dir'].strip()}" \\
+                --output "{os.path.join(spot_out_path, f'merged_goodPoints_{method}.csv')}" \\
+                --method {method} \\
+                --format {config.get('IF1_GLOBAL_STITCH', 'spot_format', fallback='csv').strip()} \\
+                --workers {config.get('IF1_GLOBAL_STITCH', 'point_stitch_workers', fallback='8')}
+        """)
     with open(point_stitch_script, 'w', encoding='utf-8') as f:
         f.write(script_content)
     os.chmod(point_stitch_script, 0o755)
     print(f"生成点拼接脚本: {point_stitch_script}")
     return {'10_stitchpoint.srp': script_content}
 
-def generate_stitchpoint_matlab_script(config):
-    """生成stitchpointnewbjx.m文件"""
+def get_point_stitch_paths(config):
+    """点拼接的输入输出路径：(TileConfiguration.registered.txt, 拼接后的二维图, 输出目录)"""
     # 从config中获取第一个蛋白名称
     first_protein = config['IF1_GLOBAL_STITCH']['proteins'].split(',')[0].strip()
     
@@ -435,6 +731,11 @@ def generate_stitchpoint_matlab_script(config):
     dapi_file = os.path.normpath(f"{config['IF1_GLOBAL_STITCH']['registration_dir']}/IF1/{first_protein}/{first_protein}big2dnew.tif")
     # 修改输出路径，移除02_registration目录
     spot_out_path = os.path.normpath(f"{config['IF1_GLOBAL_STITCH']['registration_dir'].replace('/02_registration', '')}/merged_spots")
+    return stitch_file, dapi_file, spot_out_path
+
+def generate_stitchpoint_matlab_script(config):
+    """生成stitchpointnewbjx.m文件"""
+    stitch_file, dapi_file, spot_out_path = get_point_stitch_paths(config)
     
     matlab_script = f"""% merge dots 
 stitch_file = '{stitch_file}';
@@ -591,18 +892,51 @@ writetable(merged_table, fullfile(spot_out_path, 'merged_goodPoints_max3d.csv'))
 """
     return {'stitchpointnewbjx.m': matlab_script}
 
+def get_spotfinding_backend(config):
+    """[LOCAL_REGISTRATION] spotfinding_backend：python 只支持 max3d，其余方法仍由 MATLAB 检测"""
+    backend = config.get('LOCAL_REGISTRATION', 'spotfinding_backend', fallback='matlab').strip()
+    if backend == 'python' and config['LOCAL_REGISTRATION']['spotfinding_method'].strip() != 'max3d':
+        print(f"警告：Python 点检测只支持 max3d，{config['LOCAL_REGISTRATION']['spotfinding_method']} 仍使用 MATLAB")
+        return 'matlab'
+    return backend
+
+def python_decoding_options(config):
+    """[LOCAL_REGISTRATION] decoding_backend = python 时 core_matlab 的额外参数（码本查找由 barcode_decoding.py 完成）"""
+    backend = config.get('LOCAL_REGISTRATION', 'decoding_backend', fallback='matlab').strip()
+    if backend not in ('matlab', 'python'):
+        raise ValueError(f"[LOCAL_REGISTRATION] decoding_backend 必须是 matlab 或 python，而不是 {backend}")
+    if backend != 'python':
+        return ""
+    return f", 'decoding_backend', 'python', 'decoding_script', '{Path(__file__).parent.absolute() / 'barcode_decoding.py'}'"
+
+def python_spot_finding_command(config, subtiles_per_position, task_map=None):
+    """第 03 步先用 spot_finding.py 检测本数组任务所有子块的点位置，core_matlab 再读取这些位置"""
+    section = config['LOCAL_REGISTRATION']
+    task_map_option = f'--task-map "{task_map}" ' if task_map else ''
+    return textwrap.dedent(f"""        python "{Path(__file__).parent.absolute() / 'spot_finding.py'}" \\
+            --registration-dir "$PROJECT_ROOT/$PROJECT_NAME/02_registration" \\
+            --tasks $FIRST_TASK $LAST_TASK {task_map_option}\\
+            --subtiles {subtiles_per_position} \\
+            --ref-round {section['ref_round']} \\
+            --intensity-threshold {section['intensity_threshold']} \\
+            --volume-format {get_volume_format(config)} \\
+            --workers ${{SLURM_CPUS_PER_TASK:-1}}""")
+
 def generate_spot_finding_scripts(config):
     """Generate spot finding script for all subtiles"""
-    array_tasks = int(config['LOCAL_REGISTRATION']['lr_array_tasks'])
+    resources = plan_resources(config, 'spot_finding')
+    array_tasks = local_array_tasks(config)
     parallel_tasks = int(config['LOCAL_REGISTRATION']['lr_parallel_tasks'])
+    tasks_per_job = get_tasks_per_job(config, 'LOCAL_REGISTRATION')
+    subtiles_per_position = plan_subtiles(config)['num_subtiles']
+    task_map = task_map_file(config)
+    spotfinding_backend = get_spotfinding_backend(config)
     
     scripts = []
-    max_per_batch = 1000
-    num_batches = (array_tasks + max_per_batch - 1) // max_per_batch
+    max_per_batch = get_max_array_batch_size(config)
+    num_jobs = count_array_jobs(array_tasks, tasks_per_job)
     
-    for batch in range(num_batches):
-        offset = batch * max_per_batch
-        current_batch_size = min(max_per_batch, array_tasks - offset)
+    for batch, (job_offset, current_batch_size) in enumerate(split_array_batches(num_jobs, max_per_batch)):
         array_range = f"1-{current_batch_size}"
         
         script = textwrap.dedent(f"""\
@@ -610,10 +944,10 @@ def generate_spot_finding_scripts(config):
             #SBATCH -o logs_spot_finding/spot_finding_%A_%a.out  
             #SBATCH -e logs_spot_finding/spot_finding_%A_%a.err
             #SBATCH -J Spot_Finding
-            #SBATCH -p C64M512G 
-            #SBATCH -c 8        
-            #SBATCH --mem=64G                  
-            #SBATCH --time=24:00:00
+            #SBATCH -p {resources['partition']}
+            #SBATCH -c {resources['cpus']}
+            #SBATCH --mem={resources['mem']}
+            #SBATCH --time={resources['time']}
             #SBATCH --array={array_range}%{parallel_tasks}
 
             module purge
@@ -626,19 +960,64 @@ def generate_spot_finding_scripts(config):
 
             PROJECT_NAME="{config['PROJECT']['project_name']}"
             PROJECT_ROOT="{config['PROJECT']['project_root']}"
-            OFFSET=${{OFFSET:-{offset}}}  # 默认偏移为{offset}
-            TASK_ID=$(( SLURM_ARRAY_TASK_ID + OFFSET ))
-            SUBTILES_PER_POSITION={config['LOCAL_REGISTRATION']['sqrt_pieces']}*{config['LOCAL_REGISTRATION']['sqrt_pieces']}  
-            POSITION_INDEX=$(( (TASK_ID - 1) / SUBTILES_PER_POSITION + 1 ))
-            SUBTILE_ID=$(( (TASK_ID - 1) % SUBTILES_PER_POSITION + 1 ))
-            POSITION_NAME=$(printf "Position%03d" $POSITION_INDEX)
-
-            matlab -batch "addpath('$CORE_MATLAB_DIR'); core_matlab('$PROJECT_NAME', 'spot_finding', '$POSITION_NAME', {config['LOCAL_REGISTRATION']['image_width']}, {config['LOCAL_REGISTRATION']['image_depth']}, {config['LOCAL_REGISTRATION']['ref_round']}, {config['LOCAL_REGISTRATION']['channel_num']}, {config['LOCAL_REGISTRATION']['round_num']}, '$PROJECT_ROOT', '01_data', '02_registration', 'log', 'spotfinding_method', '{config['LOCAL_REGISTRATION']['spotfinding_method']}', 'sqrt_pieces', {config['LOCAL_REGISTRATION']['sqrt_pieces']}, 'subtile', $SUBTILE_ID, 'voxel_size', {config['LOCAL_REGISTRATION']['voxel_size']}, 'end_bases', {config['LOCAL_REGISTRATION']['end_bases']}, 'barcode_mode', '{config['LOCAL_REGISTRATION']['barcode_mode']}', 'split_loc', {config['LOCAL_REGISTRATION']['split_loc']}, 'intensity_threshold', {config['LOCAL_REGISTRATION']['intensity_threshold']})"
         """)
+        call = (f"core_matlab('$PROJECT_NAME', 'spot_finding', position_name, {config['LOCAL_REGISTRATION']['image_width']}, {config['LOCAL_REGISTRATION']['image_depth']}, {config['LOCAL_REGISTRATION']['ref_round']}, {config['LOCAL_REGISTRATION']['channel_num']}, {config['LOCAL_REGISTRATION']['round_num']}, '$PROJECT_ROOT', '01_data', '02_registration', 'log', 'spotfinding_method', '{config['LOCAL_REGISTRATION']['spotfinding_method']}', 'sqrt_pieces', {config['LOCAL_REGISTRATION']['sqrt_pieces']}, 'subtile', subtile_id, 'voxel_size', {config['LOCAL_REGISTRATION']['voxel_size']}, 'end_bases', {config['LOCAL_REGISTRATION']['end_bases']}, 'barcode_mode', '{config['LOCAL_REGISTRATION']['barcode_mode']}', 'split_loc', {config['LOCAL_REGISTRATION']['split_loc']}, 'intensity_threshold', {config['LOCAL_REGISTRATION']['intensity_threshold']}, 'volume_format', '{get_volume_format(config)}', 'spotfinding_backend', '{spotfinding_backend}'{python_decoding_options(config)}{subtile_plan_options(config)})")
+        script += task_range_header(array_tasks, tasks_per_job, job_offset * tasks_per_job) + "\n\n"
+        if spotfinding_backend == 'python':
+            # Python 失败的子块不写出点文件，MATLAB 读取时报错并计为失败
+            script += python_spot_finding_command(config, subtiles_per_position, task_map) + "\n\n"
+        script += matlab_task_loop(call, subtiles_per_position, task_map) + "\n"
         scripts.append((f"03_spot_finding_batch{batch+1}.sh", script))
     
     return scripts
 
+def generate_local_registration_spot_finding_scripts(config):
+    """生成局部配准+点检测合并脚本：局部配准结果留在内存中直接点检测，不再写出/读回 .mat"""
+    resources = plan_resources(config, 'local_registration_spot_finding')
+    array_tasks = local_array_tasks(config)
+    parallel_tasks = int(config['LOCAL_REGISTRATION']['lr_parallel_tasks'])
+    tasks_per_job = get_tasks_per_job(config, 'LOCAL_REGISTRATION')
+    subtiles_per_position = plan_subtiles(config)['num_subtiles']
+    task_map = task_map_file(config)
+    save_registered = 'true' if config.getboolean('LOCAL_REGISTRATION', 'save_registered', fallback=False) else 'false'
+    
+    scripts = []
+    max_per_batch = get_max_array_batch_size(config)
+    num_jobs = count_array_jobs(array_tasks, tasks_per_job)
+    
+    for batch, (job_offset, current_batch_size) in enumerate(split_array_batches(num_jobs, max_per_batch)):
+        array_range = f"1-{current_batch_size}"
+        
+        script = textwrap.dedent(f"""\
+            #!/bin/bash
+            #SBATCH -o logs_local_registration/local_registration_spot_finding_%A_%a.out  
+            #SBATCH -e logs_local_registration/local_registration_spot_finding_%A_%a.err
+            #SBATCH -J Local_Registration_Spot_Finding
+            #SBATCH -p {resources['partition']}
+            #SBATCH -c {resources['cpus']}
+            #SBATCH --mem={resources['mem']}
+            #SBATCH --time={resources['time']}
+            #SBATCH --array={array_range}%{parallel_tasks}
+
+            module purge
+            module load matlab/2023a
+
+            MATLAB_SRC="{config['PROJECT']['matlab_src']}"
+            MATLAB_ARCHIVE="{config['PROJECT']['matlab_archive']}"
+            CORE_MATLAB_DIR="{config['PROJECT']['core_matlab_dir']}"
+            export MATLAB_SRC MATLAB_ARCHIVE CORE_MATLAB_DIR
+
+            PROJECT_NAME="{config['PROJECT']['project_name']}"
+            PROJECT_ROOT="{config['PROJECT']['project_root']}"
+        """)
+        call = (f"core_matlab('$PROJECT_NAME', 'local_registration_spot_finding', position_name, {config['LOCAL_REGISTRATION']['image_width']}, {config['LOCAL_REGISTRATION']['image_depth']}, {config['LOCAL_REGISTRATION']['ref_round']}, {config['LOCAL_REGISTRATION']['channel_num']}, {config['LOCAL_REGISTRATION']['round_num']}, '$PROJECT_ROOT', '01_data', '02_registration', 'log', 'spotfinding_method', '{config['LOCAL_REGISTRATION']['spotfinding_method']}', 'sqrt_pieces', {config['LOCAL_REGISTRATION']['sqrt_pieces']}, 'subtile', subtile_id, 'voxel_size', {config['LOCAL_REGISTRATION']['voxel_size']}, 'end_bases', {config['LOCAL_REGISTRATION']['end_bases']}, 'barcode_mode', '{config['LOCAL_REGISTRATION']['barcode_mode']}', 'split_loc', {config['LOCAL_REGISTRATION']['split_loc']}, 'intensity_threshold', {config['LOCAL_REGISTRATION']['intensity_threshold']}, "
+                f"'save_registered', {save_registered}, 'volume_format', '{get_volume_format(config)}'{python_decoding_options(config)}{subtile_plan_options(config)})")
+        script += (task_range_header(array_tasks, tasks_per_job, job_offset * tasks_per_job) + "\n\n"
+                   + matlab_task_loop(call, subtiles_per_position, task_map) + "\n")
+        scripts.append((f"02_local_registration_spot_finding_batch{batch+1}.sh", script))
+    
+    return scripts
+
 def generate_scripts(config_file='config.ini', script_dir='.'):
     """Generate all scripts"""
     # Get current script directory
@@ -659,6 +1038,26 @@ def generate_scripts(config_file='config.ini', script_dir='.'):
     if script_dir != '.':
         script_path.mkdir(exist_ok=True)
     
+    # 子块划分：规划的网格写到 02_registration/subtile_plan/，供 core_matlab 读取
+    plan = plan_subtiles(config)
+    print(describe_plan(plan))
+    warning = check_array_tasks(config)
+    if warning:
+        print(warning)
+    if plan['planned']:
+        try:
+            print(f"子块网格已写出到 {write_plan(registration_dir(config), plan)}")
+        except OSError as e:
+            print(f"警告：无法写出子块网格 {plan_coords_file(registration_dir(config), plan)}：{e}")
+    
+    # 02/03 的任务顺序：task_order = cost 时按估计耗时从大到小写出 task_map.csv
+    try:
+        message = plan_task_order(config)
+    except OSError as e:
+        message = f"警告：无法写出 {task_map_path(config)}，02/03 按原顺序运行：{e}"
+    if message:
+        print(message)
+    
     # Generate all scripts
     scripts = {
         '01_global_registration.sh': generate_global_registration_script(config),
@@ -680,6 +1079,11 @@ def generate_scripts(config_file='config.ini', script_dir='.'):
         for script_name, content in spot_finding_scripts:
             scripts[script_name] = content
     
+    # 合并模式下生成局部配准+点检测脚本
+    if config.getboolean('LOCAL_REGISTRATION', 'fused_spot_finding', fallback=False):
+        for script_name, content in generate_local_registration_spot_finding_scripts(config):
+            scripts[script_name] = content
+    
     # Check if IF2 registration script needs to be generated
     if config.getboolean('IF2_REGISTRATION', 'if2_enabled', fallback=False):
         scripts['05_IF2_registration.sh'] = generate_if2_registration_script(config)
@@ -691,14 +1095,20 @@ def generate_scripts(config_file='config.ini', script_dir='.'):
     # Generate subsequent stitching scripts
     proteins = config['IF1_GLOBAL_STITCH']['proteins'].split(',')
     script_num = 1  # 从1开始
-    for protein in proteins[1:]:  # Skip the first protein as it's already handled
-        protein = protein.strip()
-        subsequent_scripts = generate_subsequent_stitch_scripts(config, protein, script_num)
-        scripts.update(subsequent_scripts)
-        script_num += 1
+    if not config.getboolean('IF1_GLOBAL_STITCH', 'combined_fusion', fallback=False):
+        for protein in proteins[1:]:  # Skip the first protein as it's already handled
+            protein = protein.strip()
+            subsequent_scripts = generate_subsequent_stitch_scripts(config, protein, script_num)
+            scripts.update(subsequent_scripts)
+            script_num += 1
+    
+    # 合并融合：多个蛋白共用一个作业
+    for script_name, _, targets in combined_stitch_jobs(config):
+        scripts.update(generate_combined_stitch_script(config, script_name, targets))
     
     # Generate IF2 stitching scripts if enabled
-    if config.getboolean('IF2_GLOBAL_STITCH', 'if2_enabled', fallback=False):
+    if (config.getboolean('IF2_GLOBAL_STITCH', 'if2_enabled', fallback=False)
+            and not config.getboolean('IF2_GLOBAL_STITCH', 'combined_fusion', fallback=False)):
         proteins = config['IF2_GLOBAL_STITCH']['proteins'].split(',')
         script_num = 1  # 从1开始
         for protein in proteins:
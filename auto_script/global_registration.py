@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""全局配准平移量估计的 Python 实现
+
+core_matlab 的 global_registration 模式（registration_backend = python）在预处理之后，
+把每轮各通道的最大投影 (y, x, z, 1, round) 写到 interm/global_registration_input.zarr，
+调用本脚本得到各轮相对参考轮的整数平移，写到 interm/global_shifts.csv，再在 MATLAB 中用
+circshift 应用（与 DFTApply3D 对整数平移的结果相同），不再对每个通道做 FFT。
+
+平移与 DFTRegister3D 的定义相同：取 ifftn(fftn(fix) .* conj(fftn(mov))) 绝对值最大处，
+并列时取 MATLAB 列优先顺序的第一个。coarse_factor = 1 时在全分辨率上计算，与 DFTRegister3D 相同；
+coarse_factor > 1 时先在 xy 方向降采样后的体积上找峰（所有轮一起做 FFT），再在中心
+refine_window × refine_window 的全分辨率窗口内、粗峰附近 ±coarse_factor 像素范围内细化。
+FFT 使用 scipy.fft 的多线程（workers）。子块划分 coords_mat_N.csv 仍由 core_matlab 写出。
+"""
+import argparse
+import os
+from pathlib import Path
+
+import numpy as np
+import scipy.fft
+
+import volume_store
+
+
+def dft_shift(index, n):
+    """FFT 下标 -> 有符号平移，与 ifftshift(-fix(n/2):ceil(n/2)-1) 相同"""
+    return index if index < (n + 1) // 2 else index - n
+
+
+def correlation_peak(cc_abs):
+    """绝对值最大处的下标；并列时取 MATLAB 列优先顺序的第一个"""
+    candidates = np.argwhere(cc_abs == cc_abs.max())
+    return tuple(candidates[np.lexsort(candidates.T)[0]])
+
+
+def cross_correlation(fixed_fft, moving, shape, workers):
+    """fixed_fft 为 rfftn(fixed)；对 moving 的最后 3 个轴计算循环互相关"""
+    axes = tuple(range(moving.ndim - 3, moving.ndim))
+    moving_fft = scipy.fft.rfftn(moving, axes=axes, workers=workers)
+    return scipy.fft.irfftn(fixed_fft * np.conj(moving_fft), s=shape, axes=axes, workers=workers)
+
+
+def downsample_xy(volume, factor):
+    """xy 方向 factor×factor 块平均，volume 为 (..., y, x, z)"""
+    ny, nx = volume.shape[-3] // factor, volume.shape[-2] // factor
+    cropped = volume[..., :ny * factor, :nx * factor, :].astype(np.float64)
+    return cropped.reshape(volume.shape[:-3] + (ny, factor, nx, factor, volume.shape[-1])).mean(axis=(-4, -2))
+
+
+def estimate_shifts_full(fixed, moving_rounds, workers):
+    """全分辨率，与 DFTRegister3D 相同；moving_rounds 为 {轮次: (y, x, z)}"""
+    shape = fixed.shape
+    fixed_fft = scipy.fft.rfftn(fixed.astype(np.float64), workers=workers)
+    shifts = {}
+    for r, moving in moving_rounds.items():
+        peak = correlation_peak(np.abs(cross_correlation(fixed_fft, moving.astype(np.float64), shape, workers)))
+        shifts[r] = tuple(dft_shift(int(i), n) for i, n in zip(peak, shape))
+    return shifts
+
+
+def estimate_shifts_coarse_to_fine(fixed, moving_rounds, factor, refine_window, workers):
+    """先在降采样体积上对所有轮一起找峰，再在中心窗口的全分辨率互相关上细化"""
+    rounds = list(moving_rounds)
+    coarse_fixed = downsample_xy(fixed, factor)
+    coarse_moving = downsample_xy(np.stack([moving_rounds[r] for r in rounds]), factor)
+    coarse_shape = coarse_fixed.shape
+    cc = np.abs(cross_correlation(scipy.fft.rfftn(coarse_fixed, workers=workers), coarse_moving,
+                                  coarse_shape, workers))
+
+    ny, nx, nz = fixed.shape
+    wy, wx = min(refine_window, ny), min(refine_window, nx)
+    window = (slice((ny - wy) // 2, (ny - wy) // 2 + wy), slice((nx - wx) // 2, (nx - wx) // 2 + wx), slice(None))
+    fixed_window = fixed[window].astype(np.float64)
+    fixed_window_fft = scipy.fft.rfftn(fixed_window, workers=workers)
+    radius = (factor, factor, 1)
+
+    shifts = {}
+    for k, r in enumerate(rounds):
+        peak = correlation_peak(cc[k])
+        coarse = [dft_shift(i, n) for i, n in zip(peak, coarse_shape)]
+        start = (coarse[0] * factor, coarse[1] * factor, coarse[2])
+        # 先按粗平移整体移动，窗口内只剩小的残差
+        moving_window = np.roll(moving_rounds[r], start, axis=(0, 1, 2))[window].astype(np.float64)
+        residual_cc = np.abs(cross_correlation(fixed_window_fft, moving_window, fixed_window.shape, workers))
+        # 只在残差 ±radius 内找峰
+        offsets = [np.arange(-rad, rad + 1) for rad in radius]
+        local = residual_cc[np.ix_(*[np.mod(o, n) for o, n in zip(offsets, fixed_window.shape)])]
+        residual = correlation_peak(local)
+        total = [s + o[i] for s, o, i in zip(start, offsets, residual)]
+        shifts[r] = tuple(dft_shift(int(np.mod(s, n)), n) for s, n in zip(total, fixed.shape))
+    return shifts
+
+
+def estimate_shifts(volumes, ref_round, coarse_factor=1, refine_window=512, workers=1):
+    """volumes 为 (y, x, z, round) 的各轮通道最大投影，返回 {轮次: (行, 列, z) 平移}，轮次 1 起始"""
+    fixed = volumes[..., ref_round - 1]
+    moving_rounds = {r: volumes[..., r - 1] for r in range(1, volumes.shape[-1] + 1) if r != ref_round}
+    if not moving_rounds:
+        return {ref_round: (0, 0, 0)}
+    if coarse_factor > 1:
+        shifts = estimate_shifts_coarse_to_fine(fixed, moving_rounds, coarse_factor, refine_window, workers)
+    else:
+        shifts = estimate_shifts_full(fixed, moving_rounds, workers)
+    shifts[ref_round] = (0, 0, 0)
+    return dict(sorted(shifts.items()))
+
+
+def write_shifts(path, shifts):
+    path = Path(path)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w', newline='') as f:
+        f.write('round,row_shift,col_shift,z_shift\n')
+        for r, (row, col, z) in shifts.items():
+            f.write(f"{r},{row},{col},{z}\n")
+    tmp_path.replace(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="全局配准：估计各轮相对参考轮的整数平移（与 DFTRegister3D 相同）")
+    parser.add_argument('--input', required=True, help='各轮通道最大投影的 zarr 存储 (y, x, z, 1, round)')
+    parser.add_argument('--output', required=True, help='平移量 CSV（round,row_shift,col_shift,z_shift）')
+    parser.add_argument('--ref-round', type=int, default=1, help='参考轮（默认：1）')
+    parser.add_argument('--coarse-factor', type=int, default=1, help='粗配准的 xy 降采样倍数，1 为全分辨率（默认：1）')
+    parser.add_argument('--refine-window', type=int, default=512, help='细化窗口的 xy 大小（默认：512）')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('SLURM_CPUS_PER_TASK', 1)),
+                        help='FFT 线程数（默认：SLURM_CPUS_PER_TASK 或 1）')
+    args = parser.parse_args()
+
+    volumes = volume_store.open_volume(args.input)[:, :, :, 0, :]
+    shifts = estimate_shifts(volumes, args.ref_round, args.coarse_factor, args.refine_window, args.workers)
+    write_shifts(args.output, shifts)
+    for r, shift in shifts.items():
+        print(f"Round {r} vs. Round {args.ref_round}: shifted by {' '.join(map(str, shift))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""第 04 步局部拼接的 Python 实现，与 core_matlab 的 stitch 模式结果一致
+
+core_matlab 按子块顺序累积点表：每加入子块 t，先从已累积的点中去掉落在
+(x > upperleft_x(t)) & (y > upperleft_y(t)) 区域内的点，再加入子块 t 自己在该区域内的点。
+等价地，子块 t 的点被保留当且仅当它在子块 t 的区域内、且不在任何后续子块的区域内，
+这里对所有点一次性用向量化掩膜计算，并用进程池同时处理多个位置。
+
+可在编排器内运行（[LOCAL_STITCH] backend = python），某个位置的点检测结果齐全后立即合并，
+也可单独运行：python local_stitch.py --config config.ini
+"""
+import argparse
+import configparser
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from resume import is_output_fresh, registration_dir
+from spot_store import get_spot_format, remove_spot_store, spot_store_path, write_spots
+from subtile_planner import local_array_tasks, num_subtiles
+
+
+def merge_position(position_dir, num_subtiles, method, spot_format='csv'):
+    """合并一个位置的所有子块点文件，返回点数
+
+    写出 PositionXXX/goodPoints_<method>.csv 和/或 goodPoints_<method>.spots（按子块分组）。
+    """
+    position_dir = Path(position_dir)
+    interm_dir = position_dir / 'interm'
+    coords = pd.read_csv(interm_dir / f"coords_mat_{num_subtiles}.csv")
+    upper_left = coords[['upperleft_x', 'upperleft_y']].to_numpy()
+
+    tables = [pd.read_csv(interm_dir / f"goodPoints_{method}_t{t}_{num_subtiles}.csv")
+              for t in range(1, num_subtiles + 1)]
+    spots = pd.concat(tables, ignore_index=True)
+    subtile = np.repeat(np.arange(num_subtiles), [len(table) for table in tables])
+    x = spots.iloc[:, 0].to_numpy(dtype=np.float64)
+    y = spots.iloc[:, 1].to_numpy(dtype=np.float64)
+
+    keep = (x > upper_left[subtile, 0]) & (y > upper_left[subtile, 1])
+    for later in range(1, num_subtiles):
+        keep &= ~((subtile < later) & (x > upper_left[later, 0]) & (y > upper_left[later, 1]))
+
+    output = position_dir / f"goodPoints_{method}.csv"
+    # 先写 CSV 再写存储，读取方据修改时间判断存储是否过期
+    if spot_format in ('csv', 'both'):
+        tmp_output = output.with_suffix('.tmp')
+        spots[keep].to_csv(tmp_output, index=False)
+        tmp_output.replace(output)
+    if spot_format in ('npy', 'both'):
+        coords = spots.iloc[:, :3].to_numpy()
+        genes = spots.iloc[:, 3].astype(str).to_numpy()
+        write_spots(spot_store_path(output),
+                    [(t + 1, coords[keep & (subtile == t)], genes[keep & (subtile == t)]) for t in range(num_subtiles)])
+    else:
+        remove_spot_store(output)
+    return int(keep.sum())
+
+
+def pool_workers(config):
+    """进程数：ls_parallel_tasks，不超过本作业可用的 CPU 数"""
+    return max(1, min(config.getint('LOCAL_STITCH', 'ls_parallel_tasks', fallback=1),
+                      len(os.sched_getaffinity(0))))
+
+
+class LocalStitchRunner:
+    """在编排器内运行第 04 步
+
+    每次 monitor 轮询时调用 poll()：点检测输出齐全（且本次重跑的子块已重新写出）的位置
+    立即交给进程池合并。上游步骤全部结束后，输出仍不完整的位置记为失败，
+    合并后又被重写的点文件会再合并一次。全部完成后释放以 --hold 提交的下游作业，
+    有失败时取消它们。
+    """
+
+    def __init__(self, config, positions, monitor, upstream_steps=(), rerun_tasks=()):
+        self.config = config
+        self.monitor = monitor
+        self.upstream_steps = list(upstream_steps)
+        self.rerun_tasks = set(rerun_tasks)
+        self.start_time = time.time()
+        self.subtiles = num_subtiles(config)
+        self.num_tasks = local_array_tasks(config)
+        self.method = config['LOCAL_STITCH']['spotfinding_method']
+        self.spot_format = get_spot_format(config, 'LOCAL_STITCH')
+        self.pending = list(positions)
+        self.futures = {}
+        self.merged = []
+        self.failed = []
+        self.held = []  # 等待本步骤完成的下游作业
+        self.rechecked = False
+        self.finished = False
+        self.success = True
+        self.executor = None
+
+    def _subtile_ready(self, task_id):
+        if not is_output_fresh(self.config, '03', task_id):
+            return False
+        if task_id not in self.rerun_tasks:
+            return True
+        # 本次重跑的子块必须在本次运行中重新写出
+        interm_dir = registration_dir(self.config) / f"Position{(task_id - 1) // self.subtiles + 1:03d}" / 'interm'
+        subtile = (task_id - 1) % self.subtiles + 1
+        output = interm_dir / f"goodPoints_{self.method}_t{subtile}_{self.subtiles}.csv"
+        return output.stat().st_mtime >= self.start_time
+
+    def _position_ready(self, position):
+        first = (position - 1) * self.subtiles + 1
+        last = min(position * self.subtiles, self.num_tasks)
+        return all(self._subtile_ready(task_id) for task_id in range(first, last + 1))
+
+    def _submit(self, position):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=pool_workers(self.config))
+        position_dir = registration_dir(self.config) / f"Position{position:03d}"
+        self.futures[position] = self.executor.submit(merge_position, str(position_dir), self.subtiles, self.method,
+                                                     self.spot_format)
+
+    def _collect(self):
+        for position, future in list(self.futures.items()):
+            if not future.done():
+                continue
+            del self.futures[position]
+            try:
+                count = future.result()
+                print(f"局部拼接 Position{position:03d} 完成：{count} 个点")
+                self.merged.append(position)
+            except Exception as e:
+                print(f"错误：局部拼接 Position{position:03d} 失败：{e}")
+                self.failed.append(position)
+
+    def _upstream_done(self):
+        return all(self.monitor.jobs[job_id]['done']
+                   for step_name in self.upstream_steps for job_id in self.monitor.step_jobs(step_name))
+
+    def _finish(self):
+        self.finished = True
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.failed:
+            self.success = False
+            print(f"局部拼接失败的位置：{', '.join(f'Position{p:03d}' for p in sorted(self.failed))}")
+            self.monitor.cancel(self.held)
+        elif self.held:
+            self.monitor.executor.release(self.held)
+            print(f"局部拼接已完成，释放下游作业 {', '.join(self.held)}")
+
+    def poll(self):
+        """返回是否仍有工作未完成"""
+        if self.finished:
+            return False
+        self._collect()
+        upstream_done = self._upstream_done()
+        for position in list(self.pending):
+            if self._position_ready(position):
+                self.pending.remove(position)
+                self._submit(position)
+            elif upstream_done:
+                print(f"错误：Position{position:03d} 的点检测结果不完整，无法局部拼接")
+                self.pending.remove(position)
+                self.failed.append(position)
+        if upstream_done and not self.pending and not self.futures:
+            # 合并之后又被重写（如重试）的点文件需要重新合并一次
+            stale = [p for p in self.merged if not is_output_fresh(self.config, '04', p)]
+            if stale and not self.rechecked:
+                self.rechecked = True
+                for position in stale:
+                    self.merged.remove(position)
+                    self._submit(position)
+                return True
+            self._finish()
+        return not self.finished
+
+
+def main():
+    parser = argparse.ArgumentParser(description="合并各位置子块的点（第 04 步）")
+    parser.add_argument('-c', '--config', default='config.ini', help='配置文件路径（默认：config.ini）')
+    parser.add_argument('--positions', type=int, nargs='*', help='只处理这些位置（默认：全部）')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    positions = args.positions or range(1, int(config['LOCAL_STITCH']['ls_array_tasks']) + 1)
+    subtiles = num_subtiles(config)
+    method = config['LOCAL_STITCH']['spotfinding_method']
+    spot_format = get_spot_format(config, 'LOCAL_STITCH')
+    position_dirs = [str(registration_dir(config) / f"Position{p:03d}") for p in positions]
+
+    with ProcessPoolExecutor(max_workers=pool_workers(config)) as executor:
+        results = executor.map(merge_position, position_dirs, [subtiles] * len(position_dirs),
+                               [method] * len(position_dirs), [spot_format] * len(position_dirs))
+        for position_dir, count in zip(position_dirs, results):
+            print(f"{Path(position_dir).name}: {count} 个点")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,22 @@
 #!/usr/bin/env python3
 import configparser
 import os
-import subprocess
 import sys
-import time
+import signal
 import shutil
 import argparse
 from pathlib import Path
-from generate_scripts import generate_scripts
+from generate_scripts import (generate_scripts, get_max_array_batch_size, split_array_batches,
+                              get_tasks_per_job, count_array_jobs, array_indices_for_tasks, combined_stitch_jobs)
+from slurm_monitor import JobMonitor
+from executors import EXECUTORS, SlurmExecutor, make_executor
+from retry import RetryPolicy
+from resume import ARRAY_TASK_KEYS, RESUME_SECTIONS, array_task_count, format_array_spec, plan_resume, record_completed
+from local_stitch import LocalStitchRunner
+from resource_planner import record_history
+from run_report import write_run_report
+from subtile_planner import local_array_tasks, num_subtiles
+from task_order import load_task_map, task_slots
 
 def parse_args():
     """解析命令行参数"""
@@ -26,6 +35,12 @@ def parse_args():
                         default='10',
                         choices=['01', '02', '03', '04', '05', '06', '07', '08', '09', '10'],
                         help='设置流程结束点（默认：10）')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='断点续跑：01-04 步只提交输出缺失或过期的任务')
+    parser.add_argument('--executor',
+                        choices=EXECUTORS,
+                        help='执行后端（默认读取 [EXECUTOR] backend，未设置时为 slurm）')
     return parser.parse_args()
 
 def get_config_value(config, section, option, default=None):
@@ -41,145 +56,359 @@ def load_config(config_file='config.ini'):
     config.read(config_file)
     return config
 
-def submit_and_wait_job(cmd, job_name):
-    """提交作业并等待完成"""
-    try:
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            print(f"错误：提交失败\n{result.stderr}")
-            return False
-        
-        job_id = result.stdout.strip().split()[-1]
-        print(f"{job_name}作业已提交 | ID: {job_id}")
-        
-        # 等待作业完成
-        while True:
-            status = subprocess.run(f"squeue -j {job_id} -h -o '%T'",
-                                  shell=True, capture_output=True, text=True)
-            if not status.stdout.strip():
-                print(f"{job_name} 已完成")
-                break
-            time.sleep(60)
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"提交{job_name}作业时出错：{e}")
-        return False
-
-def run_batch_jobs(config, script_prefix, section, prefix, step_name):
-    """运行批处理作业"""
-    array_tasks = int(config[section][f'{prefix}_array_tasks'])
+def submit_tracked_job(monitor, step_name, script, job_name=None, array=None, env=None,
+                       deps=(), resources=None, attempt=0, hold=False):
+    """提交作业并登记到 monitor，返回作业ID（失败返回None）
+
+    array     - --array 参数（含 %并发上限），None 时使用脚本中的设置
+    env       - 通过环境变量传给脚本的任务范围，如 {'OFFSET': 256, 'TASK_LIMIT': 272}
+    deps      - [(依赖类型, 作业ID)]
+    resources - 覆盖脚本中 #SBATCH 的资源，如 {'mem': '128G', 'time': '48:00:00'}
+    hold      - 以 --hold 提交，等待编排器释放
+    """
+    job_id = monitor.executor.submit(script, array=array, env=env, deps=deps, resources=resources,
+                                     hold=hold, kill_on_invalid_dep=monitor.kill_on_invalid_dep)
+    if job_id is not None:
+        print(f"{job_name or step_name}作业已提交 | ID: {job_id}")
+        monitor.track(job_id, step_name, script=script, array=array, env=dict(env or {}),
+                      deps=list(deps), resources=dict(resources or {}), attempt=attempt)
+    return job_id
+
+def split_parallel(parallel_tasks, sizes):
+    """按各作业的数组任务数用最大余数法分配共享的并发上限，总和等于上限
+
+    总任务数不超过上限时各作业不受限制（取其任务数）。分到 0 的作业以 --hold 提交，
+    由 monitor 在有空闲名额时按顺序释放，而不是取 1 使总和超过上限。
+    """
+    total = sum(sizes)
+    if total <= parallel_tasks:
+        return list(sizes)
+    quotas = [parallel_tasks * size // total for size in sizes]
+    by_remainder = sorted(range(len(sizes)), key=lambda i: (-(parallel_tasks * sizes[i] % total), i))
+    for i in by_remainder[:parallel_tasks - sum(quotas)]:
+        quotas[i] += 1
+    return quotas
+
+def submit_throttled_jobs(monitor, step_name, parallel_tasks, jobs):
+    """提交共享并发上限 parallel_tasks 的一组数组作业，jobs 为 [(键, 脚本, 作业名, 数组范围, 数组任务数, env, deps)]
+
+    返回 {键: 作业ID}；任一提交失败时取消已提交的作业并返回 None。
+    """
+    quotas = split_parallel(parallel_tasks, [job[4] for job in jobs])
+    job_ids = {}
+    held = []
+    for (key, script_name, job_name, array_range, _, env, deps), quota in zip(jobs, quotas):
+        job_id = submit_tracked_job(monitor, step_name, script_name, job_name, array=f"{array_range}%{max(1, quota)}",
+                                    env=env, deps=deps, hold=quota == 0)
+        if job_id is None:
+            monitor.cancel(list(job_ids.values()))
+            return None
+        job_ids[key] = job_id
+        if quota == 0:
+            held.append(job_id)
+    if len(job_ids) > 1:
+        monitor.add_throttle_group(list(job_ids.values()), parallel_tasks, held)
+    return job_ids
+
+def run_batch_jobs(config, script_prefix, section, prefix, step_name, monitor, deps=(), task_ids=None):
+    """同时提交所有批次的数组作业，返回作业ID列表（失败返回None）
+
+    各批次共享同一个并发上限 {prefix}_parallel_tasks：提交时按批次大小分配（分不到名额的批次暂停），
+    之后由 monitor 根据各批次实际运行情况动态调整。
+    每个数组任务依次处理 tasks_per_job 个任务，批次按数组任务划分，OFFSET 以任务计。
+    task_ids 不为 None 时只提交其中的任务（断点续跑），没有任务的批次跳过；
+    02/03 按 task_map.csv 排序时先换算成 slot。
+    """
+    array_tasks = local_array_tasks(config) if prefix == 'lr' else int(config[section][f'{prefix}_array_tasks'])
+    if task_ids is not None and prefix == 'lr':
+        task_ids = task_slots(load_task_map(config), task_ids)
     parallel_tasks = int(config[section][f'{prefix}_parallel_tasks'])
-    max_per_batch = 1000
-    num_batches = (array_tasks + max_per_batch - 1) // max_per_batch
+    tasks_per_job = get_tasks_per_job(config, section)
+    num_jobs = count_array_jobs(array_tasks, tasks_per_job)
+    batches = split_array_batches(num_jobs, get_max_array_batch_size(config))
     
-    for batch in range(1, num_batches + 1):
+    jobs = []
+    for batch, (job_offset, current_batch_size) in enumerate(batches, 1):
+        offset = job_offset * tasks_per_job
         script_name = f'{script_prefix}_batch{batch}.sh'
         script_path = Path(script_name)
         
         if not script_path.exists():
             print(f"错误：脚本文件 {script_path} 不存在")
-            return False
+            return None
         
-        offset = (batch - 1) * 1000
-        current_batch_size = min(1000, array_tasks - offset)
         array_range = f"1-{current_batch_size}"
-        
-        cmd = (f"sbatch --array={array_range}%{parallel_tasks} "
-               f"--export=ALL,OFFSET={offset} {script_name}")
-        
-        if not submit_and_wait_job(cmd, f"{step_name}批次 {batch}"):
-            return False
+        if task_ids is not None:
+            batch_tasks = [t for t in task_ids if offset < t <= offset + current_batch_size * tasks_per_job]
+            if not batch_tasks:
+                continue
+            indices = array_indices_for_tasks(batch_tasks, tasks_per_job, offset)
+            array_range = format_array_spec(indices)
+            current_batch_size = len(indices)
+        jobs.append((batch, script_name, f"{step_name}批次 {batch}", array_range, current_batch_size,
+                     {'OFFSET': offset}, deps))
+    
+    job_ids = submit_throttled_jobs(monitor, step_name, parallel_tasks, jobs)
+    return None if job_ids is None else list(job_ids.values())
+
+def run_streaming_jobs(config, script_prefix, step_name, monitor, upstream=None, task_ids=None):
+    """流水线模式：每个位置单独提交一个数组作业，返回 {位置编号: 作业ID}（失败返回None）
+
+    位置 k 的作业使用 OFFSET=(k-1)*子块数、TASK_LIMIT=k*子块数，与批处理脚本中
+    位置编号 = (任务号-1)/子块数+1 的映射一致；每个数组任务处理 tasks_per_job 个子块。
+    upstream 为 {位置编号: (依赖类型, 作业ID)}，只等待该位置的上游任务即可开始。
+    task_ids 不为 None 时只提交其中的任务（断点续跑），没有任务的位置跳过。
+    task_map.csv 只在每个位置内部排序，换算成 slot 后仍落在该位置的区间内。
+    """
+    array_tasks = local_array_tasks(config)
+    if task_ids is not None:
+        task_ids = task_slots(load_task_map(config), task_ids)
+    parallel_tasks = int(config['LOCAL_REGISTRATION']['lr_parallel_tasks'])
+    subtiles = num_subtiles(config)
+    tasks_per_job = get_tasks_per_job(config, 'LOCAL_REGISTRATION')
+    num_positions = (array_tasks + subtiles - 1) // subtiles
+    script_name = f'{script_prefix}_batch1.sh'
+    
+    if not Path(script_name).exists():
+        print(f"错误：脚本文件 {script_name} 不存在")
+        return None
+    
+    jobs = []
+    for position in range(1, num_positions + 1):
+        offset = (position - 1) * subtiles
+        current_size = min(subtiles, array_tasks - offset)
+        indices = list(range(1, count_array_jobs(current_size, tasks_per_job) + 1))
+        if task_ids is not None:
+            position_tasks = [t for t in task_ids if offset < t <= offset + current_size]
+            if not position_tasks:
+                continue
+            indices = array_indices_for_tasks(position_tasks, tasks_per_job, offset)
+        deps = [upstream[position]] if upstream and position in upstream else []
+        jobs.append((position, script_name, f"{step_name} Position{position:03d}", format_array_spec(indices),
+                     len(indices), {'OFFSET': offset, 'TASK_LIMIT': offset + current_size}, deps))
     
-    return True
+    return submit_throttled_jobs(monitor, step_name, parallel_tasks, jobs)
 
-def run_processing_pipeline(config, start_step=None, end_step=None):
-    """运行处理流程"""
-    # 定义处理步骤
-    steps = [
-        ('01_global_registration.sh', '全局配准'),
-        ('02_local_registration', '局部配准'),  # 注意这里只写前缀
-        ('03_spot_finding', '点检测'),  # 注意这里只写前缀
-        ('04_local_stitch.sh', '局部拼接'),
-        ('05_IF_registration.sh', 'IF配准')
-    ]
+def build_pipeline_graph(config):
+    """构建处理步骤的依赖图（DAG）
+
+    每个步骤为一个字典：
+        step   - 步骤编号（01-10），用于 --startfrom/--endwith 截取
+        first  - 合并多个步骤时的起始编号（默认与 step 相同）
+        script - 脚本文件名（02/03 只写前缀）
+        name   - 步骤名称
+        deps   - 所依赖步骤的 script 列表
+    """
+    steps = []
+    
+    def add_step(step, script, name, deps=(), first=None):
+        steps.append({'step': step, 'first': first or step, 'script': script, 'name': name, 'deps': list(deps)})
+    
+    # 转录组部分：逐级依赖
+    add_step('01', '01_global_registration.sh', '全局配准')
+    if config.getboolean('LOCAL_REGISTRATION', 'fused_spot_finding', fallback=False):
+        # 合并模式：局部配准和点检测在同一个 MATLAB 调用中完成，覆盖 02-03 两步
+        add_step('03', '02_local_registration_spot_finding', '局部配准+点检测', ['01_global_registration.sh'], first='02')
+        add_step('04', '04_local_stitch.sh', '局部拼接', ['02_local_registration_spot_finding'])
+    else:
+        add_step('02', '02_local_registration', '局部配准', ['01_global_registration.sh'])  # 注意这里只写前缀
+        add_step('03', '03_spot_finding', '点检测', ['02_local_registration'])  # 注意这里只写前缀
+        add_step('04', '04_local_stitch.sh', '局部拼接', ['03_spot_finding'])
+    
+    # IF配准只读取原始数据，与转录组部分互不依赖
+    add_step('05', '05_IF_registration.sh', 'IF配准')
     
     # 如果启用了IF2，添加IF2配准步骤
-    if config.getboolean('IF2_REGISTRATION', 'if2_enabled', fallback=False):
-        steps.append(('05_IF2_registration.sh', 'IF2配准'))
+    if2_registration = config.getboolean('IF2_REGISTRATION', 'if2_enabled', fallback=False)
+    if if2_registration:
+        add_step('05', '05_IF2_registration.sh', 'IF2配准')
     
-    # 添加拼接步骤
+    # 第一个蛋白拼接生成 TileConfiguration.registered.txt
     proteins = config['IF1_GLOBAL_STITCH']['proteins'].split(',')
     first_protein = proteins[0].strip()
-    steps.append((f'06_IF1_stitch_{first_protein}.srp', f'{first_protein}拼接'))
+    first_stitch = f'06_IF1_stitch_{first_protein}.srp'
+    add_step('06', first_stitch, f'{first_protein}拼接', ['05_IF_registration.sh'])
     
-    # 添加后续蛋白质的拼接步骤
-    for i, protein in enumerate(proteins[1:], 1):
-        protein = protein.strip()
-        steps.append((f'07_{i}_IF1_stitch_{protein}.srp', f'{protein}拼接'))
+    # 后续蛋白质只依赖第一个蛋白的拼接布局，彼此并行
+    if not config.getboolean('IF1_GLOBAL_STITCH', 'combined_fusion', fallback=False):
+        for i, protein in enumerate(proteins[1:], 1):
+            protein = protein.strip()
+            add_step('07', f'07_{i}_IF1_stitch_{protein}.srp', f'{protein}拼接', [first_stitch])
     
-    # 添加点拼接步骤
-    steps.append(('10_stitchpoint.srp', '点拼接'))
+    # 合并融合：多个蛋白在一个作业中依次融合
+    for script, step, targets in combined_stitch_jobs(config):
+        deps = [first_stitch]
+        if if2_registration and any(section == 'IF2_GLOBAL_STITCH' for section, *_ in targets):
+            deps.append('05_IF2_registration.sh')
+        add_step(step, script, f"{','.join(t[1] for t in targets)}合并拼接", deps)
     
     # 如果启用了IF2拼接，添加IF2拼接步骤
-    if config.getboolean('IF2_GLOBAL_STITCH', 'if2_enabled', fallback=False):
+    if (config.getboolean('IF2_GLOBAL_STITCH', 'if2_enabled', fallback=False)
+            and not config.getboolean('IF2_GLOBAL_STITCH', 'combined_fusion', fallback=False)):
+        deps = [first_stitch]
+        if if2_registration:
+            deps.append('05_IF2_registration.sh')
         proteins = config['IF2_GLOBAL_STITCH']['proteins'].split(',')
         for i, protein in enumerate(proteins, 1):
             protein = protein.strip()
-            steps.append((f'09_{i}_IF2_stitch_{protein}.srp', f'IF2 {protein}拼接'))
-    
-    # 找到起始步骤的索引
-    start_index = 0
-    if start_step:
-        for i, (step_file, _) in enumerate(steps):
-            if step_file.startswith(start_step):
-                start_index = i
-                break
-    
-    # 找到结束步骤的索引
-    end_index = len(steps)
-    if end_step:
-        for i, (step_file, _) in enumerate(steps):
-            if step_file.startswith(end_step):
-                end_index = i + 1
-                break
-    
-    # 从指定步骤开始执行，到指定步骤结束
-    for step_file, step_name in steps[start_index:end_index]:
-        print(f"\n开始执行{step_name}...")
+            add_step('09', f'09_{i}_IF2_stitch_{protein}.srp', f'IF2 {protein}拼接', deps)
+    
+    # 点拼接需要各位置的点结果和第一个蛋白的拼接布局
+    add_step('10', '10_stitchpoint.srp', '点拼接', ['04_local_stitch.sh', first_stitch])
+    
+    return steps
+
+def cut_pipeline_graph(steps, start_step=None, end_step=None):
+    """按起止步骤截取依赖图，范围外的依赖视为已完成；合并步骤与范围有交集即保留"""
+    start_step = start_step or '01'
+    end_step = end_step or '10'
+    selected = [dict(s) for s in steps if start_step <= s['step'] and s['first'] <= end_step]
+    selected_scripts = {s['script'] for s in selected}
+    for s in selected:
+        s['deps'] = [d for d in s['deps'] if d in selected_scripts]
+    return selected
+
+def run_processing_pipeline(config, start_step=None, end_step=None, resume=False, executor=None):
+    """运行处理流程：按依赖图一次性提交所有作业，再等待全部完成
+
+    executor 为执行后端（见 executors.py），默认提交到 Slurm。
+    """
+    steps = cut_pipeline_graph(build_pipeline_graph(config), start_step, end_step)
+    
+    # 流水线模式下 02/03 按位置逐个衔接，而不是等待上一步全部完成
+    streaming = config.getboolean('LOCAL_REGISTRATION', 'streaming', fallback=False)
+    
+    # 断点续跑：01-04 步只提交输出缺失或过期的任务
+    plan = plan_resume(config, [step['step'] for step in steps]) if resume else {}
+    
+    # 局部拼接可在编排器内用进程池完成，依赖它的作业先 --hold 提交，完成后释放
+    local_stitch_runner = None
+    in_process_steps = set()
+    if config.get('LOCAL_STITCH', 'backend', fallback='matlab').strip() == 'python':
+        in_process_steps.add('04_local_stitch.sh')
+    
+    # 步骤已按拓扑顺序排列，依次提交即可拿到上游作业ID
+    monitor = JobMonitor(executor if executor is not None else SlurmExecutor())
+    # 失败任务按 [RETRY] 自动重试；启用时由编排器而不是 Slurm 处理下游作业
+    retry = RetryPolicy(config, monitor, lambda *args, **kwargs: submit_tracked_job(monitor, *args, **kwargs))
+    monitor.kill_on_invalid_dep = not retry.enabled
+    submitted = {}
+    submitted_tasks = {}  # 步骤编号 -> 本次提交的任务号
+    position_deps = {}  # 步骤 -> {位置编号: (依赖类型, 该位置对应的作业或数组任务)}
+    for step in steps:
+        step_file, step_name = step['script'], step['name']
+        deps = [('afterok', job_id) for dep in step['deps'] for job_id in submitted[dep]]
+        hold = local_stitch_runner is not None and '04_local_stitch.sh' in step['deps']
+        task_ids = plan.get(step['step'])
+        print(f"\n提交{step_name}...")
         
-        if step_file == '02_local_registration':
-            # 处理局部配准的特殊情况
-            if not run_batch_jobs(config, '02_local_registration', 'LOCAL_REGISTRATION', 'lr', step_name):
-                print(f"{step_name}执行失败")
+        if step['step'] in RESUME_SECTIONS:
+            section = config[RESUME_SECTIONS[step['step']]]
+            num_tasks = array_task_count(config, step['step'])
+            submitted_tasks[step['step']] = task_ids if task_ids is not None else list(range(1, num_tasks + 1))
+            if task_ids is not None and not task_ids:
+                print(f"{step_name}的输出均已是最新，跳过")
+                submitted[step_file] = []
+                position_deps[step_file] = {}
+                continue
+        
+        if streaming and step_file in ('02_local_registration', '03_spot_finding', '02_local_registration_spot_finding'):
+            # 02（或合并步骤）的位置 k 等待 01 的第 k 个任务；03 的每个子块等待 02 中相同编号的子块
+            upstream = position_deps.get(step['deps'][0]) if step['deps'] else None
+            if step['deps'] and upstream is None:
+                print(f"错误：{step_name}的上游步骤不支持流水线模式")
+                monitor.cancel([job_id for ids in submitted.values() for job_id in ids])
                 return False
-            print(f"{step_name}执行完成")
+            if upstream and task_ids is not None and step_file == '03_spot_finding':
+                # 续跑时若某位置有 02 未重跑的子块，aftercorr 无对应任务，改为等待该位置整个作业
+                subtiles = num_subtiles(config)
+                rerun_02 = set(submitted_tasks.get('02', []))
+                upstream = dict(upstream)
+                for position, (_, job_id) in list(upstream.items()):
+                    position_tasks = [t for t in task_ids if (t - 1) // subtiles + 1 == position]
+                    if not rerun_02.issuperset(position_tasks):
+                        upstream[position] = ('afterok', job_id)
+            position_jobs = run_streaming_jobs(config, step_file, step_name, monitor, upstream, task_ids)
+            job_ids = None if position_jobs is None else list(position_jobs.values())
+            if position_jobs is not None:
+                position_deps[step_file] = {k: ('aftercorr', job_id) for k, job_id in position_jobs.items()}
+        elif step_file == '02_local_registration':
+            # 处理局部配准的特殊情况
+            job_ids = run_batch_jobs(config, '02_local_registration', 'LOCAL_REGISTRATION', 'lr', step_name, monitor, deps, task_ids)
         elif step_file == '03_spot_finding':
             # 处理点检测的特殊情况
-            if not run_batch_jobs(config, '03_spot_finding', 'LOCAL_REGISTRATION', 'lr', step_name):
-                print(f"{step_name}执行失败")
-                return False
-            print(f"{step_name}执行完成")
+            job_ids = run_batch_jobs(config, '03_spot_finding', 'LOCAL_REGISTRATION', 'lr', step_name, monitor, deps, task_ids)
+        elif step_file == '02_local_registration_spot_finding':
+            # 局部配准+点检测合并模式
+            job_ids = run_batch_jobs(config, '02_local_registration_spot_finding', 'LOCAL_REGISTRATION', 'lr', step_name, monitor, deps, task_ids)
+        elif step_file in in_process_steps:
+            # 在编排器内合并：各位置点检测完成后立即开始，不提交作业
+            upstream_steps = [s['name'] for s in steps if s['script'] in step['deps']]
+            local_stitch_runner = LocalStitchRunner(config, submitted_tasks['04'], monitor, upstream_steps,
+                                                    submitted_tasks.get('03', []))
+            print(f"{step_name}将在编排器内运行（{len(submitted_tasks['04'])} 个位置）")
+            job_ids = []
         else:
             script_path = Path(step_file)
             if not script_path.exists():
                 print(f"错误：脚本文件 {script_path} 不存在")
                 return False
             
-            # 提交作业并等待完成
-            cmd = f"sbatch --export=ALL {step_file}"
-            if not submit_and_wait_job(cmd, step_name):
-                return False
+            array = None
+            if task_ids is not None:
+                parallel_key = ARRAY_TASK_KEYS[step['step']].replace('_array_tasks', '_parallel_tasks')
+                tasks_per_job = get_tasks_per_job(config, RESUME_SECTIONS[step['step']])
+                indices = array_indices_for_tasks(task_ids, tasks_per_job)
+                array = f"{format_array_spec(indices)}%{section[parallel_key]}"
+            job_id = submit_tracked_job(monitor, step_name, step_file, array=array, deps=deps, hold=hold)
+            job_ids = None if job_id is None else [job_id]
+            if job_id is not None and hold:
+                local_stitch_runner.held.append(job_id)
+            if job_id is not None and step_file == '01_global_registration.sh':
+                # 全局配准的第 (k-1)//tasks_per_job+1 个数组任务处理 Position k
+                tasks_per_job = get_tasks_per_job(config, 'GLOBAL_REGISTRATION')
+                position_deps[step_file] = {k: ('afterok', f"{job_id}_{(k - 1) // tasks_per_job + 1}")
+                                            for k in submitted_tasks['01']}
+        
+        if job_ids is None:
+            print(f"{step_name}提交失败")
+            monitor.cancel([job_id for ids in submitted.values() for job_id in ids])
+            return False
+        submitted[step_file] = job_ids
     
-    return True
+    # 统一监控所有作业，任一步骤失败即提前停止该步骤
+    on_poll = local_stitch_runner.poll if local_stitch_runner is not None else None
+    try:
+        success = monitor.wait(on_failure=retry, on_poll=on_poll)
+    except BaseException:
+        # 编排器提前退出（Ctrl-C、run_main.sh 超时）后没有人再取消下游作业，
+        # 关闭 --kill-on-invalid-dep 时依赖已失败作业的作业会一直排队，退出前先取消
+        if not monitor.kill_on_invalid_dep:
+            monitor.cancel(monitor.orphans())
+        raise
+    if local_stitch_runner is not None:
+        success = success and local_stitch_runner.success
+    
+    # 记录本次生成的结果所用的配置，供下次续跑判断是否过期
+    record_completed(config, submitted_tasks)
+    # 记录各作业实际的内存和运行时间，下次生成脚本时据此设置资源
+    record_history(config, monitor, {script: len(targets) for script, _, targets in combined_stitch_jobs(config)})
+    # 各作业和数组任务的记账信息、关键路径和排队/运行时间
+    write_run_report(steps, monitor)
+    return success
 
 def main():
+    # run_main.sh 超时或被 scancel 时 Slurm 发送 SIGTERM，转为 SystemExit 以便退出前清理排队的作业
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit("编排器收到 SIGTERM，已退出"))
     args = parse_args()
-    
-    if not os.getenv('SLURM_JOB_ID'):
-        sys.exit("请使用『sbatch run_main.sh』提交作业！")
-
     config = load_config(args.config)
+    try:
+        executor = make_executor(config, args.executor)
+    except ValueError as e:
+        sys.exit(str(e))
+    
+    if executor.name == 'slurm' and not os.getenv('SLURM_JOB_ID'):
+        print("警告：编排器不在 Slurm 作业中运行，需保持本进程直到流程结束（建议『sbatch run_main.sh』提交）")
     
     os.environ.update({
         'MATLAB_SRC': get_config_value(config, 'PROJECT', 'matlab_src'),
@@ -192,7 +421,7 @@ def main():
     print(f"脚本已生成到目录: {script_dir}")
     
     # 运行处理流程
-    if not run_processing_pipeline(config, args.startfrom, args.endwith):
+    if not run_processing_pipeline(config, args.startfrom, args.endwith, args.resume, executor):
         sys.exit("处理流程执行失败")
 
 if __name__ == "__main__":
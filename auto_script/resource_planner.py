@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""按数据尺寸估计各步骤 Slurm 作业的资源
+
+内存按每个数组任务要处理的体积估计：位置（或子块）的 5-D uint8 数组 (y, x, z, channel, round)、
+预处理和配准时产生的副本，以及 FFT 的双精度复数缓冲区；CPU 数取与内存相称的核数
+（分区每核内存，如 C64M512G 为 8G/核），使作业按比例占用节点；运行时间按数据量粗略估计。
+
+编排器在流程结束后把各作业的 sacct MaxRSS/Elapsed 追加到
+<project_root>/<project_name>/02_registration/.resource_history.csv。
+同一步骤、相同数据尺寸有历史记录时，改用历史最大值加余量。
+估计值只用于调高资源：没有历史记录时核数、内存和运行时间都不低于原来的固定值
+（-c 8 --mem=64G --time=24:00:00；Fiji 拼接为 -c 16，内存为 16 核对应的分区内存），
+有了实测用量之后才会降低。
+
+[RESOURCES] 中的 <步骤>_partition、<步骤>_cpus、<步骤>_mem、<步骤>_time 优先于估计值。
+"""
+import csv
+import json
+import math
+import re
+
+from resume import registration_dir
+from retry import format_memory, format_time, parse_memory, parse_time
+from slurm_monitor import split_job_id
+from subtile_planner import grid_label, plan_subtiles
+
+DEFAULT_PARTITION = 'C64M512G'
+HISTORY_NAME = '.resource_history.csv'
+HISTORY_COLUMNS = ['step', 'signature', 'job_id', 'task', 'tasks_per_job', 'max_rss_mb', 'elapsed_min']
+
+# 脚本文件名前缀 -> 步骤（按顺序匹配，长前缀在前）
+SCRIPT_STEPS = [
+    ('01_global_registration', 'global_registration'),
+    ('02_local_registration_spot_finding', 'local_registration_spot_finding'),
+    ('02_local_registration', 'local_registration'),
+    ('03_spot_finding', 'spot_finding'),
+    ('04_local_stitch', 'local_stitch'),
+    ('05_IF2_registration', 'IF2_registration'),
+    ('05_IF_registration', 'IF_registration'),
+    ('06_', 'first_stitch'),
+    ('07_', 'stitch'),
+    ('09_', 'IF2_stitch'),
+    ('10_stitchpoint', 'stitchpoint'),
+]
+
+MB = 1024 * 1024
+GB = 1024 * MB
+# MATLAB / JVM 进程本身的内存
+MATLAB_OVERHEAD = 3 * GB
+PYTHON_OVERHEAD = 1 * GB
+FIJI_OVERHEAD = 8 * GB
+
+# 原来固定的资源：{步骤: 核数}（默认 8），内存 64G 或核数对应的分区内存中较大者，运行时间 24 小时
+BASELINE_CPUS = {'first_stitch': 16, 'stitch': 16, 'IF2_stitch': 16}
+BASELINE_MEM_MB = 64 * 1024
+BASELINE_MINUTES = 24 * 60
+
+
+def script_step(script):
+    """脚本文件名 -> 步骤，无法识别时返回 None"""
+    for prefix, step in SCRIPT_STEPS:
+        if str(script).startswith(prefix):
+            return step
+    return None
+
+
+def partition_mem_per_cpu(config, partition):
+    """每核内存（MB）：[RESOURCES] mem_per_cpu，否则由分区名 C<核数>M<内存>G 推出，默认 8G"""
+    value = config.get('RESOURCES', 'mem_per_cpu', fallback='').strip()
+    if value:
+        return parse_memory(value)
+    match = re.fullmatch(r'C(\d+)M(\d+)G', partition.strip())
+    if match:
+        return int(match.group(2)) * 1024 // int(match.group(1))
+    return 8 * 1024
+
+
+def baseline_resources(step, mem_per_cpu):
+    """没有历史记录时的下限，返回 (核数, 内存 MB, 分钟)"""
+    cpus = BASELINE_CPUS.get(step, 8)
+    return cpus, max(BASELINE_MEM_MB, cpus * mem_per_cpu), BASELINE_MINUTES
+
+
+def registration_estimate(width, depth, channels, rounds, backend='matlab'):
+    """全局/IF 配准：原始与配准后各一份 5-D 数组、一份预处理副本，加每轮 FFT 缓冲区"""
+    volume = width * width * depth * channels * rounds
+    plane = width * width * depth
+    if backend == 'python':
+        # MATLAB 只做预处理和平移，FFT 在 global_registration.py 中进行（各轮最大投影 + 实数 FFT）
+        mem = 3 * volume + rounds * plane + 32 * plane + MATLAB_OVERHEAD + PYTHON_OVERHEAD
+    else:
+        # DFTRegister3D：两个复数 FFT、乘积和逆变换，每个 16 字节/体素
+        mem = 3 * volume + 64 * plane + MATLAB_OVERHEAD
+    return mem, 5 + 15 * volume / GB
+
+
+def subtile_estimate(step, sub_x, sub_y, depth, channels, rounds):
+    """02/03 的单个 sub_x × sub_y 子块"""
+    volume = sub_x * sub_y * depth * channels * rounds
+    plane = sub_x * sub_y * depth
+    registration = 3 * volume + 64 * plane
+    # max3d：每个通道一份双精度副本和区域极大值掩码
+    spots = 2 * volume + 9 * plane * channels
+    mem = {'local_registration': registration, 'spot_finding': spots,
+           'local_registration_spot_finding': max(registration, spots) + volume}[step]
+    minutes = 5 + (40 if step == 'local_registration_spot_finding' else 20) * volume / GB
+    return mem + MATLAB_OVERHEAD, minutes
+
+
+def fusion_estimate(config, section, width, depth, backend):
+    """单个蛋白的 IF 融合：Fiji 在内存中保存全部位置和融合结果（16 位），python 只保存分块"""
+    stitch = config['IF1_GLOBAL_STITCH']
+    tiles = int(stitch.get('grid_size_x', '1')) * int(stitch.get('grid_size_y', '1'))
+    fused = tiles * width * width * depth * 2
+    if backend == 'python':
+        chunk = int(config.get(section, 'fusion_chunk', fallback=stitch.get('fusion_chunk', '1024')))
+        workers = int(config.get(section, 'fusion_workers', fallback=stitch.get('fusion_workers', '16')))
+        # 每个线程：单精度累加、权重和各位置的窗口
+        mem = workers * chunk * chunk * depth * 4 * 4 + PYTHON_OVERHEAD
+    else:
+        mem = 2 * fused + FIJI_OVERHEAD
+    return mem, 30 + 10 * fused / GB
+
+
+def estimate(config, step, proteins=1):
+    """返回 {'mem': 字节, 'cpus': 最少核数, 'minutes': 每个任务的分钟数, 'tasks_per_job': n, 'signature': 尺寸}
+
+    合并拼接作业中各蛋白依次融合，proteins 为蛋白数，作为该作业的任务数。
+    """
+    def dims(section, prefix=''):
+        s = config[section]
+        return [int(s[f'{prefix}image_width']), int(s[f'{prefix}image_depth']),
+                int(s[f'{prefix}channel_num']), int(s[f'{prefix}round_num'])]
+
+    tasks_per_job = 1
+    cpus = 4
+    if step == 'global_registration':
+        section = config['GLOBAL_REGISTRATION']
+        backend = section.get('registration_backend', 'matlab').strip()
+        signature = dims('GLOBAL_REGISTRATION') + [backend]
+        mem, minutes = registration_estimate(*signature)
+        tasks_per_job = section.getint('tasks_per_job', fallback=1)
+    elif step in ('local_registration', 'spot_finding', 'local_registration_spot_finding'):
+        section = config['LOCAL_REGISTRATION']
+        plan = plan_subtiles(config)
+        signature = dims('LOCAL_REGISTRATION') + [grid_label(plan) if plan['planned'] else int(section['sqrt_pieces'])]
+        mem, minutes = subtile_estimate(step, plan['subtile_x'], plan['subtile_y'], *signature[1:4])
+        if step != 'local_registration':
+            signature.append(section.get('spotfinding_method', 'max3d').strip())
+        tasks_per_job = section.getint('tasks_per_job', fallback=1)
+    elif step == 'local_stitch':
+        section = config['LOCAL_STITCH']
+        signature = [int(section['sqrt_pieces'])]
+        mem, minutes, cpus = 4 * GB, 10, 1
+        tasks_per_job = section.getint('tasks_per_job', fallback=1)
+    elif step in ('IF_registration', 'IF2_registration'):
+        name = 'IF_REGISTRATION' if step == 'IF_registration' else 'IF2_REGISTRATION'
+        signature = dims(name, 'ir_')
+        mem, minutes = registration_estimate(*signature)
+        tasks_per_job = config[name].getint('tasks_per_job', fallback=1)
+    elif step in ('first_stitch', 'stitch', 'IF2_stitch'):
+        section = 'IF2_GLOBAL_STITCH' if step == 'IF2_stitch' else 'IF1_GLOBAL_STITCH'
+        registration = config['IF2_REGISTRATION' if step == 'IF2_stitch' else 'IF_REGISTRATION']
+        width, depth = int(registration['ir_image_width']), int(registration['ir_image_depth'])
+        # 第一个蛋白总是由 Fiji 计算拼接布局
+        backend = 'fiji' if step == 'first_stitch' else config.get(
+            section, 'fusion_backend', fallback=config.get('IF1_GLOBAL_STITCH', 'fusion_backend', fallback='fiji')).strip()
+        signature = [width, depth, config['IF1_GLOBAL_STITCH'].get('grid_size_x', '1'),
+                     config['IF1_GLOBAL_STITCH'].get('grid_size_y', '1'), backend]
+        mem, minutes = fusion_estimate(config, section, width, depth, backend)
+        cpus = 16
+        tasks_per_job = proteins
+    elif step == 'stitchpoint':
+        section = config['IF1_GLOBAL_STITCH']
+        cpus = section.getint('point_stitch_workers', fallback=8)
+        signature = [section.get('point_stitch_backend', 'matlab').strip(), config['LOCAL_STITCH']['sqrt_pieces']]
+        mem, minutes = 16 * GB, 120
+    else:
+        raise ValueError(f"未知的资源步骤：{step}")
+    return {'mem': mem, 'cpus': cpus, 'minutes': minutes, 'tasks_per_job': max(1, tasks_per_job),
+            'signature': json.dumps(signature)}
+
+
+def history_path(config):
+    return registration_dir(config) / HISTORY_NAME
+
+
+def load_history(config):
+    """读取历史记录，返回 {(步骤, 尺寸): [行]}"""
+    if not config.getboolean('RESOURCES', 'use_history', fallback=True):
+        return {}
+    path = history_path(config)
+    if not path.exists():
+        return {}
+    history = {}
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            history.setdefault((row['step'], row['signature']), []).append(row)
+    return history
+
+
+def history_resources(rows, tasks_per_job, margin):
+    """历史最大 RSS 和单任务最长运行时间乘以余量，返回 (内存 MB, 分钟)"""
+    mem = max(float(row['max_rss_mb']) for row in rows) * margin
+    per_task = max(float(row['elapsed_min']) / max(1, int(row['tasks_per_job'])) for row in rows)
+    return int(mem), per_task * tasks_per_job * margin
+
+
+def plan_resources(config, step, history=None, proteins=1):
+    """返回 {'partition', 'cpus', 'mem', 'time'}，均为 #SBATCH 可用的字符串
+
+    history 为 load_history 的结果，None 时读取本地历史记录。
+    """
+    if history is None:
+        history = load_history(config)
+    partition = config.get('RESOURCES', 'partition', fallback=DEFAULT_PARTITION).strip()
+    partition = config.get('RESOURCES', f'{step}_partition', fallback=partition).strip()
+    mem_per_cpu = partition_mem_per_cpu(config, partition)
+    max_mem = parse_memory(config.get('RESOURCES', 'max_mem', fallback='500G'))
+    min_time = parse_time(config.get('RESOURCES', 'min_time', fallback='01:00:00'))
+    max_time = parse_time(config.get('RESOURCES', 'max_time', fallback='24:00:00'))
+
+    plan = estimate(config, step, proteins)
+    rows = history.get((step, plan['signature']))
+    min_cpus = plan['cpus']
+    if rows:
+        mem, minutes = history_resources(rows, plan['tasks_per_job'],
+                                         config.getfloat('RESOURCES', 'history_margin', fallback=1.3))
+        mem += 512
+    else:
+        safety = config.getfloat('RESOURCES', 'safety_factor', fallback=1.5)
+        mem = int(plan['mem'] * safety / MB)
+        minutes = plan['minutes'] * plan['tasks_per_job'] * 2 * safety
+        # 估计值偏小的代价是 OOM 或超时，没有实测用量时不低于原来的固定资源
+        baseline_cpus, baseline_mem, baseline_minutes = baseline_resources(step, mem_per_cpu)
+        min_cpus = max(min_cpus, baseline_cpus)
+        mem = max(mem, baseline_mem)
+        minutes = max(minutes, baseline_minutes)
+    # 以 G 为单位取整，并不超过上限
+    mem = min(max(4, math.ceil(mem / 1024)) * 1024, max_mem)
+    minutes = min(max(min_time, math.ceil(minutes / 30) * 30), max_time)
+
+    overrides = {key: config.get('RESOURCES', f'{step}_{key}', fallback='').strip() for key in ('cpus', 'mem', 'time')}
+    if overrides['mem']:
+        mem = parse_memory(overrides['mem'])
+    if overrides['time']:
+        minutes = parse_time(overrides['time'])
+    cpus = int(overrides['cpus']) if overrides['cpus'] else max(min_cpus, math.ceil(mem / mem_per_cpu))
+    return {'partition': partition, 'cpus': str(cpus), 'mem': format_memory(mem), 'time': format_time(minutes)}
+
+
+def query_usage(executor, job_ids):
+    """sacct 查询作业的 MaxRSS（MB，取各作业步最大值）和 Elapsed（分钟），返回 {(作业ID, 任务号): (MB, 分钟)}"""
+    lines = executor.accounting(job_ids, ['JobID', 'State', 'Elapsed', 'MaxRSS'])
+    if lines is None:
+        return {}
+    usage = {}
+    completed = set()
+    for fields in lines:
+        raw_id, _, job_step = fields[0].partition('.')
+        key = split_job_id(raw_id)
+        rss, elapsed = usage.get(key, (0, 0))
+        if not job_step:
+            # 作业本身的一行：运行时间和最终状态
+            elapsed = parse_time(fields[2]) if fields[2] else 0
+            if fields[1].strip().startswith('COMPLETED'):
+                completed.add(key)
+        elif fields[3].strip():
+            rss = max(rss, parse_memory(fields[3]))
+        usage[key] = (rss, elapsed)
+    return {key: value for key, value in usage.items() if key in completed and value[0] > 0}
+
+
+def record_history(config, monitor, proteins_per_script=None):
+    """把 monitor 中成功结束的作业的实际资源用量追加到本地历史记录
+
+    proteins_per_script 为合并拼接脚本 -> 蛋白数，用于把运行时间折算到单个蛋白。
+    """
+    if not registration_dir(config).exists() or not monitor.jobs:
+        return
+    usage = query_usage(monitor.executor, list(monitor.jobs))
+    rows = []
+    for job_id, job in monitor.jobs.items():
+        step = script_step(job['info'].get('script', ''))
+        if step is None:
+            continue
+        script = job['info']['script']
+        plan = estimate(config, step, (proteins_per_script or {}).get(script, 1))
+        for (used_id, task), (rss, elapsed) in sorted(usage.items(), key=lambda item: str(item[0])):
+            if used_id == job_id:
+                rows.append({'step': step, 'signature': plan['signature'], 'job_id': job_id, 'task': task or '',
+                             'tasks_per_job': plan['tasks_per_job'], 'max_rss_mb': rss, 'elapsed_min': elapsed})
+    if not rows:
+        return
+    path = history_path(config)
+    is_new = not path.exists()
+    with open(path, 'a', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=HISTORY_COLUMNS)
+        if is_new:
+            writer.writeheader()
+        writer.writerows(rows)
+    print(f"已记录 {len(rows)} 个任务的资源用量到 {path}")
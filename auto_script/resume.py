@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""基于中间结果的断点续跑
+
+检查 01-04 步每个数组任务的输出文件是否存在、是否比其输入新，
+以及生成它们时所用的配置段哈希是否与当前配置一致，
+只重新提交缺失或过期的任务。
+"""
+import hashlib
+import json
+from pathlib import Path
+
+from spot_store import get_spot_format, spot_outputs
+from subtile_planner import local_array_tasks, num_subtiles
+
+# 各步骤对应的配置段
+RESUME_SECTIONS = {
+    '01': 'GLOBAL_REGISTRATION',
+    '02': 'LOCAL_REGISTRATION',
+    '03': 'LOCAL_REGISTRATION',
+    '04': 'LOCAL_STITCH',
+}
+# 各步骤数组任务数的配置项
+ARRAY_TASK_KEYS = {
+    '01': 'gr_array_tasks',
+    '02': 'lr_array_tasks',
+    '03': 'lr_array_tasks',
+    '04': 'ls_array_tasks',
+}
+# 只影响调度、不影响结果的配置项，不参与哈希
+SCHEDULING_KEYS = {'streaming', 'max_array_size', 'tasks_per_job', 'fused_spot_finding', 'save_registered',
+                   'volume_format', 'backend', 'spotfinding_backend', 'registration_backend', 'task_order',
+                   'decoding_backend'}
+SCHEDULING_SUFFIXES = ('_array_tasks', '_parallel_tasks')
+
+MANIFEST_NAME = '.resume_manifest.json'
+
+
+def registration_dir(config):
+    """<project_root>/<project_name>/02_registration，与 core_matlab 的 output_path 一致"""
+    return Path(config['PROJECT']['project_root']) / config['PROJECT']['project_name'] / '02_registration'
+
+
+def config_section_hash(config, section):
+    """对影响结果的配置项求哈希"""
+    items = sorted((key, value.strip()) for key, value in config.items(section)
+                   if key not in SCHEDULING_KEYS and not key.endswith(SCHEDULING_SUFFIXES)
+                   and key not in config.defaults())
+    return hashlib.sha1(json.dumps(items).encode('utf-8')).hexdigest()[:16]
+
+
+def load_manifest(config):
+    path = registration_dir(config) / MANIFEST_NAME
+    if not path.exists():
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(config, manifest):
+    out_dir = registration_dir(config)
+    if not out_dir.exists():
+        return
+    path = out_dir / MANIFEST_NAME
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    tmp_path.replace(path)
+
+
+def array_task_count(config, step):
+    """步骤的任务数；02/03 由子块划分决定"""
+    if step in ('02', '03'):
+        return local_array_tasks(config)
+    return int(config[RESUME_SECTIONS[step]][ARRAY_TASK_KEYS[step]])
+
+
+def task_position(config, step, task_id):
+    """数组任务号 -> (位置编号, 子块编号)；01/04 的任务号即位置编号"""
+    if step in ('01', '04'):
+        return task_id, None
+    subtiles = num_subtiles(config)
+    return (task_id - 1) // subtiles + 1, (task_id - 1) % subtiles + 1
+
+
+def local_registration_marker(interm_dir, subtile, subtiles):
+    """core_matlab 局部配准写完子块 .mat 后写出的空文件"""
+    return Path(interm_dir) / f"localRegistered_t{subtile}_{subtiles}.done"
+
+
+def task_files(config, step, task_id):
+    """返回任务的 (输出文件列表, 输入文件列表)"""
+    section = config[RESUME_SECTIONS[step]]
+    subtiles = num_subtiles(config)
+    position, subtile = task_position(config, step, task_id)
+    position_dir = registration_dir(config) / f"Position{position:03d}"
+    interm_dir = position_dir / 'interm'
+    coords = interm_dir / f"coords_mat_{subtiles}.csv"
+
+    if config.get('GLOBAL_REGISTRATION', 'volume_format', fallback='mat').strip() == 'zarr':
+        # zarr 存储的 .zarray 最后写入，以它的存在和修改时间代表整个存储
+        global_store = interm_dir / 'registeredImages.zarr' / '.zarray'
+        subtile_store = interm_dir / f"registeredImages_t{subtile}_{subtiles}.zarr" / '.zarray'
+        if step == '01':
+            return [global_store, coords], []
+        if step == '02':
+            return [subtile_store], [global_store, coords]
+        if step == '03':
+            method = section['spotfinding_method']
+            return ([interm_dir / f"goodPoints_{method}_t{subtile}_{subtiles}.csv"],
+                    [subtile_store, global_store])
+    if step == '01':
+        outputs = [interm_dir / f"registeredImages_t{t}_{subtiles}.mat" for t in range(1, subtiles + 1)]
+        return outputs + [coords], []
+    if step == '02':
+        # 局部配准覆盖全局配准写出的同名 .mat，只有局部配准写出的标记文件能说明这一步已完成
+        return [interm_dir / f"registeredImages_t{subtile}_{subtiles}.mat",
+                local_registration_marker(interm_dir, subtile, subtiles)], [coords]
+    method = section['spotfinding_method']
+    if step == '03':
+        return ([interm_dir / f"goodPoints_{method}_t{subtile}_{subtiles}.csv"],
+                [interm_dir / f"registeredImages_t{subtile}_{subtiles}.mat"])
+    return (spot_outputs(position_dir / f"goodPoints_{method}.csv", get_spot_format(config, 'LOCAL_STITCH')),
+            [interm_dir / f"goodPoints_{method}_t{t}_{subtiles}.csv" for t in range(1, subtiles + 1)])
+
+
+def is_output_fresh(config, step, task_id):
+    """输出全部存在且比所有输入新（修改时间相同视为过期）"""
+    outputs, inputs = task_files(config, step, task_id)
+    if not all(path.exists() for path in outputs):
+        return False
+    oldest_output = min(path.stat().st_mtime for path in outputs)
+    return all(not path.exists() or path.stat().st_mtime < oldest_output for path in inputs)
+
+
+def is_task_stale(config, step, task_id, manifest):
+    if not is_output_fresh(config, step, task_id):
+        return True
+    # 没有记录的已有结果（如旧版本生成）视为有效
+    recorded = manifest.get(step, {}).get(str(task_id))
+    return recorded is not None and recorded != config_section_hash(config, RESUME_SECTIONS[step])
+
+
+def plan_resume(config, step_numbers):
+    """计算需要重新运行的任务，返回 {步骤编号: [任务号]}
+
+    上游重跑的任务会使下游对应任务一并重跑。
+    """
+    manifest = load_manifest(config)
+    plan = {}
+    for step in sorted(step_numbers):
+        if step not in RESUME_SECTIONS:
+            continue
+        num_tasks = array_task_count(config, step)
+        tasks = {task_id for task_id in range(1, num_tasks + 1)
+                 if is_task_stale(config, step, task_id, manifest)}
+
+        if step == '02' and '01' in plan:
+            tasks |= {task_id for task_id in range(1, num_tasks + 1)
+                      if task_position(config, step, task_id)[0] in plan['01']}
+        elif step == '03' and '02' in plan:
+            tasks |= {task_id for task_id in plan['02'] if task_id <= num_tasks}
+        elif step == '03' and '01' in plan:
+            # 合并模式没有单独的 02 步，01 重跑的位置直接传到 03
+            tasks |= {task_id for task_id in range(1, num_tasks + 1)
+                      if task_position(config, step, task_id)[0] in plan['01']}
+        elif step == '04' and '03' in plan:
+            tasks |= {task_position(config, '03', task_id)[0] for task_id in plan['03']
+                      if task_position(config, '03', task_id)[0] <= num_tasks}
+        plan[step] = sorted(tasks)
+    return plan
+
+
+def record_completed(config, submitted_tasks):
+    """把本次运行后输出有效的任务记录为当前配置生成"""
+    manifest = load_manifest(config)
+    for step, task_ids in submitted_tasks.items():
+        if step not in RESUME_SECTIONS:
+            continue
+        section_hash = config_section_hash(config, RESUME_SECTIONS[step])
+        step_manifest = manifest.setdefault(step, {})
+        for task_id in task_ids:
+            if is_output_fresh(config, step, task_id):
+                step_manifest[str(task_id)] = section_hash
+    save_manifest(config, manifest)
+
+
+def format_array_spec(task_ids, offset=0):
+    """[1,2,3,7,9,10] -> '1-3,7,9-10'（任务号减去 offset）"""
+    ids = sorted(task_id - offset for task_id in task_ids)
+    ranges = []
+    for task_id in ids:
+        if ranges and task_id == ranges[-1][1] + 1:
+            ranges[-1][1] = task_id
+        else:
+            ranges.append([task_id, task_id])
+    return ','.join(f"{first}-{last}" if first != last else f"{first}" for first, last in ranges)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""失败数组任务的自动重试
+
+通过 sacct 得到的失败原因（OUT_OF_MEMORY、TIMEOUT、NODE_FAIL 等）决定是否重试，
+只重新提交失败的数组任务号，并按原因提高内存或运行时间，
+同时把下游作业对原作业的依赖改为等待重试作业。
+"""
+import re
+
+DEFAULT_RETRY_STATES = 'OUT_OF_MEMORY, TIMEOUT, NODE_FAIL'
+
+
+def parse_memory(value):
+    """'64G' -> 65536（MB）"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', value.upper())
+    if not match:
+        raise ValueError(f"无法解析内存大小：{value}")
+    number, unit = float(match.group(1)), match.group(2) or 'M'
+    scale = {'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}[unit]
+    return int(number * scale)
+
+
+def format_memory(mb):
+    if mb % 1024 == 0:
+        return f"{mb // 1024}G"
+    return f"{mb}M"
+
+
+def parse_time(value):
+    """'1-12:00:00' / '24:00:00' / '30:00' / '90' -> 分钟"""
+    days = 0
+    if '-' in value:
+        day_part, value = value.split('-', 1)
+        days = int(day_part)
+    parts = [int(part) for part in value.split(':')]
+    if len(parts) == 3:
+        hours, minutes, seconds = parts
+    elif len(parts) == 2:
+        hours, minutes, seconds = 0, parts[0], parts[1]
+    else:
+        hours, minutes, seconds = 0, parts[0], 0
+    return days * 24 * 60 + hours * 60 + minutes + (1 if seconds else 0)
+
+
+def format_time(minutes):
+    days, minutes = divmod(int(minutes), 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    if days:
+        return f"{days}-{hours:02d}:{minutes:02d}:00"
+    return f"{hours:02d}:{minutes:02d}:00"
+
+
+def read_script_resources(script):
+    """读取脚本 #SBATCH 头中的 --mem 和 --time"""
+    resources = {}
+    try:
+        with open(script, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                match = re.match(r'#SBATCH\s+--(mem|time)=(\S+)', line.strip())
+                if match:
+                    resources[match.group(1)] = match.group(2)
+    except OSError:
+        pass
+    return resources
+
+
+class RetryPolicy:
+    """按配置 [RETRY] 重试失败的数组任务
+
+    max_attempts - 每个任务最多重试次数（0 表示不重试）
+    retry_states - 会触发重试的结束状态
+    mem_factor   - OUT_OF_MEMORY 时内存放大倍数
+    time_factor  - TIMEOUT 时运行时间放大倍数
+    max_mem      - 内存上限（可选）
+    max_time     - 运行时间上限（可选）
+    """
+
+    def __init__(self, config, monitor, submit):
+        self.monitor = monitor
+        self.submit = submit
+        self.max_attempts = config.getint('RETRY', 'max_attempts', fallback=0)
+        states = config.get('RETRY', 'retry_states', fallback=DEFAULT_RETRY_STATES)
+        self.retry_states = {state.strip() for state in states.split(',') if state.strip()}
+        self.mem_factor = config.getfloat('RETRY', 'mem_factor', fallback=2.0)
+        self.time_factor = config.getfloat('RETRY', 'time_factor', fallback=2.0)
+        max_mem = config.get('RETRY', 'max_mem', fallback='')
+        max_time = config.get('RETRY', 'max_time', fallback='')
+        self.max_mem = parse_memory(max_mem) if max_mem else None
+        self.max_time = parse_time(max_time) if max_time else None
+
+    @property
+    def enabled(self):
+        return self.max_attempts > 0
+
+    def escalate(self, info, states):
+        """根据失败原因计算重试作业的资源"""
+        resources = dict(read_script_resources(info['script']))
+        resources.update(info.get('resources') or {})
+        if 'OUT_OF_MEMORY' in states and 'mem' in resources:
+            mem = int(parse_memory(resources['mem']) * self.mem_factor)
+            if self.max_mem:
+                mem = min(mem, self.max_mem)
+            resources['mem'] = format_memory(mem)
+        if 'TIMEOUT' in states and 'time' in resources:
+            minutes = int(parse_time(resources['time']) * self.time_factor)
+            if self.max_time:
+                minutes = min(minutes, self.max_time)
+            resources['time'] = format_time(minutes)
+        return resources
+
+    def redirect_dependents(self, job_id, retry_id, tasks):
+        """把下游作业对 job_id 的依赖改为：原作业结束（afterany）且重试作业成功（afterok）"""
+        for other_id, job in self.monitor.jobs.items():
+            if job['done']:
+                continue
+            deps = job['info'].get('deps', [])
+            new_deps = []
+            for dep_type, dep_id in deps:
+                upstream, task = (dep_id.split('_', 1) + [None])[:2]
+                if upstream != job_id or (task is not None and task not in tasks):
+                    new_deps.append((dep_type, dep_id))
+                    continue
+                new_deps.append(('afterany', dep_id))
+                new_deps.append(('afterok', retry_id if task is None else f"{retry_id}_{task}"))
+            if new_deps == deps:
+                continue
+            if not self.monitor.executor.update_dependency(other_id, new_deps):
+                return False
+            job['info']['deps'] = new_deps
+        return True
+
+    def __call__(self, job_id, failed):
+        """monitor 的 on_failure 回调，返回 True 表示失败任务已重新提交"""
+        if not self.enabled:
+            return False
+        job = self.monitor.jobs[job_id]
+        info = job['info']
+        attempt = info.get('attempt', 0) + 1
+        states = {state for _, state, _ in failed}
+        if not states <= self.retry_states:
+            print(f"{job['step']}失败原因 {', '.join(sorted(states))} 不在重试范围内")
+            return False
+        if attempt > self.max_attempts:
+            print(f"{job['step']}已重试 {self.max_attempts} 次，不再重试")
+            return False
+
+        resources = self.escalate(info, states)
+        tasks = [task for task, _, _ in failed]
+        array = None
+        if tasks != [None]:
+            array = ','.join(tasks)
+            throttle = (info.get('array') or '').partition('%')[2]
+            if throttle:
+                array += f"%{throttle}"
+        resource_text = ', '.join(f"{key}={value}" for key, value in sorted(resources.items()))
+        print(f"重试{job['step']}（第 {attempt} 次）：任务 {array or job_id}，资源 {resource_text}")
+
+        # 失败任务已经运行过，其上游必然已成功，重试作业无需再设依赖
+        retry_id = self.submit(job['step'], info['script'], f"{job['step']}重试 {attempt}",
+                               array=array, env=info.get('env'), resources=resources,
+                               attempt=attempt)
+        if retry_id is None:
+            return False
+        return self.redirect_dependents(job_id, retry_id, set(tasks))
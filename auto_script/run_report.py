@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""一次运行的作业记账报告
+
+流程结束后用一次 sacct（本地执行后端为其记录的同样字段）查询编排器提交的所有作业，
+为每个数组任务记录提交、可运行（依赖满足）、开始和结束时间，运行时间、MaxRSS、CPU 效率和结束状态，
+写到 run_reports/run_<时间>.csv；
+run_reports/run_<时间>.json 另含每个步骤的汇总和跨步骤的关键路径：
+
+    依赖等待 = Eligible - Submit   （等上游作业）
+    排队时间 = Start - Eligible    （依赖已满足，等节点或并发上限）
+    运行时间 = End - Start
+
+关键路径从最后结束的步骤开始，每次回溯到最后结束的上游步骤。路径上每个步骤只计入从上游结束
+（无上游时为提交）到它自己最后一个任务结束的时段：其中第一个任务开始之前为排队时间，之后为运行时间。
+流水线模式（aftercorr）下步骤之间相互重叠，与上游同时运行的部分算在上游，各时段首尾相接，
+路径总长不超过总耗时。
+某步骤最多同时运行的任务数达到其并发上限时标记为 throttle_bound：提高 *_parallel_tasks 可能缩短该步骤。
+
+也可单独打印已有报告的汇总：
+
+    python run_report.py run_reports/run_20240101_120000.json
+"""
+import argparse
+import csv
+import json
+from datetime import datetime
+from pathlib import Path
+
+from retry import parse_memory
+from slurm_monitor import normalize_state, split_job_id
+
+REPORT_DIR = 'run_reports'
+SACCT_FIELDS = ['JobID', 'State', 'ExitCode', 'Submit', 'Eligible', 'Start', 'End', 'MaxRSS', 'TotalCPU', 'AllocCPUS']
+TASK_COLUMNS = ['step', 'script', 'job_id', 'task', 'attempt', 'state', 'exit_code', 'submit', 'eligible', 'start', 'end',
+                'dependency_wait_s', 'queue_wait_s', 'elapsed_s', 'max_rss_mb', 'alloc_cpus', 'cpu_efficiency']
+
+
+def parse_timestamp(value):
+    """'2024-01-01T12:00:00' -> datetime；'Unknown'、'None' 等返回 None"""
+    try:
+        return datetime.strptime(value.strip(), '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+
+
+def parse_duration(value):
+    """sacct 时长 '1-02:03:04' / '02:03:04' / '03:04.567' -> 秒"""
+    value = value.strip()
+    if not value:
+        return 0.0
+    days = 0
+    if '-' in value:
+        day_part, value = value.split('-', 1)
+        days = int(day_part)
+    seconds = 0.0
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part)
+    return days * 86400 + seconds
+
+
+def seconds_between(first, second):
+    if first is None or second is None:
+        return None
+    return max(0.0, (second - first).total_seconds())
+
+
+def query_tasks(executor, job_ids):
+    """一次记账查询，返回 {(作业ID, 任务号): 字段字典}，MaxRSS 取各作业步的最大值，step_cpu_s 为各作业步 CPU 时间之和"""
+    lines = executor.accounting(job_ids, SACCT_FIELDS)
+    if lines is None:
+        print("警告：记账查询（sacct）失败，无法生成运行报告")
+        return None
+    tasks = {}
+    for line in lines:
+        fields = dict(zip(SACCT_FIELDS, line))
+        raw_id, _, job_step = fields['JobID'].partition('.')
+        key = split_job_id(raw_id)
+        if key[1] is not None and key[1].startswith('['):
+            # 从未开始的数组任务
+            continue
+        task = tasks.setdefault(key, {'max_rss_mb': 0, 'step_cpu_s': 0.0})
+        if job_step:
+            if fields['MaxRSS'].strip():
+                task['max_rss_mb'] = max(task['max_rss_mb'], parse_memory(fields['MaxRSS']))
+            task['step_cpu_s'] += parse_duration(fields['TotalCPU'])
+            continue
+        task.update(fields)
+    return {key: task for key, task in tasks.items() if 'State' in task}
+
+
+def task_rows(monitor, tasks):
+    """按 monitor 登记的作业整理每个数组任务的记录"""
+    rows = []
+    for job_id, job in monitor.jobs.items():
+        for (task_job, task_id), fields in sorted(tasks.items(), key=lambda item: str(item[0])):
+            if task_job != job_id:
+                continue
+            submit, eligible = parse_timestamp(fields['Submit']), parse_timestamp(fields['Eligible'])
+            start, end = parse_timestamp(fields['Start']), parse_timestamp(fields['End'])
+            elapsed = seconds_between(start, end)
+            cpus = int(fields['AllocCPUS'] or 0)
+            cpu_time = max(parse_duration(fields['TotalCPU']), fields['step_cpu_s'])
+            rows.append({
+                'step': job['step'],
+                'script': job['info'].get('script', ''),
+                'job_id': job_id,
+                'task': task_id or '',
+                'attempt': job['info'].get('attempt', 0),
+                'state': normalize_state(fields['State']),
+                'exit_code': fields['ExitCode'],
+                'submit': submit.isoformat() if submit else '',
+                'eligible': eligible.isoformat() if eligible else '',
+                'start': start.isoformat() if start else '',
+                'end': end.isoformat() if end else '',
+                'dependency_wait_s': seconds_between(submit, eligible),
+                'queue_wait_s': seconds_between(eligible or submit, start),
+                'elapsed_s': elapsed,
+                'max_rss_mb': fields['max_rss_mb'],
+                'alloc_cpus': cpus,
+                'cpu_efficiency': round(cpu_time / (elapsed * cpus), 3) if elapsed and cpus else None,
+            })
+    return rows
+
+
+def max_concurrency(rows):
+    """同时处于运行状态的最多任务数"""
+    events = []
+    for row in rows:
+        if row['start'] and row['end']:
+            events.append((row['start'], 1))
+            events.append((row['end'], -1))
+    running = peak = 0
+    for _, delta in sorted(events, key=lambda event: (event[0], event[1])):
+        running += delta
+        peak = max(peak, running)
+    return peak
+
+
+def parallel_limit(monitor, job_ids):
+    """步骤的并发上限：共享上限组的 limit，否则为各首次提交数组作业 %N 之和"""
+    for group in monitor.throttle_groups:
+        if set(group['jobs']) & set(job_ids):
+            return group['limit']
+    limits = [int(info['array'].partition('%')[2]) for info in (monitor.jobs[job_id]['info'] for job_id in job_ids)
+              if info.get('attempt', 0) == 0 and (info.get('array') or '').partition('%')[2]]
+    return sum(limits) or None
+
+
+def mean(values):
+    values = [value for value in values if value is not None]
+    return round(sum(values) / len(values), 3) if values else None
+
+
+def step_summaries(steps, monitor, rows):
+    """每个步骤：时间范围、任务数、排队/运行时间统计、峰值并发和内存"""
+    summaries = {}
+    for step in steps:
+        step_rows = [row for row in rows if row['step'] == step['name']]
+        job_ids = monitor.step_jobs(step['name'])
+        summary = {'step': step['step'], 'script': step['script'], 'name': step['name'], 'deps': step['deps'],
+                   'tasks': len(step_rows), 'jobs': job_ids}
+        if step_rows:
+            starts = [row['start'] for row in step_rows if row['start']]
+            ends = [row['end'] for row in step_rows if row['end']]
+            peak = max_concurrency(step_rows)
+            limit = parallel_limit(monitor, job_ids)
+            summary.update({
+                'submit': min(row['submit'] for row in step_rows if row['submit']),
+                'first_start': min(starts) if starts else None,
+                'last_end': max(ends) if ends else None,
+                'failed_tasks': sum(1 for row in step_rows if row['state'] != 'COMPLETED'),
+                'mean_queue_wait_s': mean(row['queue_wait_s'] for row in step_rows),
+                'max_queue_wait_s': max((row['queue_wait_s'] or 0) for row in step_rows),
+                'mean_elapsed_s': mean(row['elapsed_s'] for row in step_rows),
+                'max_elapsed_s': max((row['elapsed_s'] or 0) for row in step_rows),
+                'max_rss_mb': max(row['max_rss_mb'] for row in step_rows),
+                'mean_cpu_efficiency': mean(row['cpu_efficiency'] for row in step_rows),
+                'max_running': peak,
+                'parallel_limit': limit,
+                'throttle_bound': bool(limit) and peak >= limit and len(step_rows) > limit,
+            })
+        summaries[step['script']] = summary
+    return summaries
+
+
+def critical_path(summaries):
+    """从最后结束的步骤回溯，返回 [{'script', 'name', 'queued_s', 'running_s'}]，各步骤的时段互不重叠"""
+    finished = {script: s for script, s in summaries.items() if s.get('last_end') and s.get('first_start')}
+    if not finished:
+        return []
+    current = max(finished.values(), key=lambda s: s['last_end'])
+    path = []
+    limit = None
+    while current is not None:
+        deps = [finished[dep] for dep in current['deps'] if dep in finished]
+        upstream = max(deps, key=lambda s: s['last_end']) if deps else None
+        end = parse_timestamp(current['last_end'])
+        if limit is not None:
+            end = min(end, limit)
+        ready = min(parse_timestamp(max(upstream['last_end'], current['submit']) if upstream else current['submit']), end)
+        start = min(max(parse_timestamp(current['first_start']), ready), end)
+        path.append({'script': current['script'], 'name': current['name'],
+                     'queued_s': seconds_between(ready, start),
+                     'running_s': seconds_between(start, end)})
+        limit = ready
+        current = upstream
+    return path[::-1]
+
+
+def build_report(steps, monitor, rows):
+    summaries = step_summaries(steps, monitor, rows)
+    path = critical_path(summaries)
+    submits = [row['submit'] for row in rows if row['submit']]
+    ends = [row['end'] for row in rows if row['end']]
+    wall = seconds_between(parse_timestamp(min(submits)), parse_timestamp(max(ends))) if submits and ends else None
+    queued = sum(step['queued_s'] for step in path)
+    running = sum(step['running_s'] for step in path)
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'wall_clock_s': wall,
+        'critical_path': path,
+        'critical_path_queued_s': queued,
+        'critical_path_running_s': running,
+        'task_queue_wait_s': sum(row['queue_wait_s'] or 0 for row in rows),
+        'task_running_s': sum(row['elapsed_s'] or 0 for row in rows),
+        'steps': list(summaries.values()),
+    }
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def print_summary(report):
+    print(f"\n总耗时 {format_seconds(report['wall_clock_s'])}，关键路径：排队 {format_seconds(report['critical_path_queued_s'])}，"
+          f"运行 {format_seconds(report['critical_path_running_s'])}")
+    for step in report['critical_path']:
+        print(f"  {step['name']}: 排队 {format_seconds(step['queued_s'])}，运行 {format_seconds(step['running_s'])}")
+    for step in report['steps']:
+        if not step['tasks']:
+            continue
+        note = "，已达并发上限" if step['throttle_bound'] else ""
+        efficiency = step['mean_cpu_efficiency']
+        print(f"{step['name']}: {step['tasks']} 个任务，平均排队 {format_seconds(step['mean_queue_wait_s'])}，"
+              f"最长运行 {format_seconds(step['max_elapsed_s'])}，峰值内存 {step['max_rss_mb']}MB，"
+              f"CPU 效率 {'-' if efficiency is None else f'{efficiency:.0%}'}，"
+              f"最多同时运行 {step['max_running']}/{step['parallel_limit'] or '-'}{note}")
+
+
+def write_run_report(steps, monitor, report_dir=REPORT_DIR):
+    """查询 sacct 并写出 CSV（每个任务一行）和 JSON（汇总），返回 JSON 路径；无作业或查询失败时返回 None"""
+    if not monitor.jobs:
+        return None
+    tasks = query_tasks(monitor.executor, list(monitor.jobs))
+    if tasks is None:
+        return None
+    rows = task_rows(monitor, tasks)
+    report = build_report(steps, monitor, rows)
+
+    report_dir = Path(report_dir)
+    report_dir.mkdir(parents=True, exist_ok=True)
+    stem = report_dir / f"run_{datetime.now():%Y%m%d_%H%M%S}"
+    with open(stem.with_suffix('.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=TASK_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(stem.with_suffix('.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1, ensure_ascii=False)
+    print_summary(report)
+    print(f"运行报告已写出到 {stem.with_suffix('.json')} 和 {stem.with_suffix('.csv')}")
+    return stem.with_suffix('.json')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="打印运行报告的汇总")
+    parser.add_argument('report', help='run_reports/run_<时间>.json')
+    args = parser.parse_args()
+    with open(args.report, encoding='utf-8') as f:
+        print_summary(json.load(f))
+
+
+if __name__ == "__main__":
+    main()
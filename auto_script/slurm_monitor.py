@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""批量监控已提交的作业
+
+每个轮询周期只向执行后端（见 executors.py，Slurm 下为一次 sacct，不可用时退回 squeue）
+查询一次所有未结束的作业，读取每个数组任务的最终状态和退出码，并按自适应退避调整轮询间隔。
+连续 max_missing_polls 次查不到状态的作业按 UNKNOWN 失败处理并取消，避免 wait() 一直等待。
+"""
+import time
+
+# 作业成功结束的状态
+SUCCESS_STATES = {'COMPLETED'}
+# 作业失败结束的状态
+FAILURE_STATES = {'FAILED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL', 'CANCELLED',
+                  'BOOT_FAIL', 'DEADLINE', 'PREEMPTED', 'REVOKED', 'UNKNOWN'}
+TERMINAL_STATES = SUCCESS_STATES | FAILURE_STATES
+# 连续多少次轮询查不到作业时放弃等待
+MAX_MISSING_POLLS = 10
+
+
+def normalize_state(state):
+    """'CANCELLED by 123' -> 'CANCELLED'"""
+    state = state.strip().split()[0] if state.strip() else 'UNKNOWN'
+    return state.rstrip('+')
+
+
+def split_job_id(raw_id):
+    """'123_4' -> ('123', '4')，'123_[5-9%2]' -> ('123', '[5-9%2]')，'123' -> ('123', None)"""
+    if '_' in raw_id:
+        job_id, task = raw_id.split('_', 1)
+        return job_id, task
+    return raw_id, None
+
+
+def count_array_tasks(task):
+    """统计任务号描述中的任务数：'7' -> 1，'[3-9,12%4]' -> 8"""
+    if task is None or not task.startswith('['):
+        return 1
+    count = 0
+    for part in task.strip('[]').split('%')[0].split(','):
+        if '-' in part:
+            first, last = part.split('-', 1)
+            count += int(last) - int(first) + 1
+        elif part:
+            count += 1
+    return count
+
+
+class JobMonitor:
+    """跟踪编排器提交的所有作业，统一轮询状态"""
+
+    def __init__(self, executor, min_interval=None, max_interval=None, backoff=2.0, max_missing_polls=MAX_MISSING_POLLS):
+        self.executor = executor
+        self.min_interval = executor.poll_intervals[0] if min_interval is None else min_interval
+        self.max_interval = executor.poll_intervals[1] if max_interval is None else max_interval
+        self.backoff = backoff
+        self.max_missing_polls = max_missing_polls
+        # job_id -> {'step': 步骤名, 'tasks': {任务号: (状态, 退出码)}, 'done': bool, 'info': 提交信息,
+        #            'missing': 连续查不到的轮询次数}
+        self.jobs = {}
+        # 上游失败时是否由 Slurm 自动取消下游作业；启用重试时关闭，由编排器改写依赖或取消
+        self.kill_on_invalid_dep = True
+        # 由编排器主动取消的作业，其 CANCELLED 状态不再报告
+        self.cancelled = set()
+        # 共享并发上限的作业组：{'jobs': [job_id], 'limit': 上限, 'throttle': {job_id: 当前限制},
+        #                        'held': [以 --hold 提交、尚未分到名额的 job_id]}
+        self.throttle_groups = []
+
+    def track(self, job_id, step_name, **info):
+        """登记一个需要监控的作业，info 为提交信息（脚本、数组范围、OFFSET、依赖、资源等）"""
+        self.jobs[job_id] = {'step': step_name, 'tasks': {}, 'done': False, 'info': info, 'missing': 0}
+
+    def add_throttle_group(self, job_ids, limit, held=()):
+        """登记一组共享并发上限的数组作业（如同一步骤的多个批次）
+
+        held 为提交时没有分到名额而以 --hold 提交的作业，有空闲名额时按顺序释放。
+        """
+        self.throttle_groups.append({'jobs': list(job_ids), 'limit': limit, 'throttle': {},
+                                     'held': [job_id for job_id in job_ids if job_id in held]})
+
+    def active_jobs(self):
+        return [job_id for job_id, job in self.jobs.items() if not job['done']]
+
+    def step_jobs(self, step_name):
+        return [job_id for job_id, job in self.jobs.items() if job['step'] == step_name]
+
+    def dependents(self, job_id):
+        """返回直接或间接依赖该作业的所有作业ID"""
+        found = []
+        frontier = [job_id]
+        while frontier:
+            upstream = frontier.pop()
+            for other_id, job in self.jobs.items():
+                if other_id in found:
+                    continue
+                if any(split_job_id(dep_id)[0] == upstream for _, dep_id in job['info'].get('deps', [])):
+                    found.append(other_id)
+                    frontier.append(other_id)
+        return found
+
+    def orphans(self):
+        """返回因上游失败而永远无法运行、但还未结束的作业ID
+
+        afterok/aftercorr 依赖的作业（或数组任务）已失败的作业及其全部下游；
+        改写为 afterany 的原作业依赖不算，重试作业成功后下游仍会运行。
+        """
+        found = set()
+        for other_id, job in self.jobs.items():
+            for dep_type, dep_id in job['info'].get('deps', []):
+                upstream, task = split_job_id(dep_id)
+                if dep_type == 'afterany' or upstream not in self.jobs:
+                    continue
+                tasks = self.jobs[upstream]['tasks']
+                failed = (tasks.get(task, ('', ''))[0] in FAILURE_STATES if task is not None
+                          else self.is_failed(upstream))
+                if failed:
+                    found.add(other_id)
+                    found.update(self.dependents(other_id))
+                    break
+        return sorted(job_id for job_id in found if not self.jobs[job_id]['done'])
+
+    def failed_tasks(self, job_id):
+        """返回 [(任务号, 状态, 退出码)]，非数组作业的任务号为 None"""
+        return [(task, state, exit_code)
+                for task, (state, exit_code) in sorted(self.jobs[job_id]['tasks'].items(),
+                                                       key=lambda item: str(item[0]))
+                if state in FAILURE_STATES]
+
+    def is_failed(self, job_id):
+        return bool(self.failed_tasks(job_id))
+
+    def poll(self):
+        """轮询一次，返回本次状态发生变化的作业ID列表"""
+        job_ids = self.active_jobs()
+        if not job_ids:
+            return []
+
+        states = self.executor.query(job_ids)
+        changed = []
+        for job_id in job_ids:
+            tasks = states.get(job_id)
+            job = self.jobs[job_id]
+            if not tasks:
+                # 刚提交的作业可能还未进入记账数据库，查询失败时也没有状态
+                job['missing'] += 1
+                if job['missing'] >= self.max_missing_polls:
+                    print(f"警告：连续 {job['missing']} 次查不到作业 {job_id} 的状态，按失败处理并取消")
+                    self.executor.cancel([job_id])
+                    job['tasks'] = {None: ('UNKNOWN', '')}
+                    job['done'] = True
+                    changed.append(job_id)
+                continue
+            job['missing'] = 0
+            if tasks != job['tasks']:
+                changed.append(job_id)
+            job['tasks'] = tasks
+            # 还有未展开的挂起数组（如 123_[5-9]）或未结束的任务时作业未完成
+            job['done'] = all(state in TERMINAL_STATES for state in
+                              (state for state, _ in tasks.values()))
+        return changed
+
+    def rebalance_throttles(self):
+        """在同组作业之间重新分配并发上限
+
+        每个作业保留正在运行的任务数，剩余名额按提交顺序分给仍有排队任务的作业，
+        通过执行后端修改 ArrayTaskThrottle 生效。限制为 0 表示不限制，所以已释放的作业至少为 1，
+        先为其中没有运行任务的作业各留 1 个名额；暂停的作业分到名额后才设置限制并释放，
+        各作业的限制之和不超过上限。
+        """
+        for group in self.throttle_groups:
+            running = {}
+            pending = {}
+            for job_id in group['jobs']:
+                job = self.jobs[job_id]
+                if job['done'] or not job['tasks']:
+                    continue
+                running[job_id] = sum(1 for state, _ in job['tasks'].values() if state == 'RUNNING')
+                pending[job_id] = sum(count_array_tasks(task) for task, (state, _) in job['tasks'].items()
+                                      if state == 'PENDING')
+            waiting = [job_id for job_id in pending if pending[job_id] > 0]
+            if not waiting:
+                continue
+
+            released = [job_id for job_id in waiting if job_id not in group['held']]
+            extra = {job_id: 0 if running[job_id] else 1 for job_id in released}
+            free = max(0, group['limit'] - sum(running.values()) - sum(extra.values()))
+            for job_id in released + [job_id for job_id in group['held'] if job_id in waiting]:
+                grant = min(free, pending[job_id] - extra.get(job_id, 0))
+                extra[job_id] = extra.get(job_id, 0) + grant
+                free -= grant
+
+            for job_id in running:
+                if job_id in group['held']:
+                    if extra.get(job_id) and self.executor.set_throttle(job_id, extra[job_id]):
+                        group['throttle'][job_id] = extra[job_id]
+                        self.executor.release([job_id])
+                        group['held'].remove(job_id)
+                    continue
+                throttle = max(1, running[job_id] + extra.get(job_id, 0))
+                if group['throttle'].get(job_id) == throttle:
+                    continue
+                if self.executor.set_throttle(job_id, throttle):
+                    group['throttle'][job_id] = throttle
+
+    def cancel(self, job_ids):
+        """取消作业"""
+        if job_ids:
+            self.cancelled.update(job_ids)
+            self.executor.cancel(list(job_ids))
+
+    def report_failure(self, job_id, tasks):
+        job = self.jobs[job_id]
+        print(f"错误：{job['step']}（作业 {job_id}）失败：")
+        for task, state, exit_code in tasks:
+            task_name = f"{job_id}_{task}" if task is not None else job_id
+            print(f"  {task_name}: {state} (ExitCode {exit_code})")
+
+    def wait(self, on_failure=None, on_poll=None):
+        """等待所有作业结束
+
+        发现新的失败任务时调用 on_failure(job_id, 失败任务列表)；返回 True 表示已处理
+        （如重新提交），不计为失败。未处理的失败会立即取消该步骤的剩余作业及其下游作业。
+        on_poll() 在每次轮询后调用，用于编排器内运行的步骤，返回 True 表示仍有工作未完成。
+        所有作业（及 on_poll 的工作）结束后返回作业是否全部成功。
+        """
+        interval = self.min_interval
+        handled = set()
+        failed_steps = set()
+        while True:
+            changed = self.poll()
+            self.rebalance_throttles()
+            for job_id in changed:
+                if job_id in self.cancelled:
+                    continue
+                new_failures = [task for task in self.failed_tasks(job_id)
+                                if (job_id, task[0]) not in handled]
+                if not new_failures:
+                    continue
+                handled.update((job_id, task[0]) for task in new_failures)
+                self.report_failure(job_id, new_failures)
+                step_name = self.jobs[job_id]['step']
+                if on_failure is not None and on_failure(job_id, new_failures):
+                    continue
+                failed_steps.add(step_name)
+                to_cancel = set(self.step_jobs(step_name))
+                for step_job in list(to_cancel):
+                    to_cancel.update(self.dependents(step_job))
+                self.cancel(sorted(j for j in to_cancel if not self.jobs[j]['done']))
+
+            busy = on_poll() if on_poll is not None else False
+            active = self.active_jobs()
+            if not active and not busy:
+                break
+
+            # 状态有变化时恢复最短间隔，否则逐步拉长
+            if changed:
+                interval = self.min_interval
+            else:
+                interval = min(self.max_interval, interval * self.backoff)
+            # 只剩编排器内的工作时不必等待执行后端
+            time.sleep(interval if active else min(1, self.max_interval))
+
+        if failed_steps:
+            print(f"以下步骤失败：{', '.join(sorted(failed_steps))}")
+            return False
+        print("所有作业已完成")
+        return True
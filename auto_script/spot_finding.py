@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""max3d 点检测的 Python 实现，与 SpotFindingMax3D.m 结果一致
+
+对参考轮的每个通道：
+1. 区域极大值（与 imregionalmax 相同，26 连通）：先用 3×3×3 最大值滤波找出不小于所有邻居的体素，
+   再排除与更高体素相邻的同值平台（平台中只要有一个体素不是局部最大，整个平台都不是区域极大值）；
+2. 保留强度大于 intensity_threshold * 255 的区域极大值；
+3. 每个连通区域取质心（与 regionprops3 相同，按 MATLAB 列优先顺序编号），四舍五入为 int16。
+
+各通道在进程池中并行计算，结果按通道顺序拼接，坐标为子块内 1 起始的 (x, y, z)，
+与 sdata.allSpots 相同。core_matlab 的 spot_finding 模式通过 'spots_file' 读取这些位置，
+跳过 MATLAB 的点检测，只做读段提取和过滤。
+"""
+import argparse
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from scipy import ndimage
+
+import volume_store
+
+CONNECTIVITY = np.ones((3, 3, 3), dtype=bool)
+
+
+def spots_file_path(interm_dir, subtile, num_subtiles, method='max3d'):
+    return Path(interm_dir) / f"spots_{method}_t{subtile}_{num_subtiles}.csv"
+
+
+def regional_max_3d(channel):
+    """与 imregionalmax 相同的区域极大值掩膜"""
+    local_max = ndimage.maximum_filter(channel, footprint=CONNECTIVITY, mode='nearest') == channel
+    # 非局部最大的体素保留原值，其余置为最小值；若某个局部最大体素的同值邻居不是局部最大，
+    # 则它所在的平台与更高的体素相连
+    dtype = np.promote_types(channel.dtype, np.int8)
+    lowest = np.iinfo(dtype).min if np.issubdtype(dtype, np.integer) else -np.inf
+    others = np.where(local_max, lowest, channel.astype(dtype, copy=False))
+    touches_higher = local_max & (ndimage.maximum_filter(others, footprint=CONNECTIVITY,
+                                                         mode='constant', cval=lowest) == channel)
+    labels, _ = ndimage.label(local_max, structure=CONNECTIVITY)
+    rejected = np.unique(labels[touches_higher])
+    return local_max & ~np.isin(labels, rejected[rejected > 0])
+
+
+def plateau_centroids(mask):
+    """连通区域的质心，返回 N×3 int16 的 (x, y, z)，1 起始，与 regionprops3 的 Centroid 相同"""
+    # 转为 (z, x, y) 后按 C 顺序编号，与 MATLAB 按列优先扫描 (y, x, z) 的编号顺序一致
+    labels, count = ndimage.label(mask.transpose(2, 1, 0), structure=CONNECTIVITY)
+    if count == 0:
+        return np.zeros((0, 3), dtype=np.int16)
+    z, x, y = np.nonzero(labels)
+    ids = labels[z, x, y]
+    sizes = np.bincount(ids, minlength=count + 1)[1:]
+    centroids = np.stack([np.bincount(ids, weights=axis, minlength=count + 1)[1:] / sizes
+                          for axis in (x, y, z)], axis=1) + 1
+    # int16() 四舍五入，.5 远离零
+    return np.floor(centroids + 0.5).astype(np.int16)
+
+
+def find_channel_spots(channel, intensity_threshold):
+    """单个通道 (y, x, z) 的点位置"""
+    return plateau_centroids(regional_max_3d(channel) & (channel > intensity_threshold * 255))
+
+
+def find_spots_max3d(volume, ref_round, intensity_threshold, executor=None):
+    """volume 为 (y, x, z, channel, round)，ref_round 为 1 起始的参考轮"""
+    ref = volume[..., ref_round - 1]
+    channels = [np.ascontiguousarray(ref[:, :, :, c]) for c in range(ref.shape[3])]
+    if executor is None:
+        results = [find_channel_spots(channel, intensity_threshold) for channel in channels]
+    else:
+        results = list(executor.map(find_channel_spots, channels, [intensity_threshold] * len(channels)))
+    return np.concatenate(results) if results else np.zeros((0, 3), dtype=np.int16)
+
+
+def read_registered_subtile(interm_dir, subtile, num_subtiles, volume_format):
+    """读取局部配准后的子块，(y, x, z, channel, round)"""
+    if volume_format == 'zarr':
+        return volume_store.open_volume(volume_store.subtile_store_path(interm_dir, subtile, num_subtiles))[...]
+    import scipy.io
+    mat_file = Path(interm_dir) / f"registeredImages_t{subtile}_{num_subtiles}.mat"
+    try:
+        data = scipy.io.loadmat(mat_file)
+    except NotImplementedError:
+        raise RuntimeError(f"{mat_file} 为 v7.3 格式，无法用 scipy 读取，请使用 volume_format = zarr")
+    for name in ('t_output', 'local_registered_img'):
+        if name in data:
+            return data[name]
+    raise KeyError(f"{mat_file} 中没有配准结果")
+
+
+def write_spots_file(path, spots):
+    """写出 x,y,z 位置；先写临时文件再改名"""
+    path = Path(path)
+    tmp_path = path.with_suffix('.tmp')
+    np.savetxt(tmp_path, spots, fmt='%d', delimiter=',', header='x,y,z', comments='')
+    tmp_path.replace(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="max3d 点检测（第 03 步），写出供 core_matlab 读取的点位置")
+    parser.add_argument('--registration-dir', required=True, help='包含 PositionXXX/interm 的目录')
+    parser.add_argument('--tasks', type=int, nargs=2, required=True, metavar=('FIRST', 'LAST'),
+                        help='子块任务号范围（与数组任务的 FIRST_TASK/LAST_TASK 相同）')
+    parser.add_argument('--task-map', help='task_map.csv：--tasks 为其中的 slot，任务号从表中查出')
+    parser.add_argument('--subtiles', type=int, required=True, help='每个位置的子块数 N')
+    parser.add_argument('--ref-round', type=int, default=1, help='参考轮（默认：1）')
+    parser.add_argument('--intensity-threshold', type=float, required=True, help='强度阈值，乘以 255 后使用')
+    parser.add_argument('--volume-format', default='mat', choices=['mat', 'zarr'], help='配准体积格式（默认：mat）')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('SLURM_CPUS_PER_TASK', 1)),
+                        help='并行处理通道的进程数（默认：SLURM_CPUS_PER_TASK 或 1）')
+    args = parser.parse_args()
+
+    task_ids = range(args.tasks[0], args.tasks[1] + 1)
+    if args.task_map:
+        with open(args.task_map, newline='', encoding='utf-8') as f:
+            task_map = [int(row['task']) for row in csv.DictReader(f)]
+        task_ids = [task_map[slot - 1] for slot in task_ids]
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for task_id in task_ids:
+            position = (task_id - 1) // args.subtiles + 1
+            subtile = (task_id - 1) % args.subtiles + 1
+            interm_dir = Path(args.registration_dir) / f"Position{position:03d}" / 'interm'
+            spots_file = spots_file_path(interm_dir, subtile, args.subtiles)
+            if spots_file.exists():
+                spots_file.unlink()
+            try:
+                volume = read_registered_subtile(interm_dir, subtile, args.subtiles, args.volume_format)
+                spots = find_spots_max3d(volume, args.ref_round, args.intensity_threshold, executor)
+                write_spots_file(spots_file, spots)
+                print(f"[task {task_id}] Position{position:03d} subtile {subtile}: {len(spots)} 个点")
+            except Exception as e:
+                # 不写出点文件，core_matlab 读取时报错，该子块计为失败
+                failed += 1
+                print(f"[task {task_id}] Position{position:03d} subtile {subtile} failed: {e}")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""合并后点表的空间索引与查询
+
+merged_goodPoints_<method>.csv 的裁剪、按视野计数、按细胞分配每次都要全表扫描。
+这里把点按网格分箱排序后写成一个 .spots 存储（merged_goodPoints_<method>.index/），
+每个箱是一个分组，网格与 TileConfiguration.registered.txt 的布局对齐，
+网格信息和各位置的矩形保存在同目录的 grid.json 中。查询时以内存映射打开，
+区域查询只读取与区域相交的箱；细胞×基因矩阵对所有点一次性查标签图，不逐个细胞循环。
+
+坐标与合并后的 CSV 相同（0 起始），区域为半开区间 [x0, x1) × [y0, y1)。
+"""
+import argparse
+import configparser
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from spot_store import SpotTable, fresh_store_path, write_store
+from stitch_points import parse_tile_configuration
+
+GRID_FILE = 'grid.json'
+CHUNK_ROWS = 1 << 22
+
+
+def index_path_for(spots_path):
+    """merged_goodPoints_max3d.csv/.spots -> merged_goodPoints_max3d.index"""
+    return Path(spots_path).with_suffix('.index')
+
+
+def resolve_source(spots_path):
+    """返回实际读取的点表：.spots 存储不早于 CSV 时使用存储"""
+    spots_path = Path(spots_path)
+    if spots_path.suffix != '.spots' and fresh_store_path(spots_path) is not None:
+        return fresh_store_path(spots_path)
+    return spots_path
+
+
+def source_mtime(source):
+    source = Path(source)
+    return (source / 'meta.json').stat().st_mtime if source.is_dir() else source.stat().st_mtime
+
+
+def load_source(source):
+    """读取点表，返回 (x, y, z, 基因编号, 基因名列表)；.spots 存储以内存映射读取"""
+    source = Path(source)
+    if source.is_dir():
+        table = SpotTable(source, mmap=True)
+        return table.x, table.y, table.z, table.gene, list(table.genes)
+    frame = pd.read_csv(source, dtype={'Gene': 'category'})
+    coords = [frame[name].to_numpy() for name in ('x', 'y', 'z')]
+    return (*coords, frame['Gene'].cat.codes.to_numpy(), [str(gene) for gene in frame['Gene'].cat.categories])
+
+
+def build_index(spots_path, tile_config, tile_size, bin_size=None, index_path=None):
+    """建立索引并返回其路径
+
+    网格原点为拼接坐标的 (0, 0)，即最左上位置的左上角；箱大小默认为位置宽度的 1/4，
+    使每个位置恰好覆盖 4×4 个箱。
+    """
+    source = resolve_source(spots_path)
+    index_path = Path(index_path or index_path_for(spots_path))
+    bin_size = int(bin_size or max(1, tile_size // 4))
+    x, y, z, gene, genes = load_source(source)
+
+    # parse_tile_configuration 返回 1 起始坐标，合并后的点为 0 起始
+    tiles = [(tile, int(tx) - 1, int(ty) - 1) for tile, tx, ty, _ in parse_tile_configuration(tile_config)]
+    extent_x = max([tx + tile_size for _, tx, _ in tiles] + [int(x.max()) + 1 if len(x) else 0])
+    extent_y = max([ty + tile_size for _, _, ty in tiles] + [int(y.max()) + 1 if len(y) else 0])
+    shape = (-(-extent_y // bin_size), -(-extent_x // bin_size))
+
+    bins = (np.clip(np.asarray(y) // bin_size, 0, shape[0] - 1).astype(np.int64) * shape[1]
+            + np.clip(np.asarray(x) // bin_size, 0, shape[1] - 1))
+    order = np.argsort(bins, kind='stable')
+    offsets = np.zeros(shape[0] * shape[1] + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(bins, minlength=shape[0] * shape[1]))
+    del bins
+
+    def fill(columns, gene_column):
+        # 分块按排序后的顺序拷贝，避免同时持有多份完整的列
+        for start in range(0, len(order), CHUNK_ROWS):
+            rows = order[start:start + CHUNK_ROWS]
+            for column, values in zip(columns, (x, y, z)):
+                column[start:start + len(rows)] = values[rows]
+            gene_column[start:start + len(rows)] = gene[rows]
+
+    grid = {
+        'source': str(source.absolute()),
+        'source_mtime': source_mtime(source),
+        'bin_size': bin_size,
+        'shape': list(shape),
+        'tile_size': int(tile_size),
+        'tiles': [list(tile) for tile in tiles],
+    }
+    count = write_store(index_path, len(order), fill, genes, np.arange(shape[0] * shape[1]), offsets,
+                        extra={GRID_FILE: grid})
+    print(f"已建立索引 {index_path}：{count} 个点，{shape[0]}×{shape[1]} 个箱（箱大小 {bin_size}）")
+    return index_path
+
+
+def is_index_fresh(index_path, spots_path):
+    index_path = Path(index_path)
+    if not (index_path / 'meta.json').exists():
+        return False
+    with open(index_path / GRID_FILE, encoding='utf-8') as f:
+        grid = json.load(f)
+    source = resolve_source(spots_path)
+    return Path(grid['source']) == source.absolute() and grid['source_mtime'] >= source_mtime(source)
+
+
+def open_index(spots_path, tile_config, tile_size, bin_size=None):
+    """打开点表的索引，不存在或比点表旧时重新建立"""
+    index_path = index_path_for(spots_path)
+    if not is_index_fresh(index_path, spots_path):
+        build_index(spots_path, tile_config, tile_size, bin_size, index_path)
+    return SpotIndex(index_path)
+
+
+class SpotIndex:
+    """以内存映射打开的索引"""
+
+    def __init__(self, index_path):
+        self.table = SpotTable(index_path, mmap=True)
+        with open(Path(index_path) / GRID_FILE, encoding='utf-8') as f:
+            self.grid = json.load(f)
+        self.bin_size = self.grid['bin_size']
+        self.shape = tuple(self.grid['shape'])
+        self.tiles = {tile: (tx, ty) for tile, tx, ty in self.grid['tiles']}
+        self.tile_size = self.grid['tile_size']
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def genes(self):
+        return self.table.genes
+
+    def gene_codes(self, genes):
+        """基因名列表 -> 编号数组，不存在的基因给出警告后忽略"""
+        codes = []
+        for name in genes:
+            code = self.table.gene_code(name)
+            if code is None:
+                print(f"警告：索引中没有基因 {name}")
+            else:
+                codes.append(code)
+        return np.array(codes, dtype=np.int64)
+
+    def region_rows(self, x0=None, x1=None, y0=None, y1=None, z0=None, z1=None, genes=None):
+        """返回落在区域内（且属于给定基因）的行号"""
+        height, width = self.shape[0] * self.bin_size, self.shape[1] * self.bin_size
+        x0, y0 = max(0, x0 or 0), max(0, y0 or 0)
+        x1, y1 = min(width, width if x1 is None else x1), min(height, height if y1 is None else y1)
+        if x0 >= x1 or y0 >= y1:
+            return np.zeros(0, dtype=np.int64)
+
+        # 箱按行优先排列，区域在每一行箱中对应一段连续的行
+        bx0, bx1 = x0 // self.bin_size, (x1 - 1) // self.bin_size
+        offsets = self.table.tile_offsets
+        ranges = [(offsets[by * self.shape[1] + bx0], offsets[by * self.shape[1] + bx1 + 1])
+                  for by in range(y0 // self.bin_size, (y1 - 1) // self.bin_size + 1)]
+        rows = np.concatenate([np.arange(start, stop) for start, stop in ranges])
+
+        x, y = self.table.x[rows], self.table.y[rows]
+        mask = (x >= x0) & (x < x1) & (y >= y0) & (y < y1)
+        if z0 is not None or z1 is not None:
+            z = self.table.z[rows]
+            mask &= (z >= (z0 if z0 is not None else np.iinfo(np.int32).min)) & \
+                    (z < (z1 if z1 is not None else np.iinfo(np.int32).max))
+        if genes is not None:
+            mask &= np.isin(self.table.gene[rows], self.gene_codes(genes))
+        return rows[mask]
+
+    def gene_rows(self, genes):
+        """全片某些基因的行号，只扫描基因编号列"""
+        codes = self.gene_codes(genes)
+        rows = []
+        for start in range(0, len(self), CHUNK_ROWS):
+            chunk = np.asarray(self.table.gene[start:start + CHUNK_ROWS])
+            rows.append(np.flatnonzero(np.isin(chunk, codes)) + start)
+        return np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+
+    def query(self, x0=None, x1=None, y0=None, y1=None, z0=None, z1=None, genes=None):
+        """区域/基因查询，返回 x, y, z, Gene 列的 DataFrame（按箱的顺序）"""
+        if all(value is None for value in (x0, x1, y0, y1, z0, z1)) and genes is not None:
+            rows = self.gene_rows(genes)
+        else:
+            rows = self.region_rows(x0, x1, y0, y1, z0, z1, genes)
+        return self.table.to_frame(rows)
+
+    def tile_box(self, tile):
+        tx, ty = self.tiles[tile]
+        return tx, tx + self.tile_size, ty, ty + self.tile_size
+
+    def counts_by_tile(self, genes=None):
+        """每个位置矩形内的点数（位置×基因），重叠区域的点计入所有覆盖它的位置"""
+        counts = {}
+        for tile in self.tiles:
+            rows = self.region_rows(*self.tile_box(tile), genes=genes)
+            counts[tile] = np.bincount(self.table.gene[rows], minlength=len(self.genes))
+        table = pd.DataFrame.from_dict(counts, orient='index', columns=self.genes)
+        table.index.name = 'tile'
+        table.insert(0, 'total', table.sum(axis=1))
+        return table
+
+    def cell_by_gene(self, labels, origin=(0, 0, 0)):
+        """由标签图得到稀疏的细胞×基因计数矩阵（CSR，第 i 行为标签 i+1）
+
+        labels 为二维 (y, x) 或三维 (z, y, x) 标签图，origin 为其左上角在拼接坐标中的 (x, y, z)；
+        与 GetReadsLocation/GetGeneByCells 相同，点所在像素的标签即为其细胞，标签 0 为背景。
+        """
+        ox, oy, oz = origin
+        height, width = labels.shape[-2:]
+        rows = self.region_rows(ox, ox + width, oy, oy + height)
+        lx = self.table.x[rows] - ox
+        ly = self.table.y[rows] - oy
+        if labels.ndim == 3:
+            lz = self.table.z[rows] - oz
+            inside = (lz >= 0) & (lz < labels.shape[0])
+            cells = np.zeros(len(rows), dtype=np.int64)
+            cells[inside] = labels[lz[inside], ly[inside], lx[inside]]
+        else:
+            cells = labels[ly, lx].astype(np.int64)
+        assigned = cells > 0
+        num_cells = int(labels.max())
+        matrix = scipy.sparse.coo_matrix(
+            (np.ones(int(assigned.sum()), dtype=np.int32),
+             (cells[assigned] - 1, self.table.gene[rows][assigned].astype(np.int64))),
+            shape=(num_cells, len(self.genes)))
+        return matrix.tocsr()
+
+
+def read_label_image(label_file):
+    """读取标签图，未压缩时以内存映射打开"""
+    import tifffile
+    try:
+        return tifffile.memmap(label_file, mode='r')
+    except ValueError:
+        return tifffile.imread(label_file)
+
+
+def default_paths(config):
+    """由配置得到 (合并后的点表, TileConfiguration.registered.txt, 位置宽度)"""
+    from generate_scripts import get_point_stitch_paths
+    stitch_file, _, spot_out_path = get_point_stitch_paths(config)
+    method = config.get('LOCAL_STITCH', 'spotfinding_method', fallback='max3d')
+    return (os.path.join(spot_out_path, f"merged_goodPoints_{method}.csv"), stitch_file,
+            config.getint('LOCAL_STITCH', 'image_width', fallback=2048))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="合并后点表的空间索引与查询")
+    parser.add_argument('command', choices=['build', 'query', 'tiles', 'cells'],
+                        help='build 建立索引；query 区域/基因查询；tiles 按位置计数；cells 细胞×基因矩阵')
+    parser.add_argument('-c', '--config', default='config.ini', help='配置文件，用于确定默认路径（默认：config.ini）')
+    parser.add_argument('--spots', help='merged_goodPoints_<method>.csv 或 .spots（默认：按配置）')
+    parser.add_argument('--tile-config', help='TileConfiguration.registered.txt（默认：按配置）')
+    parser.add_argument('--tile-size', type=int, help='位置宽度（默认：[LOCAL_STITCH] image_width）')
+    parser.add_argument('--bin-size', type=int, help='箱大小（默认：位置宽度的 1/4）')
+    parser.add_argument('--box', type=int, nargs=4, metavar=('X0', 'X1', 'Y0', 'Y1'), help='查询区域')
+    parser.add_argument('--z', type=int, nargs=2, metavar=('Z0', 'Z1'), help='查询的 z 范围')
+    parser.add_argument('--genes', help='逗号分隔的基因名')
+    parser.add_argument('--labels', help='cells：标签图 tif')
+    parser.add_argument('--origin', type=int, nargs=3, default=[0, 0, 0], metavar=('X', 'Y', 'Z'),
+                        help='cells：标签图左上角在拼接坐标中的位置（默认：0 0 0）')
+    parser.add_argument('--output', help='输出文件（query/tiles 为 CSV，cells 为 .npz）')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    spots, tile_config, tile_size = default_paths(config) if config.has_section('IF1_GLOBAL_STITCH') else (None, None, 2048)
+    spots = args.spots or spots
+    tile_config = args.tile_config or tile_config
+    tile_size = args.tile_size or tile_size
+    if not spots or not tile_config:
+        parser.error('需要 --spots 和 --tile-config，或包含 [IF1_GLOBAL_STITCH] 的配置文件')
+
+    if args.command == 'build':
+        build_index(spots, tile_config, tile_size, args.bin_size)
+        return
+    index = open_index(spots, tile_config, tile_size, args.bin_size)
+    genes = [gene.strip() for gene in args.genes.split(',')] if args.genes else None
+
+    if args.command == 'query':
+        box = args.box or [None] * 4
+        z = args.z or [None] * 2
+        result = index.query(*box, *z, genes=genes)
+        print(f"查询到 {len(result)} 个点")
+        if args.output:
+            result.to_csv(args.output, index=False)
+            print(f"已写出 {args.output}")
+    elif args.command == 'tiles':
+        result = index.counts_by_tile(genes)
+        print(result[['total']].to_string())
+        if args.output:
+            result.to_csv(args.output)
+            print(f"已写出 {args.output}")
+    else:
+        if not args.labels:
+            parser.error('cells 需要 --labels')
+        matrix = index.cell_by_gene(read_label_image(args.labels), tuple(args.origin))
+        print(f"{matrix.shape[0]} 个细胞 × {matrix.shape[1]} 个基因，{int(matrix.sum())} 个点分配到细胞")
+        output = Path(args.output or 'cell_by_gene.npz')
+        scipy.sparse.save_npz(output, matrix)
+        pd.DataFrame({'Gene': index.genes}).to_csv(output.with_name(output.stem + '_genes.csv'), index=False)
+        print(f"已写出 {output} 和 {output.stem}_genes.csv")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""点表的列式二进制存储
+
+CSV 中每行都重复基因名字符串，整张切片的 merged_goodPoints_<method>.csv 可达数 GB，
+读取时大部分时间花在解析文本上。spot_format = npy（或 both）时，合并步骤另外写出
+<同名>.spots/ 目录：
+
+    x.npy, y.npy, z.npy   int32 坐标，与 CSV 中的数值相同
+    gene.npy              基因编号（uint8，基因多于 256 个时为 uint16）
+    genes.csv             编号 -> 基因名
+    tile_ids.npy          各分组的编号（位置合并时为子块号，点拼接时为位置号）
+    tile_offsets.npy      各分组在列中的起止行，长度为分组数 + 1
+    meta.json             点数、格式版本，最后写入
+
+整个目录先写到 .tmp 再改名，存在即表示已写完。读取时可用 mmap 只映射文件，不载入内存。
+
+同时写出两种格式时先写 CSV 再写存储。读取方只在存储的 meta.json 不早于同名 CSV 时使用存储，
+否则（如 MATLAB 第 04 步之后重写了 CSV）读 CSV；只写 CSV 的 Python 步骤会删除旧存储。
+"""
+import argparse
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+COLUMNS = ('x', 'y', 'z')
+SPOT_FORMATS = ('csv', 'npy', 'both')
+
+
+def spot_store_path(csv_path):
+    """goodPoints_max3d.csv -> goodPoints_max3d.spots"""
+    return Path(csv_path).with_suffix('.spots')
+
+
+def fresh_store_path(csv_path):
+    """同名 .spots 存储已写完且不早于 CSV（或没有 CSV）时返回其路径，否则返回 None"""
+    store_path = spot_store_path(csv_path)
+    meta_path = store_path / 'meta.json'
+    if not meta_path.exists():
+        return None
+    csv_path = Path(csv_path)
+    if csv_path.exists() and csv_path.stat().st_mtime_ns > meta_path.stat().st_mtime_ns:
+        return None
+    return store_path
+
+
+def remove_spot_store(csv_path):
+    """只写出 CSV 时删除同名的旧 .spots 存储"""
+    store_path = spot_store_path(csv_path)
+    if store_path.exists():
+        shutil.rmtree(store_path)
+
+
+def get_spot_format(config, section):
+    spot_format = config.get(section, 'spot_format', fallback='csv').strip()
+    if spot_format not in SPOT_FORMATS:
+        raise ValueError(f"[{section}] spot_format 必须是 {'/'.join(SPOT_FORMATS)}，而不是 {spot_format}")
+    return spot_format
+
+
+def spot_outputs(csv_path, spot_format):
+    """按 spot_format 返回应写出的文件：CSV 路径和/或存储的 meta.json"""
+    outputs = []
+    if spot_format in ('csv', 'both'):
+        outputs.append(Path(csv_path))
+    if spot_format in ('npy', 'both'):
+        outputs.append(spot_store_path(csv_path) / 'meta.json')
+    return outputs
+
+
+class SpotWriter:
+    """按分组逐个加入点，close() 时写出存储
+
+    基因编号按首次出现的顺序分配。各分组的列先保存在内存中，写出时逐组拷贝到
+    np.lib.format.open_memmap 打开的文件，不需要再拼接一份完整的副本。
+    """
+
+    def __init__(self, store_path):
+        self.store_path = Path(store_path)
+        self.codes = {}
+        self.tile_ids = []
+        self.chunks = []
+
+    def add(self, tile_id, coords, genes):
+        """coords 为 N×3 坐标（非整数时四舍五入），genes 为长度 N 的基因名数组"""
+        coords = np.asarray(coords)
+        if not np.issubdtype(coords.dtype, np.integer):
+            # 与 MATLAB int32() 相同，.5 远离零取整
+            coords = np.sign(coords) * np.floor(np.abs(coords) + 0.5)
+        genes = np.asarray(genes).astype(str)
+        names, inverse = np.unique(genes, return_inverse=True)
+        lookup = np.array([self.codes.setdefault(name, len(self.codes)) for name in names], dtype=np.uint16)
+        self.tile_ids.append(tile_id)
+        self.chunks.append((np.asarray(coords, dtype=np.int32).reshape(-1, 3), lookup[inverse.reshape(-1)]))
+
+    def close(self):
+        """写出存储，返回点数"""
+        offsets = np.zeros(len(self.chunks) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(coords) for coords, _ in self.chunks])
+
+        def fill(columns, gene):
+            for (start, stop), (coords, codes) in zip(zip(offsets[:-1], offsets[1:]), self.chunks):
+                for axis, column in enumerate(columns):
+                    column[start:stop] = coords[:, axis]
+                gene[start:stop] = codes
+
+        total = write_store(self.store_path, int(offsets[-1]), fill, list(self.codes), self.tile_ids, offsets)
+        self.chunks = []
+        return total
+
+
+def write_store(store_path, total, fill, genes, tile_ids, tile_offsets, extra=None):
+    """写出 total 行的存储：fill(columns, gene) 向 x/y/z 与基因编号的内存映射写入数据
+
+    extra 为 {文件名: 可 JSON 序列化的对象}，随存储一起写出（如索引的网格信息）。
+    """
+    if len(genes) > np.iinfo(np.uint16).max + 1:
+        raise ValueError(f"基因数 {len(genes)} 超过 uint16 编号范围")
+    store_path = Path(store_path)
+    tmp_path = store_path.with_name(store_path.name + '.tmp')
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+    gene_dtype = np.uint8 if len(genes) <= 256 else np.uint16
+    columns = [np.lib.format.open_memmap(tmp_path / f"{name}.npy", mode='w+', dtype=np.int32, shape=(total,))
+               for name in COLUMNS]
+    gene = np.lib.format.open_memmap(tmp_path / 'gene.npy', mode='w+', dtype=gene_dtype, shape=(total,))
+    fill(columns, gene)
+    for array in columns + [gene]:
+        array.flush()
+    del columns, gene
+
+    pd.DataFrame({'code': range(len(genes)), 'Gene': list(genes)}).to_csv(tmp_path / 'genes.csv', index=False)
+    np.save(tmp_path / 'tile_ids.npy', np.asarray(tile_ids, dtype=np.int32))
+    np.save(tmp_path / 'tile_offsets.npy', np.asarray(tile_offsets, dtype=np.int64))
+    for name, content in (extra or {}).items():
+        with open(tmp_path / name, 'w', encoding='utf-8') as f:
+            json.dump(content, f, indent=1)
+    with open(tmp_path / 'meta.json', 'w', encoding='utf-8') as f:
+        json.dump({'format_version': FORMAT_VERSION, 'count': total, 'num_tiles': len(tile_ids),
+                   'num_genes': len(genes)}, f, indent=1)
+
+    if store_path.exists():
+        shutil.rmtree(store_path)
+    tmp_path.rename(store_path)
+    return total
+
+
+def write_spots(store_path, tiles):
+    """tiles 为 [(分组编号, 坐标 N×3, 基因名)]，写出存储并返回点数"""
+    writer = SpotWriter(store_path)
+    for tile_id, coords, genes in tiles:
+        writer.add(tile_id, coords, genes)
+    return writer.close()
+
+
+class SpotTable:
+    """读取 .spots 存储；mmap=True 时各列为只读内存映射"""
+
+    def __init__(self, store_path, mmap=False):
+        self.store_path = Path(store_path)
+        with open(self.store_path / 'meta.json', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta['format_version'] > FORMAT_VERSION:
+            raise ValueError(f"{store_path} 的格式版本 {self.meta['format_version']} 过新")
+        mmap_mode = 'r' if mmap else None
+        self.x, self.y, self.z = (np.load(self.store_path / f"{name}.npy", mmap_mode=mmap_mode) for name in COLUMNS)
+        self.gene = np.load(self.store_path / 'gene.npy', mmap_mode=mmap_mode)
+        self.genes = pd.read_csv(self.store_path / 'genes.csv', keep_default_na=False)['Gene'].astype(str).to_numpy()
+        self.tile_ids = np.load(self.store_path / 'tile_ids.npy')
+        self.tile_offsets = np.load(self.store_path / 'tile_offsets.npy')
+
+    def __len__(self):
+        return int(self.meta['count'])
+
+    def tile_rows(self, tile_id):
+        """分组 tile_id 的行切片"""
+        index = np.flatnonzero(self.tile_ids == tile_id)
+        if not len(index):
+            raise KeyError(f"{self.store_path} 中没有分组 {tile_id}")
+        return slice(int(self.tile_offsets[index[0]]), int(self.tile_offsets[index[0] + 1]))
+
+    def coords(self, rows=slice(None)):
+        """N×3 的 int32 坐标"""
+        return np.stack([self.x[rows], self.y[rows], self.z[rows]], axis=1)
+
+    def gene_names(self, rows=slice(None)):
+        return self.genes[self.gene[rows]]
+
+    def gene_code(self, name):
+        """基因名 -> 编号，不存在时返回 None"""
+        index = np.flatnonzero(self.genes == name)
+        return int(index[0]) if len(index) else None
+
+    def to_frame(self, rows=slice(None)):
+        """与 CSV 相同列的 DataFrame，Gene 为 Categorical，不为每行生成字符串"""
+        frame = pd.DataFrame({name: np.asarray(column[rows]) for name, column in zip(COLUMNS, (self.x, self.y, self.z))})
+        frame['Gene'] = pd.Categorical.from_codes(np.asarray(self.gene[rows]).astype(np.int64), categories=self.genes)
+        return frame
+
+    def to_csv(self, csv_path, chunk_rows=1 << 22):
+        """导出与原 CSV 相同格式的文件，分块写出"""
+        with open(csv_path, 'w', newline='') as f:
+            f.write('x,y,z,Gene\n')
+            for start in range(0, len(self), chunk_rows):
+                self.to_frame(slice(start, start + chunk_rows)).to_csv(f, header=False, index=False)
+
+
+def read_spots(store_path, mmap=False):
+    return SpotTable(store_path, mmap=mmap)
+
+
+def read_spot_table(csv_path):
+    """读取点表为 DataFrame：.spots 存储不早于 CSV 时读取存储，否则读 CSV"""
+    store_path = fresh_store_path(csv_path)
+    if store_path is not None:
+        return read_spots(store_path).to_frame()
+    return pd.read_csv(csv_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="查看、导出或生成 .spots 点表存储")
+    parser.add_argument('path', help='.spots 存储路径，或与 --from-csv 一起使用时的 CSV 路径')
+    parser.add_argument('--csv', help='把存储导出为 CSV')
+    parser.add_argument('--tile', type=int, help='只显示该分组的点数')
+    parser.add_argument('--from-csv', action='store_true', help='把 CSV（如 MATLAB 写出的结果）转换为同名 .spots 存储')
+    args = parser.parse_args()
+
+    if args.from_csv:
+        table = pd.read_csv(args.path)
+        store_path = spot_store_path(args.path)
+        count = write_spots(store_path, [(1, table.iloc[:, :3].to_numpy(), table.iloc[:, 3].astype(str).to_numpy())])
+        print(f"已写出 {store_path}，共 {count} 个点")
+        return
+
+    table = read_spots(args.path, mmap=True)
+    print(f"点数: {len(table)}")
+    print(f"分组数: {len(table.tile_ids)}")
+    print(f"基因数: {len(table.genes)}")
+    if args.tile is not None:
+        rows = table.tile_rows(args.tile)
+        print(f"分组 {args.tile}: {rows.stop - rows.start} 个点")
+    if args.csv:
+        table.to_csv(args.csv)
+        print(f"已写出 {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""点拼接（第 10 步）的 Python 实现，与 stitchpointnewbjx.m 结果一致
+
+按 TileConfiguration.registered.txt 中的顺序把各位置的 goodPoints_<method>.csv 平移到拼接坐标，
+重叠区域归先出现的位置所有：位置的点包围盒与之前各位置包围盒相交的部分丢弃。
+与 MATLAB 版本不同，不为每个位置分配整幅图大小的掩膜，而是直接用矩形判断；
+拼接图只读取 TIFF 头获得尺寸；各位置的点文件并行读取，结果按位置顺序流式写出。
+各位置的 goodPoints_<method>.spots 存储不早于同名 CSV 时读取存储；--format npy/both 时写出按位置分组的 .spots 存储。
+"""
+import argparse
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import tifffile
+
+from spot_store import SPOT_FORMATS, SpotWriter, fresh_store_path, read_spots, remove_spot_store, spot_store_path
+
+TILE_LINE = re.compile(r'^\s*([^;#]+?)\s*;\s*[^;]*;\s*\(([^)]*)\)')
+
+
+def parse_tile_configuration(tile_config):
+    """解析 TileConfiguration.registered.txt，返回 [(位置编号, x, y, z)]
+
+    与 MATLAB 版本一致：坐标先向零取整，再整体平移使最小值为 1。
+    """
+    tiles = []
+    with open(tile_config, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            match = TILE_LINE.match(line)
+            if not match:
+                continue
+            tile = int(re.search(r'\d+', match.group(1)).group())
+            coords = [int(float(value)) for value in match.group(2).split(',')]
+            coords += [0] * (3 - len(coords))
+            tiles.append((tile, *coords[:3]))
+    if not tiles:
+        raise ValueError(f"{tile_config} 中没有位置坐标")
+    offsets = np.abs(np.array([t[1:] for t in tiles]).min(axis=0)) + 1
+    return [(tile, x + offsets[0], y + offsets[1], z + offsets[2]) for tile, x, y, z in tiles]
+
+
+def read_image_shape(image_file):
+    """只读 TIFF 头，返回 (高, 宽)"""
+    with tifffile.TiffFile(image_file) as tif:
+        page = tif.pages[0]
+        return page.imagelength, page.imagewidth
+
+
+def matlab_round(values):
+    """与 MATLAB int32() 相同的四舍五入（.5 远离零）"""
+    return (np.sign(values) * np.floor(np.abs(values) + 0.5)).astype(np.int64)
+
+
+def read_tile_spots(spot_file):
+    """读取一个位置的点，返回 (坐标 N×3, 基因数组)；无点时返回 None"""
+    store_path = fresh_store_path(spot_file)
+    if store_path is not None:
+        table = read_spots(store_path)
+        if not len(table):
+            return None
+        return table.coords().astype(np.float64), table.gene_names()
+    if not Path(spot_file).exists():
+        print(f"警告：{spot_file} 不存在，跳过")
+        return None
+    table = pd.read_csv(spot_file)
+    if table.empty:
+        return None
+    return table.iloc[:, :3].to_numpy(dtype=np.float64), table.iloc[:, 3].astype(str).to_numpy()
+
+
+def owned_mask(points, previous_boxes):
+    """点不落在任何之前位置的包围盒（含边界）内时归当前位置所有"""
+    keep = np.ones(len(points), dtype=bool)
+    # 图像范围外的点全部被裁掉时 points 为空，min/max 无法计算
+    if not previous_boxes or not len(points):
+        return keep
+    lo = points[:, :2].min(axis=0)
+    hi = points[:, :2].max(axis=0)
+    for box_lo, box_hi in previous_boxes:
+        # 只有与当前包围盒相交的矩形才需要逐点判断
+        if np.any(box_lo > hi) or np.any(box_hi < lo):
+            continue
+        inside = np.all((points[:, :2] >= box_lo) & (points[:, :2] <= box_hi), axis=1)
+        keep &= ~inside
+    return keep
+
+
+def stitch_points(tile_config, image_file, registration_dir, output_file, method='max3d', workers=8,
+                  spot_format='csv'):
+    """合并所有位置的点并写出 merged_goodPoints_<method>.csv 和/或 .spots 存储，返回写出的点数"""
+    tiles = parse_tile_configuration(tile_config)
+    height, width = read_image_shape(image_file)
+    spot_files = [Path(registration_dir) / f"Position{tile:03d}" / f"goodPoints_{method}.csv"
+                  for tile, _, _, _ in tiles]
+
+    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+    write_csv = spot_format in ('csv', 'both')
+    writer = SpotWriter(spot_store_path(output_file)) if spot_format in ('npy', 'both') else None
+    if writer is None:
+        remove_spot_store(output_file)
+    previous_boxes = []
+    total = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            (open(output_file, 'w', newline='') if write_csv else nullcontext()) as out:
+        if write_csv:
+            out.write('x,y,z,Gene\n')
+        # map 按提交顺序返回结果，读取并行进行，归属判断和写出按位置顺序进行
+        for (tile, x, y, z), spots in zip(tiles, executor.map(read_tile_spots, spot_files)):
+            if spots is None:
+                continue
+            coords, genes = spots
+            points = matlab_round(coords) + np.array([x, y, z])
+
+            lo = points[:, :2].min(axis=0)
+            hi = np.minimum(points[:, :2].max(axis=0), [width, height])
+            in_image = np.all(points[:, :2] <= hi, axis=1)
+            points, genes = points[in_image], genes[in_image]
+
+            keep = owned_mask(points, previous_boxes)
+            previous_boxes.append((lo, hi))
+
+            # 输出坐标为 0 起始
+            if writer is not None:
+                writer.add(tile, points[keep] - 1, genes[keep])
+            if write_csv:
+                kept = pd.DataFrame(points[keep] - 1, columns=['x', 'y', 'z'])
+                kept['Gene'] = genes[keep]
+                kept.to_csv(out, header=False, index=False)
+            total += int(keep.sum())
+            print(f"Position{tile:03d}: {int(keep.sum())}/{len(points)} 个点")
+    if writer is not None:
+        writer.close()
+        print(f"已写出 {spot_store_path(output_file)}")
+    if write_csv:
+        print(f"已写出 {output_file}")
+    print(f"共 {total} 个点")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="合并各位置的点到拼接坐标")
+    parser.add_argument('--tile-config', required=True, help='TileConfiguration.registered.txt')
+    parser.add_argument('--image', required=True, help='拼接后的二维图（只读取尺寸）')
+    parser.add_argument('--registration-dir', required=True, help='包含 PositionXXX/goodPoints_<method>.csv 的目录')
+    parser.add_argument('--output', required=True, help='输出 CSV 路径')
+    parser.add_argument('--method', default='max3d', help='点检测方法（默认：max3d）')
+    parser.add_argument('--format', default='csv', choices=SPOT_FORMATS,
+                        help='输出格式：csv、npy（.spots 存储）或 both（默认：csv）')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('SLURM_CPUS_PER_TASK', 8)),
+                        help='并行读取线程数（默认：SLURM_CPUS_PER_TASK 或 8）')
+    args = parser.parse_args()
+    stitch_points(args.tile_config, args.image, args.registration_dir, args.output, args.method, args.workers,
+                  args.format)
+
+
+if __name__ == "__main__":
+    main()
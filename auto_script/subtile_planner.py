@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""子块划分规划
+
+第 01 步把每个位置切成子块，02/03 步的每个数组任务处理一个子块。默认与 core_matlab 相同：
+sqrt_pieces × sqrt_pieces 的网格，子块每侧向外扩展 floor(子块边长 × 0.1) 作为重叠。
+
+[LOCAL_REGISTRATION] 设置 subtile_mem_budget 后改由本模块规划：x、y 方向分别取 1..max_pieces 块
+（可以不相等，如 3×4，但子块长宽比不超过 max_aspect），估计最大的子块在 02/03 中的内存
+（与 resource_planner 相同的模型，乘以 [RESOURCES] safety_factor），在不超过预算的网格中选处理像素总数（各子块面积之和）最少的，
+并列时选子块少的。min_overlap 为相邻子块至少重叠的像素数（未设置时为子块边长的 20%）。
+重叠区域被相邻子块重复处理，规划时报告其占图像面积的比例。
+
+规划的网格写到 <project_root>/<project_name>/02_registration/subtile_plan/coords_mat_N.csv，
+通过 'coords_file' 传给 core_matlab；此时 lr_array_tasks 由位置数（gr_array_tasks）× N 得出，
+各脚本中任务号与位置/子块的换算也使用 N。
+
+单独查看规划：
+
+    python subtile_planner.py -c config.ini
+"""
+import argparse
+import configparser
+import csv
+import math
+from functools import lru_cache
+from pathlib import Path
+
+from retry import format_memory, parse_memory
+
+COORDS_COLUMNS = ['t', 'ind_x', 'ind_y', 'scoords_x', 'scoords_y', 'ecoords_x', 'ecoords_y',
+                  'upperleft_x', 'upperleft_y', 'inputdim_x', 'inputdim_y']
+PLAN_DIR = 'subtile_plan'
+
+
+def grid_coords(xy, pieces_x, pieces_y, overlap_half=None):
+    """pieces_x × pieces_y 的划分，返回 coords_mat 的行（字典）
+
+    overlap_half 为子块每侧向外扩展的像素，None 时每个方向取 floor(子块边长 × 0.1)，
+    pieces_x == pieces_y 时与 core_matlab 的划分相同。
+    """
+    tile_x, tile_y = xy // pieces_x, xy // pieces_y
+    half_x = int(tile_x * 0.1) if overlap_half is None else overlap_half
+    half_y = int(tile_y * 0.1) if overlap_half is None else overlap_half
+    rows = []
+    for t, (ind_x, ind_y) in enumerate(((i, j) for i in range(pieces_x) for j in range(pieces_y)), start=1):
+        start_x = ind_x * tile_x - half_x + 1 + (half_x if ind_x == 0 else 0)
+        start_y = ind_y * tile_y - half_y + 1 + (half_y if ind_y == 0 else 0)
+        end_x = xy if ind_x == pieces_x - 1 else min(xy, (ind_x + 1) * tile_x + half_x)
+        end_y = xy if ind_y == pieces_y - 1 else min(xy, (ind_y + 1) * tile_y + half_y)
+        rows.append(dict(zip(COORDS_COLUMNS, [t, ind_x, ind_y, start_x, start_y, end_x, end_y,
+                                              ind_x * tile_x, ind_y * tile_y,
+                                              end_x - start_x + 1, end_y - start_y + 1])))
+    return rows
+
+
+def write_coords_mat(interm_dir, rows):
+    """写出 coords_mat_N.csv，格式与 MATLAB writetable 相同"""
+    path = Path(interm_dir) / f"coords_mat_{len(rows)}.csv"
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COORDS_COLUMNS, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+    tmp_path.replace(path)
+    return path
+
+
+def budget_steps(config):
+    """受子块大小影响的步骤"""
+    if config.getboolean('LOCAL_REGISTRATION', 'fused_spot_finding', fallback=False):
+        return ('local_registration_spot_finding',)
+    return ('local_registration', 'spot_finding')
+
+
+@lru_cache(maxsize=None)
+def grid_plan(xy, depth, channels, rounds, pieces_x, pieces_y, overlap_half, steps, safety):
+    """一个网格的子块坐标、最大子块、估计内存和重复计算比例"""
+    from resource_planner import MB, subtile_estimate
+
+    rows = grid_coords(xy, pieces_x, pieces_y, overlap_half)
+    sub_x = max(row['inputdim_x'] for row in rows)
+    sub_y = max(row['inputdim_y'] for row in rows)
+    mem = max(subtile_estimate(step, sub_x, sub_y, depth, channels, rounds)[0] for step in steps)
+    processed = sum(row['inputdim_x'] * row['inputdim_y'] for row in rows)
+    return {'pieces_x': pieces_x, 'pieces_y': pieces_y, 'num_subtiles': len(rows), 'overlap_half': overlap_half,
+            'subtile_x': sub_x, 'subtile_y': sub_y, 'mem_mb': int(mem * safety / MB),
+            'processed_pixels': processed, 'duplicated': processed / (xy * xy) - 1, 'rows': rows}
+
+
+def is_valid_grid(xy, pieces_x, pieces_y, overlap_half, max_aspect=None):
+    """每个子块至少 1 像素宽，重叠不超过子块边长，长宽比不超过 max_aspect"""
+    tiles = [xy // pieces for pieces in (pieces_x, pieces_y)]
+    if min(tiles) < 1 or (overlap_half is not None and overlap_half > min(tiles)):
+        return False
+    return max_aspect is None or max(tiles) <= max_aspect * min(tiles)
+
+
+def plan_subtiles(config):
+    """返回子块划分 {'pieces_x', 'pieces_y', 'num_subtiles', 'subtile_x', 'subtile_y', 'mem_mb',
+    'duplicated', 'rows', 'planned', ...}
+
+    planned 为 True 时网格由本模块决定（设置了 subtile_mem_budget 或 min_overlap），需要把
+    coords_mat 传给 core_matlab；否则为 sqrt_pieces × sqrt_pieces，与 core_matlab 自行计算的相同。
+    """
+    section = config['LOCAL_REGISTRATION']
+    xy, depth = int(section['image_width']), int(section['image_depth'])
+    channels, rounds = int(section['channel_num']), int(section['round_num'])
+    budget = section.get('subtile_mem_budget', '').strip()
+    min_overlap = section.get('min_overlap', '').strip()
+    overlap_half = math.ceil(int(min_overlap) / 2) if min_overlap else None
+    steps = budget_steps(config)
+    safety = config.getfloat('RESOURCES', 'safety_factor', fallback=1.5)
+
+    if not budget:
+        pieces = int(section['sqrt_pieces'])
+        if not is_valid_grid(xy, pieces, pieces, overlap_half):
+            raise ValueError(f"[LOCAL_REGISTRATION] min_overlap = {min_overlap} 超过 {pieces}×{pieces} 网格的子块边长")
+        return dict(grid_plan(xy, depth, channels, rounds, pieces, pieces, overlap_half, steps, safety),
+                    planned=overlap_half is not None, budget_mb=None)
+
+    budget_mb = parse_memory(budget)
+    max_pieces = section.getint('max_pieces', fallback=8)
+    max_aspect = section.getfloat('max_aspect', fallback=2.0)
+    candidates = [grid_plan(xy, depth, channels, rounds, pieces_x, pieces_y, overlap_half, steps, safety)
+                  for pieces_x in range(1, max_pieces + 1) for pieces_y in range(1, max_pieces + 1)
+                  if is_valid_grid(xy, pieces_x, pieces_y, overlap_half, max_aspect)]
+    fitting = [plan for plan in candidates if plan['mem_mb'] <= budget_mb]
+    if not fitting:
+        smallest = min(candidates, key=lambda plan: plan['mem_mb'])
+        raise ValueError(f"[LOCAL_REGISTRATION] subtile_mem_budget = {budget} 不足：max_pieces = {max_pieces} 时"
+                         f"最小的 {smallest['pieces_x']}×{smallest['pieces_y']} 网格每个子块约需 "
+                         f"{format_memory(smallest['mem_mb'])}")
+    best = min(fitting, key=lambda plan: (plan['processed_pixels'], plan['num_subtiles'],
+                                          abs(plan['pieces_x'] - plan['pieces_y'])))
+    return dict(best, planned=True, budget_mb=budget_mb)
+
+
+def grid_label(plan):
+    """'3x4'，指定了重叠时为 '3x4+32'"""
+    label = f"{plan['pieces_x']}x{plan['pieces_y']}"
+    return label if plan['overlap_half'] is None else f"{label}+{plan['overlap_half']}"
+
+
+def num_subtiles(config):
+    """每个位置的子块数 N"""
+    return plan_subtiles(config)['num_subtiles']
+
+
+def local_array_tasks(config):
+    """02/03 的任务数：规划网格时为位置数 × N，否则为 lr_array_tasks"""
+    plan = plan_subtiles(config)
+    if plan['planned']:
+        return int(config['GLOBAL_REGISTRATION']['gr_array_tasks']) * plan['num_subtiles']
+    return int(config['LOCAL_REGISTRATION']['lr_array_tasks'])
+
+
+def check_array_tasks(config):
+    """未规划网格时 lr_array_tasks 应为位置数 × 子块数（gr_array_tasks × sqrt_pieces²），不一致时返回警告"""
+    plan = plan_subtiles(config)
+    if plan['planned']:
+        return None
+    expected = int(config['GLOBAL_REGISTRATION']['gr_array_tasks']) * plan['num_subtiles']
+    configured = int(config['LOCAL_REGISTRATION']['lr_array_tasks'])
+    if configured == expected:
+        return None
+    return (f"警告：[LOCAL_REGISTRATION] lr_array_tasks = {configured}，与 gr_array_tasks × 子块数 = {expected} 不一致，"
+            f"02/03 {'只处理前 ' + str(configured) + ' 个子块' if configured < expected else '会处理不存在的位置'}")
+
+
+def plan_coords_file(out_dir, plan):
+    """规划的 coords_mat 在 02_registration 下的路径"""
+    return Path(out_dir) / PLAN_DIR / f"coords_mat_{plan['num_subtiles']}.csv"
+
+
+def write_plan(out_dir, plan):
+    """把规划的网格写到 02_registration/subtile_plan/coords_mat_N.csv"""
+    path = plan_coords_file(out_dir, plan)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return write_coords_mat(path.parent, plan['rows'])
+
+
+def describe_plan(plan):
+    overlap = 'floor(子块边长 × 0.1)' if plan['overlap_half'] is None else f"{plan['overlap_half']} 像素"
+    budget = f"（预算 {format_memory(plan['budget_mb'])}）" if plan['budget_mb'] else ''
+    return (f"子块划分：{plan['pieces_x']}×{plan['pieces_y']} = {plan['num_subtiles']} 个子块，每侧扩展 {overlap}，"
+            f"最大子块 {plan['subtile_x']}×{plan['subtile_y']}，估计每个任务 {format_memory(plan['mem_mb'])}{budget}，"
+            f"重叠导致的重复计算 {plan['duplicated']:.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按内存预算规划子块划分")
+    parser.add_argument('-c', '--config', default='config.ini', help='配置文件路径（默认：config.ini）')
+    parser.add_argument('--output', help='把 coords_mat_N.csv 写到该目录')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    plan = plan_subtiles(config)
+    print(describe_plan(plan))
+    print(f"02/03 步任务数：{local_array_tasks(config)}")
+    warning = check_array_tasks(config)
+    if warning:
+        print(warning)
+    if args.output:
+        print(f"已写出 {write_coords_mat(args.output, plan['rows'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""02/03 步数组任务的执行顺序
+
+批处理脚本按数组下标顺序启动任务，任务号 n 对应 Position (n-1)/N+1 的第 (n-1)%N+1 个子块
+（N 为每个位置的子块数）。组织密集的子块耗时长，落在末尾时，%parallel_tasks 的并发下整个步骤
+要等这几个子块跑完。
+
+[LOCAL_REGISTRATION] task_order = cost 时按估计的耗时从大到小启动（最长处理时间优先，LPT）：
+<project_root>/<project_name>/02_registration/task_map.csv 的第 i 行（slot = i）为第 i 个启动的任务号，
+02/03 脚本（含合并模式）按 slot 查表得到位置和子块。--array、OFFSET、sacct 和重试都以 slot 计，
+断点续跑时按表把缺失的任务号换算成 slot。
+
+耗时按以下信号估计，取覆盖任务最多的一种，缺少该信号的任务取中位数：
+  - spots：上次运行的 goodPoints_<method>_t<t>_<N>.csv 中的点数
+  - image：第 01 步写出的 interm/r1merged.tif 在子块窗口内的前景像素数
+    （最大投影超过 intensity_threshold × 255），加上与窗口面积成正比的配准开销
+两种信号都没有时（新项目第一次运行、第 01 步尚未完成）保持原顺序。
+
+tasks_per_job > 1 时先把任务装入数组任务（依次放进当前总耗时最小且未满的数组任务，只有一个数组任务不满），
+再按数组任务的总耗时从大到小排列，未装满的数组任务排在最后。流水线模式下只在每个位置内部排序，OFFSET/TASK_LIMIT 不变。
+
+单独查看排序效果：
+
+    python task_order.py -c config.ini [--write]
+"""
+import argparse
+import configparser
+import csv
+import heapq
+import statistics
+
+from resume import registration_dir
+from subtile_planner import local_array_tasks, plan_subtiles
+
+TASK_ORDERS = ('natural', 'cost')
+TASK_MAP_NAME = 'task_map.csv'
+TASK_MAP_COLUMNS = ['slot', 'task', 'position', 'subtile', 'cost']
+# image 信号中每个窗口像素的配准开销，相对于一个前景像素的点检测开销
+AREA_COST = 0.05
+
+
+def get_task_order(config):
+    """[LOCAL_REGISTRATION] task_order：natural（默认）或 cost"""
+    order = config.get('LOCAL_REGISTRATION', 'task_order', fallback='natural').strip()
+    if order not in TASK_ORDERS:
+        raise ValueError(f"[LOCAL_REGISTRATION] task_order 必须是 {' 或 '.join(TASK_ORDERS)}，而不是 {order}")
+    return order
+
+
+def task_map_path(config):
+    return registration_dir(config) / TASK_MAP_NAME
+
+
+def locate(task_id, subtiles):
+    """任务号 -> (位置编号, 子块编号)"""
+    return (task_id - 1) // subtiles + 1, (task_id - 1) % subtiles + 1
+
+
+def interm_dir(config, position):
+    return registration_dir(config) / f"Position{position:03d}" / 'interm'
+
+
+def spot_costs(config, num_tasks, subtiles):
+    """上次运行的各子块点数 {任务号: 点数}"""
+    method = config['LOCAL_REGISTRATION']['spotfinding_method'].strip()
+    costs = {}
+    for task_id in range(1, num_tasks + 1):
+        position, subtile = locate(task_id, subtiles)
+        path = interm_dir(config, position) / f"goodPoints_{method}_t{subtile}_{subtiles}.csv"
+        if path.exists():
+            with open(path, encoding='utf-8') as f:
+                costs[task_id] = max(0, sum(1 for _ in f) - 1)
+    return costs
+
+
+def image_costs(config, num_tasks, subtiles, rows):
+    """由 r1merged.tif 估计各子块的耗时 {任务号: 前景像素数 + AREA_COST × 窗口面积}"""
+    import numpy as np
+    import tifffile
+
+    threshold = float(config['LOCAL_REGISTRATION']['intensity_threshold']) * 255
+    costs = {}
+    num_positions = (num_tasks + subtiles - 1) // subtiles
+    for position in range(1, num_positions + 1):
+        path = interm_dir(config, position) / 'r1merged.tif'
+        if not path.exists():
+            continue
+        image = tifffile.imread(str(path))
+        foreground = (image.max(axis=0) if image.ndim == 3 else image) > threshold
+        for row in rows:
+            task_id = (position - 1) * subtiles + row['t']
+            if task_id > num_tasks:
+                break
+            # coords_mat 为 1 起始的闭区间，行为 y、列为 x
+            window = foreground[row['scoords_y'] - 1:row['ecoords_y'], row['scoords_x'] - 1:row['ecoords_x']]
+            costs[task_id] = float(np.count_nonzero(window)) + AREA_COST * window.size
+    return costs
+
+
+def estimate_costs(config):
+    """返回 (各任务的估计耗时列表, 信号名)，没有可用信号时返回 (None, None)"""
+    num_tasks = local_array_tasks(config)
+    plan = plan_subtiles(config)
+    subtiles = plan['num_subtiles']
+    signals = [('spots', spot_costs(config, num_tasks, subtiles))]
+    if len(signals[0][1]) < num_tasks:
+        signals.append(('image', image_costs(config, num_tasks, subtiles, plan['rows'])))
+    source, costs = max(signals, key=lambda signal: len(signal[1]))
+    if not costs:
+        return None, None
+    fill = statistics.median(costs.values())
+    return [costs.get(task_id, fill) for task_id in range(1, num_tasks + 1)], source
+
+
+def pack_tasks(task_ids, costs, tasks_per_job):
+    """把 task_ids 装入每个最多 tasks_per_job 个任务的数组任务，按数组任务总耗时从大到小返回任务顺序
+
+    脚本按固定的 tasks_per_job 个 slot 一组划分数组任务，所以除最后一个外每个数组任务都装满，
+    未装满的数组任务放在最后，返回顺序按块划分时每块恰好是一个装好的数组任务。
+    """
+    full_jobs, remainder = divmod(len(task_ids), tasks_per_job)
+    capacities = [tasks_per_job] * full_jobs + ([remainder] if remainder else [])
+    jobs = [[] for _ in capacities]
+    loads = [(0.0, index) for index in range(len(jobs))]
+    for task_id in sorted(task_ids, key=lambda t: (-costs[t - 1], t)):
+        load, index = heapq.heappop(loads)
+        jobs[index].append(task_id)
+        if len(jobs[index]) < capacities[index]:
+            heapq.heappush(loads, (load + costs[task_id - 1], index))
+    jobs.sort(key=lambda job: (len(job) < tasks_per_job, -sum(costs[t - 1] for t in job), job[0]))
+    return [task_id for job in jobs for task_id in job]
+
+
+def order_tasks(config, costs):
+    """按估计耗时排好的任务号列表（slot i 对应第 i 个）"""
+    num_tasks = len(costs)
+    tasks_per_job = max(1, config.getint('LOCAL_REGISTRATION', 'tasks_per_job', fallback=1))
+    if not config.getboolean('LOCAL_REGISTRATION', 'streaming', fallback=False):
+        return pack_tasks(list(range(1, num_tasks + 1)), costs, tasks_per_job)
+    # 流水线模式：每个位置的任务仍占用原来的 slot 区间
+    subtiles = plan_subtiles(config)['num_subtiles']
+    order = []
+    for offset in range(0, num_tasks, subtiles):
+        order += pack_tasks(list(range(offset + 1, min(offset + subtiles, num_tasks) + 1)), costs, tasks_per_job)
+    return order
+
+
+def estimated_makespan(order, costs, tasks_per_job, parallel_tasks):
+    """数组任务按 slot 顺序在 parallel_tasks 个并发位置上依次启动时的总耗时（与 costs 同单位）"""
+    job_costs = [sum(costs[t - 1] for t in order[i:i + tasks_per_job]) for i in range(0, len(order), tasks_per_job)]
+    running = [0.0] * min(max(1, parallel_tasks), max(1, len(job_costs)))
+    for cost in job_costs:
+        heapq.heappush(running, heapq.heappop(running) + cost)
+    return max(running)
+
+
+def compare_makespans(config, order, costs):
+    """(原顺序, 排序后) 的估计总耗时"""
+    tasks_per_job = max(1, config.getint('LOCAL_REGISTRATION', 'tasks_per_job', fallback=1))
+    parallel_tasks = int(config['LOCAL_REGISTRATION']['lr_parallel_tasks'])
+    return (estimated_makespan(list(range(1, len(costs) + 1)), costs, tasks_per_job, parallel_tasks),
+            estimated_makespan(order, costs, tasks_per_job, parallel_tasks))
+
+
+def write_task_map(config, order, costs):
+    """写出 task_map.csv（先写临时文件再替换），返回路径"""
+    subtiles = plan_subtiles(config)['num_subtiles']
+    path = task_map_path(config)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(TASK_MAP_COLUMNS)
+        for slot, task_id in enumerate(order, 1):
+            writer.writerow([slot, task_id, *locate(task_id, subtiles), f"{costs[task_id - 1]:g}"])
+    tmp_path.replace(path)
+    return path
+
+
+def load_task_map(config):
+    """返回 slot -> 任务号的列表（下标 0 为 slot 1）；未启用、文件缺失或与当前任务数不符时返回 None"""
+    if get_task_order(config) != 'cost':
+        return None
+    path = task_map_path(config)
+    if not path.exists():
+        return None
+    with open(path, newline='', encoding='utf-8') as f:
+        order = [int(row['task']) for row in csv.DictReader(f)]
+    if sorted(order) != list(range(1, local_array_tasks(config) + 1)):
+        print(f"警告：{path} 与当前的任务数不符，按原顺序运行")
+        return None
+    return order
+
+
+def task_slots(task_map, task_ids):
+    """任务号 -> slot（排序），task_map 为 None 时不变"""
+    if task_map is None:
+        return sorted(task_ids)
+    slot_of = {task_id: slot for slot, task_id in enumerate(task_map, 1)}
+    return sorted(slot_of[task_id] for task_id in task_ids)
+
+
+def plan_task_order(config):
+    """task_order = cost 时估计耗时并写出 task_map.csv，返回说明；没有信号时删除旧表"""
+    if get_task_order(config) != 'cost':
+        return None
+    path = task_map_path(config)
+    costs, source = estimate_costs(config)
+    if costs is None:
+        if path.exists():
+            path.unlink()
+        return "任务顺序：没有上次的点数或 r1merged.tif，02/03 按原顺序运行"
+    order = order_tasks(config, costs)
+    write_task_map(config, order, costs)
+    natural, ordered = compare_makespans(config, order, costs)
+    return (f"任务顺序：按 {source} 估计的耗时从大到小，已写出 {path}；"
+            f"估计总耗时为原顺序的 {ordered / natural if natural else 1:.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按估计耗时排列 02/03 步的数组任务")
+    parser.add_argument('-c', '--config', default='config.ini', help='配置文件路径（默认：config.ini）')
+    parser.add_argument('--write', action='store_true', help='写出 task_map.csv（否则只显示估计结果）')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    costs, source = estimate_costs(config)
+    if costs is None:
+        print("没有上次的点数或 r1merged.tif，无法估计耗时")
+        return
+    order = order_tasks(config, costs)
+    natural, ordered = compare_makespans(config, order, costs)
+    print(f"耗时信号：{source}，{len(costs)} 个任务")
+    print(f"估计总耗时（{config['LOCAL_REGISTRATION']['lr_parallel_tasks']} 并发）：原顺序 {natural:g}，按耗时排序 {ordered:g}")
+    if args.write:
+        print(f"已写出 {write_task_map(config, order, costs)}")
+
+
+if __name__ == "__main__":
+    main()
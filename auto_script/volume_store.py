@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""配准体积的分块存储（zarr）
+
+volume_format = zarr 时，全局配准把每个位置的配准结果只写一次到
+PositionXXX/interm/registeredImages.zarr，不再为每个子块各存一份重叠的 .mat；
+局部配准结果写到 registeredImages_t{t}_{N}.zarr。
+
+数组轴顺序与 MATLAB 一致：(y, x, z, channel, round)，按 Fortran 顺序存储、不压缩，
+块大小为 tile_size x tile_size x 全部 z x 1 x 1（规划的网格为各轴的子块间距），与子块网格对齐，
+core_matlab 直接 fwrite/fread 每个块，后续步骤只读取与自己子块窗口相交的块。
+.zarray 最后写入，存在即表示该存储已写完。
+"""
+import argparse
+import csv
+import shutil
+from pathlib import Path
+
+import numpy as np
+import zarr
+
+GLOBAL_STORE_NAME = 'registeredImages.zarr'
+
+
+def global_store_path(interm_dir):
+    return Path(interm_dir) / GLOBAL_STORE_NAME
+
+
+def subtile_store_path(interm_dir, subtile, num_subtiles):
+    return Path(interm_dir) / f"registeredImages_t{subtile}_{num_subtiles}.zarr"
+
+
+def is_complete(store_path):
+    return (Path(store_path) / '.zarray').exists()
+
+
+def read_coords(interm_dir, num_subtiles):
+    """读取 coords_mat_N.csv，返回每个子块一行的字典列表（数值为 int）"""
+    with open(Path(interm_dir) / f"coords_mat_{num_subtiles}.csv", newline='') as f:
+        return [{key: int(float(value)) for key, value in row.items()} for row in csv.DictReader(f)]
+
+
+def subtile_window(coords_row):
+    """coords_mat 的一行 -> (行切片, 列切片)；coords_mat 为 1 起始、含末端"""
+    return (slice(coords_row['scoords_y'] - 1, coords_row['ecoords_y']),
+            slice(coords_row['scoords_x'] - 1, coords_row['ecoords_x']))
+
+
+def open_volume(store_path, mode='r'):
+    return zarr.open_array(str(store_path), mode=mode)
+
+
+def read_window(store_path, rows, cols):
+    """读取 (rows, cols) 窗口内所有 z/通道/轮次，只读取相交的块"""
+    return open_volume(store_path)[rows, cols]
+
+
+def read_subtile(interm_dir, subtile, num_subtiles):
+    """读取子块 subtile 的全局配准结果，与 .mat 格式中的 t_output 相同"""
+    coords = read_coords(interm_dir, num_subtiles)[subtile - 1]
+    return read_window(global_store_path(interm_dir), *subtile_window(coords))
+
+
+def write_volume(store_path, volume, chunk_yx=None, compressor=None):
+    """写出 (y, x, z, channel, round) 体积，先写到临时目录再改名，保证读到的存储都是完整的
+
+    chunk_yx 为 y/x 方向的块大小，一个整数时两个方向相同，None 时不分块。
+    compressor 为 None 时与 core_matlab 写出的格式相同；压缩的存储只能由 Python 读取。
+    """
+    volume = np.asarray(volume)
+    volume = volume.reshape(volume.shape + (1,) * (5 - volume.ndim))
+    chunk_y, chunk_x = np.broadcast_to(chunk_yx or max(volume.shape[:2]), 2).tolist()
+    store_path = Path(store_path)
+    tmp_path = store_path.with_name(store_path.name + '.tmp')
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    array = zarr.open_array(str(tmp_path), mode='w', shape=volume.shape, dtype=volume.dtype,
+                            chunks=(chunk_y, chunk_x, volume.shape[2], 1, 1),
+                            compressor=compressor, fill_value=0, order='F')
+    array[...] = volume
+    if store_path.exists():
+        shutil.rmtree(store_path)
+    tmp_path.rename(store_path)
+    return store_path
+
+
+def describe(store_path):
+    """返回存储的基本信息，供编排器和质检工具使用"""
+    array = open_volume(store_path)
+    return {
+        'path': str(store_path),
+        'shape': array.shape,
+        'chunks': array.chunks,
+        'dtype': str(array.dtype),
+        'compressor': str(array.compressor),
+        'nbytes': array.nbytes,
+        'nchunks_initialized': array.nchunks_initialized,
+        'nchunks': array.nchunks,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="查看配准体积的 zarr 存储")
+    parser.add_argument('store', help='zarr 存储路径，如 Position001/interm/registeredImages.zarr')
+    parser.add_argument('--subtile', type=int, help='只读取该子块（需要同目录下的 coords_mat_N.csv）')
+    parser.add_argument('--num-subtiles', type=int, default=16, help='子块总数 N（默认：16）')
+    parser.add_argument('--mip', help='把 z 方向最大投影写为 tif（各通道/轮次依次排列）')
+    args = parser.parse_args()
+
+    for key, value in describe(args.store).items():
+        print(f"{key}: {value}")
+
+    if args.subtile:
+        coords = read_coords(Path(args.store).parent, args.num_subtiles)[args.subtile - 1]
+        volume = read_window(args.store, *subtile_window(coords))
+        print(f"子块 {args.subtile} 窗口: {volume.shape}")
+    else:
+        volume = open_volume(args.store)[...]
+
+    if args.mip:
+        import tifffile
+        mip = volume.max(axis=2)
+        # (y, x, channel, round) -> (round, channel, y, x)
+        tifffile.imwrite(args.mip, np.ascontiguousarray(mip.transpose(3, 2, 0, 1)))
+        print(f"已写出 {args.mip}")
+
+
+if __name__ == "__main__":
+    main()
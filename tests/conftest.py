@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# auto_script 下的模块按脚本目录互相导入
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'auto_script'))
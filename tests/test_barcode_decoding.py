@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from barcode_decoding import decode_reads, encode_barcode, load_codebook, pattern_mask
+
+# genes.csv 中的条形码，反转后按 new_EncodeBases 手工编码：
+#   Actb  GATTAGAAGTG -> GTGAAGATTAG -> GT GA ... AG = 1 3 3 2 1 3 3 2 1 1
+#   Gapdh TTAGGATAGTA -> ATGATAGGATT -> AT TG ... TT = 3 3 3 3 1 1 2 3 3 2
+GENES_CSV = "Gene,Barcode\nActb,GATTAGAAGTG\nGapdh,TTAGGATAGTA\n"
+REGULAR_SEQS = {'Actb': '1332133211', 'Gapdh': '3333112332'}
+# new_LoadCodebook，remove_index = 6：去掉第 6 位后把 7-10 位移到最前
+SPLIT_SEQS = {'Actb': '3211' + '13321', 'Gapdh': '2332' + '33331'}
+
+
+@pytest.fixture
+def genes_csv(tmp_path):
+    path = tmp_path / 'genes.csv'
+    path.write_text(GENES_CSV, encoding='utf-8')
+    return path
+
+
+def colors_of(*seqs):
+    return np.array([[int(c) for c in seq] for seq in seqs])
+
+
+def test_encode_barcode():
+    assert encode_barcode('GATTAGAAGTG'[::-1]) == REGULAR_SEQS['Actb']
+    assert encode_barcode('TTAGGATAGTA'[::-1]) == REGULAR_SEQS['Gapdh']
+    with pytest.raises(ValueError):
+        encode_barcode('ACGT')
+
+
+@pytest.mark.parametrize('mode, split_loc, seqs', [
+    ('regular', (), REGULAR_SEQS),
+    ('regular', (6,), REGULAR_SEQS),
+    ('duo', (6,), SPLIT_SEQS),
+    # core_matlab 调用 LoadCodebook 时不传 mode，tri 与 duo 的码本相同
+    ('tri', (6,), SPLIT_SEQS),
+])
+def test_codebook_lookup(genes_csv, mode, split_loc, seqs):
+    codebook = load_codebook(genes_csv, mode, split_loc)
+    assert codebook.genes == ['Actb', 'Gapdh']
+    length = len(seqs['Actb'])
+    unknown = '2' * length
+    gene_ids = codebook.lookup(colors_of(seqs['Gapdh'], seqs['Actb'], unknown, seqs['Actb']))
+    assert [codebook.genes[i] if i >= 0 else None for i in gene_ids] == ['Gapdh', 'Actb', None, 'Actb']
+    other = SPLIT_SEQS if seqs is REGULAR_SEQS else REGULAR_SEQS
+    assert codebook.lookup(colors_of(other['Actb'])).tolist() == [-1]
+
+
+def test_lookup_without_reads(genes_csv):
+    codebook = load_codebook(genes_csv, 'duo', (6,))
+    assert codebook.lookup(np.zeros((0, 9), dtype=np.int64)).tolist() == []
+
+
+def test_invalid_mode(genes_csv):
+    with pytest.raises(ValueError):
+        load_codebook(genes_csv, 'quad')
+
+
+def test_regular_pattern():
+    # Actb 的颜色序列从 G 解码：G T G A A G A T T A G，首尾均为 G
+    colors = colors_of(REGULAR_SEQS['Actb'])
+    assert pattern_mask(colors, 'regular', ['G', 'G']).tolist() == [True]
+    assert pattern_mask(colors, 'regular', ['G', 'T']).tolist() == [False]
+
+
+def test_duo_and_tri_patterns():
+    # 前 5 轮从 G 起 3 2 2 2 2 -> A A A A A，后 5 轮从 A 起全为 2 -> A；第 11 轮为组学位
+    colors = colors_of('32222' + '22222' + '1', '12222' + '22222' + '1', '32222' + '22222' + '0')
+    assert pattern_mask(colors[:, :10], 'duo', ['G', 'A', 'A', 'A']).tolist() == [True, False, True]
+    # tri：G 起的组学位颜色 1-3 才能解码
+    assert pattern_mask(colors, 'tri', ['G', 'G', 'A', 'A', 'A']).tolist() == [True, False, False]
+    assert pattern_mask(colors, 'tri', ['A', 'G', 'A', 'A', 'A']).tolist() == [False, False, False]
+    with pytest.raises(ValueError):
+        pattern_mask(colors, 'tri', ['G', 'A', 'A', 'A'])
+
+
+def test_decode_reads_statistics(genes_csv):
+    codebook = load_codebook(genes_csv, 'regular')
+    colors = colors_of(REGULAR_SEQS['Actb'], REGULAR_SEQS['Gapdh'], '2' * 10)
+    gene_ids, stats = decode_reads(colors, codebook, 'regular', ['G', 'G'])
+    assert gene_ids.tolist() == [0, 1, -1]
+    # 从 G 解码：Actb 以 G 结尾，Gapdh 以 A 结尾，全 2 的读段一直是 G
+    assert '[2 / 3]' in stats[0]
+    assert '[2 / 3]' in stats[1]
+    assert '[2 / 2]' in stats[2]
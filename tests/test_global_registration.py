@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from global_registration import dft_shift, estimate_shifts
+
+SHIFTS = {2: (5, -7, 1), 3: (-3, 4, 0), 4: (0, 0, -2)}
+
+
+def shifted_rounds(shape, ref_round=1, seed=0):
+    """(y, x, z, round)：第 r 轮为参考轮循环平移 -SHIFTS[r]，配准应得到 SHIFTS[r]"""
+    reference = np.random.default_rng(seed).integers(0, 255, size=shape).astype(np.uint8)
+    rounds = {ref_round: reference}
+    for offset, shift in SHIFTS.items():
+        r = offset if offset > ref_round else offset - 1
+        rounds[r] = np.roll(reference, [-s for s in shift], axis=(0, 1, 2))
+    return np.stack([rounds[r] for r in sorted(rounds)], axis=3)
+
+
+def expected_shifts(ref_round=1):
+    shifts = {ref_round: (0, 0, 0)}
+    for offset, shift in SHIFTS.items():
+        shifts[offset if offset > ref_round else offset - 1] = shift
+    return shifts
+
+
+def test_dft_shift():
+    assert [dft_shift(i, 6) for i in range(6)] == [0, 1, 2, -3, -2, -1]
+    assert [dft_shift(i, 5) for i in range(5)] == [0, 1, 2, -2, -1]
+
+
+def test_full_resolution():
+    volumes = shifted_rounds((48, 64, 8))
+    assert estimate_shifts(volumes, 1) == expected_shifts()
+
+
+@pytest.mark.parametrize('coarse_factor, refine_window', [(2, 32), (4, 64), (2, 512)])
+def test_coarse_to_fine(coarse_factor, refine_window):
+    volumes = shifted_rounds((64, 64, 8), seed=1)
+    assert estimate_shifts(volumes, 1, coarse_factor, refine_window) == expected_shifts()
+
+
+def test_reference_round_in_the_middle():
+    volumes = shifted_rounds((40, 40, 6), ref_round=3, seed=2)
+    assert estimate_shifts(volumes, 3) == expected_shifts(3)
+    assert estimate_shifts(volumes, 3, coarse_factor=2, refine_window=24) == expected_shifts(3)
+
+
+def test_single_round():
+    volumes = np.zeros((8, 8, 2, 1), dtype=np.uint8)
+    assert estimate_shifts(volumes, 1) == {1: (0, 0, 0)}
@@ -0,0 +1,134 @@
+import configparser
+from pathlib import Path
+
+import pytest
+
+import main
+from executors import FakeExecutor
+from generate_scripts import generate_scripts
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    """run(overrides, executor, **kwargs)：按覆盖后的 config.ini 生成脚本，在脚本目录中用 executor 运行流程"""
+
+    def run(overrides=None, executor=None, **kwargs):
+        config = configparser.ConfigParser()
+        config.read(Path(__file__).parent.parent / 'auto_script' / 'config.ini')
+        config['PROJECT']['project_root'] = str(tmp_path / 'root') + '/'
+        for section, values in (overrides or {}).items():
+            config[section].update(values)
+        config_path = tmp_path / 'config.ini'
+        with open(config_path, 'w') as f:
+            config.write(f)
+        script_dir = tmp_path / 'scripts'
+        generate_scripts(str(config_path), str(script_dir))
+        monkeypatch.chdir(script_dir)
+        executor = executor or FakeExecutor()
+        return main.run_processing_pipeline(config, executor=executor, **kwargs), executor
+
+    return run
+
+
+def submissions(executor):
+    """脚本名 -> 该脚本的提交记录列表"""
+    by_script = {}
+    for record in executor.submitted:
+        by_script.setdefault(Path(record['script']).name, []).append(record)
+    return by_script
+
+
+def job_of(executor, script):
+    [record] = submissions(executor)[script]
+    return record['job_id']
+
+
+def task_states(executor, script):
+    return {state['state'] for record in submissions(executor)[script]
+            for state in executor.jobs[record['job_id']]['tasks'].values()}
+
+
+def test_full_graph(pipeline):
+    success, executor = pipeline()
+    assert success
+    by_script = submissions(executor)
+    assert sorted(by_script) == ['01_global_registration.sh', '02_local_registration_batch1.sh',
+                                 '03_spot_finding_batch1.sh', '04_local_stitch.sh', '05_IF2_registration.sh',
+                                 '05_IF_registration.sh', '06_IF1_stitch_protein1.srp',
+                                 '07_1_IF1_stitch_protein2.srp', '10_stitchpoint.srp']
+    deps = {script: records[0]['deps'] for script, records in by_script.items()}
+    assert deps['02_local_registration_batch1.sh'] == [('afterok', job_of(executor, '01_global_registration.sh'))]
+    assert deps['03_spot_finding_batch1.sh'] == [('afterok', job_of(executor, '02_local_registration_batch1.sh'))]
+    assert deps['05_IF_registration.sh'] == []
+    assert deps['07_1_IF1_stitch_protein2.srp'] == [('afterok', job_of(executor, '06_IF1_stitch_protein1.srp'))]
+    assert deps['10_stitchpoint.srp'] == [('afterok', job_of(executor, '04_local_stitch.sh')),
+                                          ('afterok', job_of(executor, '06_IF1_stitch_protein1.srp'))]
+
+
+def test_streaming_graph(pipeline):
+    overrides = {section: {'sqrt_pieces': '2'} for section in ('GLOBAL_REGISTRATION', 'LOCAL_REGISTRATION',
+                                                                'LOCAL_STITCH')}
+    overrides['GLOBAL_REGISTRATION'].update(gr_array_tasks='2', gr_parallel_tasks='2')
+    overrides['LOCAL_REGISTRATION'].update(lr_array_tasks='8', lr_parallel_tasks='4', streaming='true')
+    success, executor = pipeline(overrides, end_step='04')
+    assert success
+    by_script = submissions(executor)
+    global_job = job_of(executor, '01_global_registration.sh')
+    registration = by_script['02_local_registration_batch1.sh']
+    spot_finding = by_script['03_spot_finding_batch1.sh']
+    assert [record['env'] for record in registration] == [{'OFFSET': 0, 'TASK_LIMIT': 4},
+                                                         {'OFFSET': 4, 'TASK_LIMIT': 8}]
+    assert [record['deps'] for record in registration] == [[('afterok', f"{global_job}_1")],
+                                                          [('afterok', f"{global_job}_2")]]
+    assert [record['deps'] for record in spot_finding] == [[('aftercorr', record['job_id'])]
+                                                          for record in registration]
+    assert '10_stitchpoint.srp' not in by_script
+
+
+def test_startfrom_endwith_cut(pipeline):
+    success, executor = pipeline(start_step='02', end_step='04')
+    assert success
+    by_script = submissions(executor)
+    assert sorted(by_script) == ['02_local_registration_batch1.sh', '03_spot_finding_batch1.sh',
+                                 '04_local_stitch.sh']
+    # 范围外的 01 视为已完成
+    assert by_script['02_local_registration_batch1.sh'][0]['deps'] == []
+    assert by_script['04_local_stitch.sh'][0]['deps'] == [('afterok', job_of(executor, '03_spot_finding_batch1.sh'))]
+
+
+def test_out_of_memory_is_retried_with_more_resources(pipeline):
+    overrides = {'RETRY': {'max_attempts': '2', 'max_mem': '500G'},
+                 'LOCAL_REGISTRATION': {'lr_array_tasks': '3', 'lr_parallel_tasks': '3'}}
+    executor = FakeExecutor({('03_spot_finding_batch1.sh', '2'): 'OUT_OF_MEMORY',
+                             ('03_spot_finding_batch1.sh', '3'): 'TIMEOUT'})
+    success, executor = pipeline(overrides, executor, end_step='04')
+    assert success
+    original, retry = submissions(executor)['03_spot_finding_batch1.sh']
+    assert original['array'] == '1-3%3'
+    assert retry['array'] == '2,3%3'
+    assert retry['env'] == original['env']
+    assert retry['resources']['mem'] == '128G'
+    assert retry['resources']['time'] == '2-00:00:00'
+    stitch = job_of(executor, '04_local_stitch.sh')
+    assert executor.jobs[stitch]['deps'] == [('afterany', original['job_id']), ('afterok', retry['job_id'])]
+    assert task_states(executor, '04_local_stitch.sh') == {'COMPLETED'}
+
+
+def test_unretryable_failure_cancels_downstream(pipeline):
+    overrides = {'RETRY': {'max_attempts': '2'}}
+    executor = FakeExecutor({('02_local_registration_batch1.sh', '1'): 'FAILED'})
+    success, executor = pipeline(overrides, executor)
+    assert not success
+    assert len(submissions(executor)['02_local_registration_batch1.sh']) == 1
+    for script in ('03_spot_finding_batch1.sh', '04_local_stitch.sh', '10_stitchpoint.srp'):
+        assert task_states(executor, script) == {'CANCELLED'}
+    # 与转录组部分无关的 IF 步骤照常完成
+    assert task_states(executor, '07_1_IF1_stitch_protein2.srp') == {'COMPLETED'}
+
+
+def test_failure_without_retry_uses_kill_on_invalid_dep(pipeline):
+    executor = FakeExecutor({('01_global_registration.sh', '1'): 'FAILED'})
+    success, executor = pipeline(executor=executor, end_step='04')
+    assert not success
+    assert all(job['kill_on_invalid_dep'] for job in executor.jobs.values())
+    assert task_states(executor, '04_local_stitch.sh') == {'CANCELLED'}
@@ -0,0 +1,122 @@
+import configparser
+import os
+from pathlib import Path
+
+import pytest
+
+from resume import is_task_stale, load_manifest, plan_resume, record_completed, registration_dir
+
+STEPS = ['01', '02', '03', '04']
+BASE_TIME = 1_700_000_000
+# 各步骤输出的修改时间（相对 BASE_TIME 的秒数）
+STEP_TIMES = {'01': 0, '02': 10, '03': 20, '04': 30}
+
+
+def touch(path, seconds):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.touch()
+    os.utime(path, (BASE_TIME + seconds, BASE_TIME + seconds))
+
+
+@pytest.fixture
+def config(tmp_path):
+    config = configparser.ConfigParser()
+    config.read(Path(__file__).parent.parent / 'auto_script' / 'config.ini')
+    config['PROJECT']['project_root'] = str(tmp_path) + '/'
+    config['GLOBAL_REGISTRATION']['gr_array_tasks'] = '2'
+    config['LOCAL_STITCH']['ls_array_tasks'] = '2'
+    for section in ('GLOBAL_REGISTRATION', 'LOCAL_REGISTRATION', 'LOCAL_STITCH'):
+        config[section]['sqrt_pieces'] = '2'
+    config['LOCAL_REGISTRATION']['lr_array_tasks'] = '8'
+    return config
+
+
+def interm(config, position):
+    return registration_dir(config) / f"Position{position:03d}" / 'interm'
+
+
+def write_step(config, step, position, subtile=None, seconds=None):
+    """按 mat 格式写出一个任务的输出"""
+    seconds = STEP_TIMES[step] if seconds is None else seconds
+    directory = interm(config, position)
+    if step == '01':
+        for t in range(1, 5):
+            touch(directory / f"registeredImages_t{t}_4.mat", seconds)
+        touch(directory / 'coords_mat_4.csv', seconds)
+    elif step == '02':
+        touch(directory / f"registeredImages_t{subtile}_4.mat", seconds)
+        touch(directory / f"localRegistered_t{subtile}_4.done", seconds)
+    elif step == '03':
+        touch(directory / f"goodPoints_max3d_t{subtile}_4.csv", seconds)
+    else:
+        touch(directory.parent / 'goodPoints_max3d.csv', seconds)
+
+
+def write_tree(config):
+    for position in (1, 2):
+        write_step(config, '01', position)
+        for subtile in range(1, 5):
+            write_step(config, '02', position, subtile)
+            write_step(config, '03', position, subtile)
+        write_step(config, '04', position)
+
+
+def test_fresh_tree_needs_nothing(config):
+    write_tree(config)
+    assert plan_resume(config, STEPS) == {step: [] for step in STEPS}
+
+
+def test_empty_tree_runs_everything(config):
+    assert plan_resume(config, STEPS) == {'01': [1, 2], '02': list(range(1, 9)), '03': list(range(1, 9)),
+                                          '04': [1, 2]}
+
+
+def test_global_registration_only_is_not_local(config):
+    # 第 01 步写出同名的子块 .mat，没有局部配准的标记
+    write_tree(config)
+    write_step(config, '02', 1, 3, seconds=STEP_TIMES['01'])
+    (interm(config, 1) / 'localRegistered_t3_4.done').unlink()
+    assert plan_resume(config, STEPS) == {'01': [], '02': [3], '03': [3], '04': [1]}
+
+
+def test_output_with_same_mtime_as_input_is_stale(config):
+    write_tree(config)
+    write_step(config, '02', 2, 1, seconds=STEP_TIMES['01'])
+    assert is_task_stale(config, '02', 5, {})
+    assert not is_task_stale(config, '02', 6, {})
+
+
+def test_newer_input_marks_task_stale(config):
+    write_tree(config)
+    write_step(config, '02', 2, 2, seconds=25)
+    assert plan_resume(config, STEPS) == {'01': [], '02': [], '03': [6], '04': [2]}
+
+
+def test_changed_config_hash_marks_task_stale(config):
+    write_tree(config)
+    record_completed(config, {step: list(range(1, 9)) if step in ('02', '03') else [1, 2] for step in STEPS})
+    assert load_manifest(config)['03']['8']
+    assert plan_resume(config, STEPS) == {step: [] for step in STEPS}
+    config['LOCAL_REGISTRATION']['intensity_threshold'] = '0.3'
+    assert plan_resume(config, STEPS) == {'01': [], '02': list(range(1, 9)), '03': list(range(1, 9)),
+                                          '04': [1, 2]}
+
+
+def test_scheduling_keys_do_not_change_hash(config):
+    write_tree(config)
+    record_completed(config, {'03': list(range(1, 9))})
+    config['LOCAL_REGISTRATION']['lr_parallel_tasks'] = '16'
+    config['LOCAL_REGISTRATION']['streaming'] = 'true'
+    assert plan_resume(config, STEPS)['03'] == []
+
+
+def test_upstream_rerun_cascades(config):
+    write_tree(config)
+    (interm(config, 2) / 'coords_mat_4.csv').unlink()
+    assert plan_resume(config, STEPS) == {'01': [2], '02': [5, 6, 7, 8], '03': [5, 6, 7, 8], '04': [2]}
+
+
+def test_fused_mode_cascades_from_01_to_03(config):
+    write_tree(config)
+    (interm(config, 1) / 'coords_mat_4.csv').unlink()
+    assert plan_resume(config, ['01', '03', '04']) == {'01': [1], '03': [1, 2, 3, 4], '04': [1]}
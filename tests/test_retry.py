@@ -0,0 +1,63 @@
+import configparser
+from pathlib import Path
+
+from executors import FakeExecutor
+from main import submit_tracked_job
+from retry import RetryPolicy
+from slurm_monitor import JobMonitor
+
+
+class AlwaysFailExecutor(FakeExecutor):
+    """failing 中的脚本每次运行（包括重试）都以 OUT_OF_MEMORY 结束"""
+
+    def __init__(self, failing):
+        super().__init__()
+        self.failing = set(failing)
+
+    def _launch(self, job_id, job, task):
+        super()._launch(job_id, job, task)
+        if Path(job['script']).name in self.failing:
+            job['tasks'][task].update(state='OUT_OF_MEMORY', exit_code='0:125')
+
+
+def make_pipeline(tmp_path, executor, max_attempts):
+    scripts = {}
+    for name in ('upstream', 'middle', 'downstream'):
+        scripts[name] = tmp_path / f"{name}.sh"
+        scripts[name].write_text('#!/bin/bash\n#SBATCH --mem=8G\n', encoding='utf-8')
+    config = configparser.ConfigParser()
+    config.read_dict({'RETRY': {'max_attempts': str(max_attempts)}})
+    monitor = JobMonitor(executor, min_interval=0, max_interval=0)
+    retry = RetryPolicy(config, monitor, lambda *args, **kwargs: submit_tracked_job(monitor, *args, **kwargs))
+    monitor.kill_on_invalid_dep = not retry.enabled
+    upstream = submit_tracked_job(monitor, 'upstream', scripts['upstream'], array='1-2')
+    middle = submit_tracked_job(monitor, 'middle', scripts['middle'], deps=[('afterok', upstream)])
+    downstream = submit_tracked_job(monitor, 'downstream', scripts['downstream'], deps=[('afterok', middle)])
+    return monitor, retry, [upstream, middle, downstream]
+
+
+def test_exhausted_retries_cancel_dependents(tmp_path):
+    executor = AlwaysFailExecutor({'upstream.sh'})
+    monitor, retry, (upstream, middle, downstream) = make_pipeline(tmp_path, executor, max_attempts=1)
+    assert monitor.wait(on_failure=retry) is False
+    scripts = [Path(job['script']).name for job in executor.submitted]
+    assert scripts.count('upstream.sh') == 2
+    assert {middle, downstream} <= monitor.cancelled
+    assert all(job['done'] for job in monitor.jobs.values())
+
+
+def test_unretryable_failure_cancels_dependents(tmp_path):
+    executor = FakeExecutor({('upstream.sh', '2'): 'FAILED'})
+    monitor, retry, (upstream, middle, downstream) = make_pipeline(tmp_path, executor, max_attempts=2)
+    assert monitor.wait(on_failure=retry) is False
+    assert len(executor.submitted) == 3
+    assert {middle, downstream} <= monitor.cancelled
+
+
+def test_orphans_skip_dependents_waiting_on_retry(tmp_path):
+    executor = FakeExecutor({('upstream.sh', '2'): 'OUT_OF_MEMORY'})
+    monitor, retry, (upstream, middle, downstream) = make_pipeline(tmp_path, executor, max_attempts=2)
+    monitor.poll()
+    assert monitor.orphans() == sorted([middle, downstream])
+    assert retry(upstream, monitor.failed_tasks(upstream)) is True
+    assert monitor.orphans() == []
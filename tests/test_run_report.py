@@ -0,0 +1,39 @@
+from datetime import datetime
+
+from run_report import critical_path
+
+
+def summary(script, deps, submit, first_start, last_end):
+    return {'script': script, 'name': script, 'deps': deps, 'submit': f'2024-01-01T{submit}',
+            'first_start': f'2024-01-01T{first_start}', 'last_end': f'2024-01-01T{last_end}'}
+
+
+def test_sequential_steps():
+    summaries = {s['script']: s for s in [summary('01', [], '00:00:00', '00:10:00', '01:00:00'),
+                                          summary('02', ['01'], '00:00:00', '01:05:00', '02:00:00')]}
+    path = critical_path(summaries)
+    assert [(step['script'], step['queued_s'], step['running_s']) for step in path] == [
+        ('01', 600, 3000), ('02', 300, 3300)]
+
+
+def test_overlapping_streaming_steps_fit_wall_clock():
+    # aftercorr：下游在上游结束前就已开始
+    summaries = {s['script']: s for s in [summary('02', [], '00:00:00', '00:00:00', '02:00:00'),
+                                          summary('03', ['02'], '00:00:00', '00:30:00', '02:10:00'),
+                                          summary('04', ['03'], '00:00:00', '00:40:00', '02:15:00')]}
+    path = critical_path(summaries)
+    total = sum(step['queued_s'] + step['running_s'] for step in path)
+    wall = (datetime(2024, 1, 1, 2, 15) - datetime(2024, 1, 1)).total_seconds()
+    assert total == wall
+    assert [(step['queued_s'], step['running_s']) for step in path] == [(0, 7200), (0, 600), (0, 300)]
+
+
+def test_upstream_ending_after_downstream_is_clipped():
+    # b 依赖 a 却比 a 先结束（如 afterany），a 只计入到 b 的时段开始为止
+    summaries = {s['script']: s for s in [summary('a', [], '00:00:00', '00:00:00', '03:00:00'),
+                                          summary('b', ['a'], '00:00:00', '00:10:00', '02:00:00'),
+                                          summary('c', ['b'], '00:00:00', '02:30:00', '04:00:00')]}
+    path = critical_path(summaries)
+    assert [step['script'] for step in path] == ['a', 'b', 'c']
+    assert sum(step['queued_s'] + step['running_s'] for step in path) == 4 * 3600
+    assert [(step['queued_s'], step['running_s']) for step in path] == [(0, 7200), (0, 0), (1800, 5400)]
@@ -0,0 +1,38 @@
+import subprocess
+
+from executors import FakeExecutor, SlurmExecutor
+from slurm_monitor import JobMonitor
+
+
+class SilentExecutor(FakeExecutor):
+    """提交成功但查询永远没有结果的执行后端"""
+
+    def query(self, job_ids):
+        return {}
+
+
+def test_missing_job_marked_unknown():
+    executor = SilentExecutor()
+    monitor = JobMonitor(executor, min_interval=0, max_interval=0, max_missing_polls=3)
+    job_id = executor.submit('step.sh')
+    monitor.track(job_id, 'step')
+    failures = []
+    assert monitor.wait(on_failure=lambda job, tasks: failures.append((job, tasks))) is False
+    assert failures == [(job_id, [(None, 'UNKNOWN', '')])]
+
+
+def test_squeue_failure_gives_no_information(monkeypatch):
+    def failed_squeue(args, **kwargs):
+        return subprocess.CompletedProcess(args, 1, '', 'slurm_load_jobs error: Unable to contact slurm controller')
+
+    monkeypatch.setattr(subprocess, 'run', failed_squeue)
+    assert SlurmExecutor()._query_squeue(['11', '12']) == {}
+
+
+def test_squeue_missing_job_completed(monkeypatch):
+    def squeue(args, **kwargs):
+        return subprocess.CompletedProcess(args, 0, '11_3|RUNNING\n', '')
+
+    monkeypatch.setattr(subprocess, 'run', squeue)
+    assert SlurmExecutor()._query_squeue(['11', '12']) == {'11': {'3': ('RUNNING', '')},
+                                                         '12': {None: ('COMPLETED', 'unknown')}}
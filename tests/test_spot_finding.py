@@ -0,0 +1,73 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from spot_finding import find_channel_spots, plateau_centroids, regional_max_3d
+
+OFFSETS = [offset for offset in itertools.product((-1, 0, 1), repeat=3) if offset != (0, 0, 0)]
+
+
+def neighbors(index, shape):
+    for offset in OFFSETS:
+        other = tuple(i + d for i, d in zip(index, offset))
+        if all(0 <= i < n for i, n in zip(other, shape)):
+            yield other
+
+
+def reference_regional_max(channel):
+    """逐个平台检查的 imregionalmax：26 连通的同值平台，外围没有更高的体素"""
+    mask = np.zeros(channel.shape, dtype=bool)
+    seen = np.zeros(channel.shape, dtype=bool)
+    for start in np.ndindex(channel.shape):
+        if seen[start]:
+            continue
+        value, plateau, frontier, is_max = channel[start], [start], [start], True
+        seen[start] = True
+        while frontier:
+            for other in neighbors(frontier.pop(), channel.shape):
+                if channel[other] > value:
+                    is_max = False
+                elif channel[other] == value and not seen[other]:
+                    seen[other] = True
+                    plateau.append(other)
+                    frontier.append(other)
+        for index in plateau:
+            mask[index] = is_max
+    return mask
+
+
+def test_single_peak():
+    channel = np.zeros((5, 5, 5), dtype=np.uint8)
+    channel[2, 3, 1] = 9
+    channel[2, 2, 1] = 4
+    assert np.argwhere(regional_max_3d(channel)).tolist() == [[2, 3, 1]]
+
+
+def test_plateau_next_to_higher_voxel_is_rejected():
+    channel = np.zeros((3, 6, 1), dtype=np.uint8)
+    channel[1, 1:4, 0] = 5
+    channel[1, 4, 0] = 6
+    mask = regional_max_3d(channel)
+    assert not mask[1, 1:4, 0].any()
+    assert mask[1, 4, 0]
+
+
+def test_flat_plateau_is_one_maximum():
+    channel = np.zeros((4, 4, 3), dtype=np.uint16)
+    channel[1:3, 1:3, 1] = 300
+    assert regional_max_3d(channel)[1:3, 1:3, 1].all()
+    assert plateau_centroids(regional_max_3d(channel) & (channel > 0)).tolist() == [[3, 3, 2]]
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.float32])
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_reference(dtype, seed):
+    # 只有几种强度时会出现大量相连的平台
+    channel = np.random.default_rng(seed).integers(0, 4, size=(6, 7, 5)).astype(dtype)
+    assert np.array_equal(regional_max_3d(channel), reference_regional_max(channel))
+
+
+def test_no_spots_above_threshold():
+    channel = np.full((4, 4, 4), 10, dtype=np.uint8)
+    assert find_channel_spots(channel, 0.5).shape == (0, 3)
@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from local_stitch import merge_position
+from spot_index import resolve_source
+from spot_store import SpotTable, fresh_store_path, read_spot_table, spot_store_path, write_spots
+from stitch_points import read_tile_spots
+
+
+def write_csv(path, rows):
+    pd.DataFrame(rows, columns=['x', 'y', 'z', 'Gene']).to_csv(path, index=False)
+
+
+def age(path, seconds):
+    """把文件的修改时间往前调 seconds 秒"""
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns - int(seconds * 1e9)))
+
+
+def test_round_trip(tmp_path):
+    coords = [np.array([[1, 2, 3], [4, 5, 6]]), np.array([[7.5, -2.5, 0.4]])]
+    genes = [np.array(['Gad1', 'Actb']), np.array(['Gad1'])]
+    store_path = tmp_path / 'goodPoints_max3d.spots'
+    assert write_spots(store_path, [(3, coords[0], genes[0]), (5, coords[1], genes[1])]) == 3
+
+    table = SpotTable(store_path, mmap=True)
+    assert len(table) == 3
+    assert table.coords().tolist() == [[1, 2, 3], [4, 5, 6], [8, -3, 0]]
+    assert table.gene_names().tolist() == ['Gad1', 'Actb', 'Gad1']
+    assert table.tile_rows(5) == slice(2, 3)
+    assert table.genes[table.gene_code('Actb')] == 'Actb' and table.gene_code('Sst') is None
+
+    table.to_csv(tmp_path / 'out.csv')
+    frame = pd.read_csv(tmp_path / 'out.csv')
+    assert frame.values.tolist() == [[1, 2, 3, 'Gad1'], [4, 5, 6, 'Actb'], [8, -3, 0, 'Gad1']]
+
+
+def test_empty_store(tmp_path):
+    store_path = tmp_path / 'empty.spots'
+    assert write_spots(store_path, [(1, np.zeros((0, 3)), np.array([], dtype=str))]) == 0
+    assert len(SpotTable(store_path)) == 0
+    assert read_tile_spots(tmp_path / 'empty.csv') is None
+
+
+def test_stale_store_ignored(tmp_path):
+    csv_path = tmp_path / 'goodPoints_max3d.csv'
+    write_spots(spot_store_path(csv_path), [(1, [[5, 5, 1]], ['OLD'])])
+    age(spot_store_path(csv_path) / 'meta.json', 10)
+    write_csv(csv_path, [[1, 2, 3, 'NEW']])
+
+    assert fresh_store_path(csv_path) is None
+    assert resolve_source(csv_path) == csv_path
+    assert read_spot_table(csv_path)['Gene'].tolist() == ['NEW']
+    assert read_tile_spots(csv_path)[1].tolist() == ['NEW']
+
+
+def test_fresh_store_preferred(tmp_path):
+    csv_path = tmp_path / 'goodPoints_max3d.csv'
+    write_csv(csv_path, [[1, 2, 3, 'CSV']])
+    age(csv_path, 10)
+    write_spots(spot_store_path(csv_path), [(1, [[1, 2, 3]], ['STORE'])])
+
+    assert fresh_store_path(csv_path) == spot_store_path(csv_path)
+    assert resolve_source(csv_path) == spot_store_path(csv_path)
+    assert read_spot_table(csv_path)['Gene'].astype(str).tolist() == ['STORE']
+
+
+def test_csv_merge_removes_old_store(tmp_path):
+    interm = tmp_path / 'interm'
+    interm.mkdir()
+    pd.DataFrame({'t': [1], 'upperleft_x': [0], 'upperleft_y': [0]}).to_csv(interm / 'coords_mat_1.csv', index=False)
+    write_csv(interm / 'goodPoints_max3d_t1_1.csv', [[1, 2, 3, 'NEW']])
+    output = tmp_path / 'goodPoints_max3d.csv'
+    write_spots(spot_store_path(output), [(1, [[5, 5, 1]], ['OLD'])])
+
+    assert merge_position(tmp_path, 1, 'max3d', spot_format='csv') == 1
+    assert not spot_store_path(output).exists()
+    assert read_spot_table(output)['Gene'].tolist() == ['NEW']
+
+    merge_position(tmp_path, 1, 'max3d', spot_format='both')
+    assert fresh_store_path(output) == spot_store_path(output)
@@ -0,0 +1,29 @@
+import numpy as np
+
+from stitch_points import owned_mask
+
+
+def box(lo, hi):
+    return np.array(lo), np.array(hi)
+
+
+def test_empty_points():
+    empty = np.zeros((0, 3), dtype=np.int64)
+    assert owned_mask(empty, []).tolist() == []
+    assert owned_mask(empty, [box([1, 1], [10, 10])]).tolist() == []
+
+
+def test_no_previous_boxes():
+    points = np.array([[5, 5, 1], [20, 20, 1]])
+    assert owned_mask(points, []).tolist() == [True, True]
+
+
+def test_box_edges_are_owned_by_earlier_tile():
+    points = np.array([[10, 10, 1], [11, 10, 1], [10, 11, 1], [1, 1, 2]])
+    assert owned_mask(points, [box([1, 1], [10, 10])]).tolist() == [False, True, True, False]
+
+
+def test_disjoint_and_overlapping_boxes():
+    points = np.array([[5, 5, 1], [15, 5, 1], [25, 5, 1]])
+    boxes = [box([100, 100], [200, 200]), box([10, 0], [20, 10]), box([0, 0], [6, 6])]
+    assert owned_mask(points, boxes).tolist() == [False, False, True]
@@ -0,0 +1,54 @@
+import itertools
+import random
+
+import pytest
+
+from task_order import estimated_makespan, pack_tasks, task_slots
+
+
+def regroup(order, tasks_per_job):
+    """与 02/03 脚本相同，按固定的 tasks_per_job 个 slot 一组划分数组任务"""
+    return [order[i:i + tasks_per_job] for i in range(0, len(order), tasks_per_job)]
+
+
+def test_review_example():
+    costs = [10, 1, 9, 2, 8, 3, 7]
+    order = pack_tasks(list(range(1, 8)), costs, 2)
+    loads = [sum(costs[t - 1] for t in job) for job in regroup(order, 2)]
+    assert sorted(order) == list(range(1, 8))
+    assert len(regroup(order, 2)[-1]) == 1
+    assert loads[:-1] == sorted(loads[:-1], reverse=True)
+    assert max(loads) <= 11
+
+
+@pytest.mark.parametrize('num_tasks, tasks_per_job', list(itertools.product([1, 5, 7, 12, 13], [1, 2, 3, 4, 5])))
+def test_blocks_are_packed_jobs(num_tasks, tasks_per_job):
+    rng = random.Random(num_tasks * 10 + tasks_per_job)
+    costs = [rng.uniform(0, 100) for _ in range(num_tasks)]
+    order = pack_tasks(list(range(1, num_tasks + 1)), costs, tasks_per_job)
+    assert sorted(order) == list(range(1, num_tasks + 1))
+    blocks = regroup(order, tasks_per_job)
+    # 只有最后一块不满，其余各块按总耗时从大到小
+    assert all(len(block) == tasks_per_job for block in blocks[:-1])
+    assert len(blocks[-1]) == (num_tasks % tasks_per_job or tasks_per_job)
+    loads = [sum(costs[t - 1] for t in block) for block in blocks if len(block) == tasks_per_job]
+    assert loads == sorted(loads, reverse=True)
+
+
+def test_subset_keeps_task_ids():
+    costs = [5, 1, 1, 1, 9, 1, 1]
+    order = pack_tasks([4, 5, 6], costs, 2)
+    assert sorted(order) == [4, 5, 6]
+    assert order[-1] in (4, 6)
+
+
+def test_longest_first_beats_natural_order():
+    costs = [1, 1, 1, 1, 1, 1, 10]
+    order = pack_tasks(list(range(1, 8)), costs, 1)
+    assert order[0] == 7
+    assert estimated_makespan(order, costs, 1, 2) < estimated_makespan(list(range(1, 8)), costs, 1, 2)
+
+
+def test_task_slots():
+    assert task_slots(None, [3, 1]) == [1, 3]
+    assert task_slots([7, 3, 1, 2, 4, 5, 6], [1, 7]) == [1, 3]
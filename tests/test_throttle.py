@@ -0,0 +1,84 @@
+import pytest
+
+from main import split_parallel
+from slurm_monitor import JobMonitor
+
+
+@pytest.mark.parametrize('limit, sizes', [(4, [3] * 6), (10, [1000, 1000, 50]), (3, [5, 1, 1, 1, 1]), (7, [4, 4, 4])])
+def test_split_never_exceeds_cap(limit, sizes):
+    quotas = split_parallel(limit, sizes)
+    assert sum(quotas) == limit
+    assert all(0 <= quota <= size for quota, size in zip(quotas, sizes))
+
+
+def test_split_without_contention():
+    assert split_parallel(10, [2, 3]) == [2, 3]
+
+
+def test_split_largest_remainder():
+    assert split_parallel(10, [1000, 1000, 50]) == [5, 5, 0]
+    assert split_parallel(3, [5, 1, 1, 1, 1]) == [2, 1, 0, 0, 0]
+
+
+class ScriptedExecutor:
+    """查询结果由测试直接设置的执行后端"""
+
+    name = 'scripted'
+    poll_intervals = (0, 0)
+
+    def __init__(self):
+        self.states = {}
+        self.throttles = {}
+        self.released = []
+
+    def query(self, job_ids):
+        return {job_id: self.states[job_id] for job_id in job_ids if job_id in self.states}
+
+    def set_throttle(self, job_id, throttle):
+        self.throttles[job_id] = throttle
+        return True
+
+    def release(self, job_ids):
+        self.released += job_ids
+
+
+def tasks(running, pending):
+    states = {str(i): ('RUNNING', '') for i in range(1, running + 1)}
+    if pending:
+        states[f'[{running + 1}-{running + pending}]'] = ('PENDING', '')
+    return states
+
+
+def test_held_jobs_released_in_order_within_cap():
+    executor = ScriptedExecutor()
+    monitor = JobMonitor(executor)
+    for job_id in ('1', '2', '3'):
+        monitor.track(job_id, 'step')
+    monitor.add_throttle_group(['1', '2', '3'], 2, held=['2', '3'])
+
+    executor.states = {'1': tasks(2, 3), '2': tasks(0, 4), '3': tasks(0, 4)}
+    monitor.poll()
+    monitor.rebalance_throttles()
+    assert executor.released == []
+
+    # 作业 1 只剩 1 个运行中的任务：空出的 1 个名额释放作业 2，作业 3 仍暂停
+    executor.states['1'] = {'1': ('COMPLETED', '0:0'), '2': ('COMPLETED', '0:0'), '3': ('RUNNING', '')}
+    monitor.poll()
+    monitor.rebalance_throttles()
+    assert executor.released == ['2']
+    assert executor.throttles == {'1': 1, '2': 1}
+
+    executor.states['1'] = {str(i): ('COMPLETED', '0:0') for i in range(1, 4)}
+    executor.states['2'] = tasks(1, 3)
+    monitor.poll()
+    monitor.rebalance_throttles()
+    assert executor.released == ['2']
+    assert executor.throttles == {'1': 1, '2': 2}
+
+    # 作业 2 没有排队的任务后，作业 3 才分到名额
+    executor.states['2'] = {'1': ('COMPLETED', '0:0'), '2': ('COMPLETED', '0:0'), '3': ('RUNNING', ''),
+                            '4': ('COMPLETED', '0:0')}
+    monitor.poll()
+    monitor.rebalance_throttles()
+    assert executor.released == ['2', '3']
+    assert executor.throttles['2'] + executor.throttles['3'] == 2